@@ -0,0 +1,153 @@
+"""
+A fake XNAT server for the benchmarks. It answers the few REST calls the orchestrator makes (experiment lookup,
+resource listing, file catalog and file download) and serves a synthetic FreeSurfer subject per session.
+File contents are generated deterministically from the session and path, so nothing is stored on disk.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+resource_label = 'FREESURFER'
+
+# Large imaging files share most of the resource size, the rest goes to many small text files
+large_files = [f"mri/{name}.mgz" for name in ('orig', 'T1', 'brain', 'brainmask', 'norm', 'aseg', 'aparc+aseg', 'wm')]
+large_files += [f"surf/{hemi}.{name}" for hemi in ('lh', 'rh') for name in ('white', 'pial', 'inflated', 'sphere', 'sphere.reg', 'thickness', 'curv')]
+small_files = ['scripts/recon-all.log', 'scripts/recon-all.done', 'stats/aseg.stats', 'stats/lh.aparc.stats', 'stats/rh.aparc.stats']
+
+
+def synthetic_tree(subject: str, file_count: int, total_bytes: int) -> List[Tuple[str, int]]:
+    """
+    Lays out a FreeSurfer subject of a given number of files and total size.
+
+    Returns:
+    - List[Tuple[str, int]]: The path of each file relative to the resource and its size.
+    """
+    large = large_files[:max(1, min(len(large_files), file_count // 2))]
+    small = list(small_files)
+    while len(large) + len(small) < file_count:
+        small.append(f"label/{'lh' if len(small) % 2 else 'rh'}.extra-{len(small)}.label")
+    small = small[:max(0, file_count - len(large))]
+
+    large_size = int(total_bytes * 0.9) // len(large)
+    small_size = max(1, int(total_bytes * 0.1) // max(1, len(small)))
+    return [(f"{subject}/{path}", large_size) for path in large] + [(f"{subject}/{path}", small_size) for path in small]
+
+
+def file_content(session: str, path: str, size: int) -> bytes:
+    """The deterministic content of a synthetic file."""
+    generator = random.Random(f"{session}/{path}")
+    if path.endswith(('.log', '.stats', '.label', '.done')):
+        line = f"{path} {session}\n".encode()
+        return (line * (size // len(line) + 1))[:size]
+    return generator.randbytes(size)
+
+
+class FakeXNAT:
+    """
+    The sessions served by the fake server and their synthetic resources.
+
+    Parameters:
+    - project (str): The project the sessions belong to.
+    - sessions (Dict[str, str]): The BIDS subject of each session label.
+    - file_count (int): The number of files of each FreeSurfer resource.
+    - total_mb (float): The size of each FreeSurfer resource in megabytes.
+    - latency (float): Seconds added to every request, to emulate a remote server.
+    """
+
+    def __init__(self, project: str, sessions: Dict[str, str], file_count: int = 40, total_mb: float = 20, latency: float = 0.0):
+        self.project = project
+        self.sessions = sessions
+        self.experiment_ids = {f"BENCH_E{index:05d}": label for index, label in enumerate(sorted(sessions))}
+        self.file_count = file_count
+        self.total_bytes = int(total_mb * 1024 * 1024)
+        self.latency = latency
+        self.requests = 0
+        self.bytes_served = 0
+        self._digests: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def files(self, label: str) -> List[Tuple[str, int]]:
+        return synthetic_tree(self.sessions[label], self.file_count, self.total_bytes)
+
+    def digest(self, label: str, path: str, size: int) -> str:
+        key = (label, path)
+        if key not in self._digests:
+            self._digests[key] = hashlib.md5(file_content(label, path, size)).hexdigest()
+        return self._digests[key]
+
+    def start(self, port: int = 0) -> str:
+        """Serves the sessions in a background thread and returns the base URL."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _send(self, handler: BaseHTTPRequestHandler, status: int, body: bytes, content_type: str = 'application/json') -> None:
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self._lock:
+            self.bytes_served += len(body)
+
+    def _json(self, handler: BaseHTTPRequestHandler, rows: List[Dict]) -> None:
+        self._send(handler, 200, json.dumps({'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}).encode())
+
+    def handle(self, handler: BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+
+        match = re.match(r"^/data/projects/([^/]+)/experiments/?$", url.path)
+        if match:
+            label = query.get('label', [''])[0]
+            rows = [{'ID': experiment_id, 'label': label} for experiment_id, experiment_label in self.experiment_ids.items()
+                    if experiment_label == label and match.group(1) == self.project]
+            return self._json(handler, rows)
+
+        match = re.match(r"^/data/experiments/([^/]+)(/resources(?:/([^/]+)/files(?:/(.+))?)?)?/?$", url.path)
+        if not match or match.group(1) not in self.experiment_ids:
+            return self._send(handler, 404, b'Not found', 'text/plain')
+
+        experiment_id, label = match.group(1), self.experiment_ids[match.group(1)]
+        if match.group(2) is None:
+            return self._json(handler, [{'ID': experiment_id, 'label': label, 'project': self.project}])
+        if match.group(3) is None:
+            return self._json(handler, [{'label': resource_label, 'xnat_abstractresource_id': '1'}])
+        if match.group(3) != resource_label:
+            return self._send(handler, 404, b'Not found', 'text/plain')
+
+        files = dict(self.files(label))
+        if match.group(4) is None:
+            base = f"/data/experiments/{experiment_id}/resources/{resource_label}/files"
+            return self._json(handler, [{'URI': f"{base}/{path}", 'Name': path.split('/')[-1], 'Size': str(size), 'digest': self.digest(label, path, size)}
+                                        for path, size in files.items()])
+        if match.group(4) not in files:
+            return self._send(handler, 404, b'Not found', 'text/plain')
+        self._send(handler, 200, file_content(label, match.group(4), files[match.group(4)]), 'application/octet-stream')
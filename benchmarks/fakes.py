@@ -0,0 +1,215 @@
+"""
+Stand-ins for the SSH connection and the XNAT client used by the orchestrator. Remote commands run locally
+inside the fake cluster directory (see shims/_cluster.py) and XNAT requests go to the fake server over HTTP.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, Optional
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shims'))
+
+import _cluster  # noqa: E402
+
+
+class _ProcessChannel:
+    """The exit status and stdin shutdown of a running command, like a paramiko channel."""
+
+    def __init__(self, process: subprocess.Popen):
+        self._process = process
+
+    def recv_exit_status(self) -> int:
+        return self._process.wait()
+
+    def shutdown_write(self) -> None:
+        self._process.stdin.close()
+
+
+class _ProcessFile:
+    """The stdin, stdout or stderr of a running command, with the parts of paramiko's ChannelFile the orchestrator uses."""
+
+    def __init__(self, stream, channel: _ProcessChannel, wait: bool = False):
+        self._stream = stream
+        self._wait = wait
+        self.channel = channel
+
+    def read(self, size: int = -1) -> bytes:
+        if self._wait:
+            # stderr goes to a temporary file, readable once the command has exited
+            self.channel.recv_exit_status()
+            self._stream.seek(0)
+            self._wait = False
+        return self._stream.read(size)
+
+    def readline(self) -> str:
+        return self._stream.readline().decode('utf-8')
+
+    def readlines(self):
+        return [line.decode('utf-8') for line in self._stream.readlines()]
+
+    def write(self, data) -> None:
+        self._stream.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def flush(self) -> None:
+        self._stream.flush()
+
+
+class _StreamingChannel:
+    """A session channel whose command reads its stdin from sendall and writes its stdout to recv, like the tar streams."""
+
+    def __init__(self, username: str):
+        self.username = username
+        self._stderr = tempfile.TemporaryFile()
+        self._process = None
+
+    def exec_command(self, command: str) -> None:
+        self._process = subprocess.Popen(['bash', '-c', _cluster.to_local(command)], cwd=_cluster.home_dir(self.username),
+                                         env=_cluster.shell_env(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr)
+
+    def sendall(self, data: bytes) -> None:
+        self._process.stdin.write(data)
+
+    def recv(self, size: int) -> bytes:
+        return self._process.stdout.read1(size)
+
+    def shutdown_write(self) -> None:
+        self._process.stdin.close()
+
+    def recv_exit_status(self) -> int:
+        return self._process.wait()
+
+    def makefile_stderr(self, mode: str = 'rb'):
+        self._stderr.seek(0)
+        return self._stderr
+
+    def close(self) -> None:
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+        self._stderr.close()
+
+
+class _Transport:
+    def __init__(self, username: str):
+        self.username = username
+
+    def is_active(self) -> bool:
+        return True
+
+    def open_session(self) -> _StreamingChannel:
+        return _StreamingChannel(self.username)
+
+
+class _SFTPClient:
+    """The SFTP calls of RemoteLogFollower, served from the fake cluster directory."""
+
+    def stat(self, path: str):
+        return os.stat(_cluster.to_local(path))
+
+    def open(self, path: str, mode: str = 'r'):
+        return open(_cluster.to_local(path), mode)
+
+    def close(self) -> None:
+        pass
+
+
+class LocalSSHClient:
+    """Runs the commands of a paramiko SSHClient with bash inside the fake cluster."""
+
+    def __init__(self, username: str):
+        self.username = username
+
+    def exec_command(self, command: str):
+        # Like paramiko, the command runs in the background and exec_command returns at once
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(['bash', '-c', _cluster.to_local(command)], cwd=_cluster.home_dir(self.username),
+                                   env=_cluster.shell_env(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        channel = _ProcessChannel(process)
+        return _ProcessFile(process.stdin, channel), _ProcessFile(process.stdout, channel), _ProcessFile(stderr, channel, wait=True)
+
+    def get_transport(self) -> _Transport:
+        return _Transport(self.username)
+
+    def open_sftp(self) -> _SFTPClient:
+        return _SFTPClient()
+
+    def close(self) -> None:
+        pass
+
+
+class LocalSSHConnection:
+    """Drop-in replacement of utilities.SSHConnection for the fake cluster."""
+
+    def __init__(self, hostname: str, port: int, username: str, private_key_path: Optional[str] = None, **kwargs):
+        self.hostname = hostname
+        self.username = username
+        self._client = LocalSSHClient(username)
+
+    def connect(self) -> 'LocalSSHConnection':
+        return self
+
+    @property
+    def client(self) -> LocalSSHClient:
+        return self._client
+
+    @property
+    def ssh_command(self) -> str:
+        # rsync starts the shim instead of ssh, which runs the remote rsync in the fake cluster
+        return os.path.join(_cluster.shim_dir, 'ssh')
+
+    def close(self) -> None:
+        pass
+
+
+class _Resource:
+    def __init__(self, label: str, uri: str):
+        self.label = label
+        self.uri = uri
+
+
+class _Experiment:
+    def __init__(self, session: 'FakeXNATSession', uri: str):
+        result = session.get_json(f"{uri}/resources")
+        self.resources: Dict[str, _Resource] = {
+            row['label']: _Resource(row['label'], f"{uri}/resources/{row['label']}") for row in result['ResultSet']['Result']
+        }
+
+
+class FakeXNATSession:
+    """The parts of an xnatpy session the orchestrator uses, talking plain HTTP to the fake server."""
+
+    def __init__(self, server: str):
+        self.server = server.rstrip('/')
+        self.interface = requests.Session()
+
+    def __enter__(self) -> 'FakeXNATSession':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.interface.close()
+
+    def get_json(self, uri: str, query: Optional[Dict] = None) -> Dict:
+        response = self.interface.get(f"{self.server}{uri}", params=query)
+        response.raise_for_status()
+        return response.json()
+
+    def download_stream(self, uri: str, target_stream, chunk_size: int = 512 * 1024) -> None:
+        with self.interface.get(f"{self.server}{uri}", stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size):
+                target_stream.write(chunk)
+
+    def create_object(self, uri: str) -> _Experiment:
+        return _Experiment(self, uri)
+
+
+class FakeXNATModule:
+    """Replaces the xnat module imported by utilities.freesurfer, sending every connection to the fake server."""
+
+    def __init__(self, server: str):
+        self.server = server
+
+    def connect(self, server: str, user: Optional[str] = None, password: Optional[str] = None, **kwargs) -> FakeXNATSession:
+        return FakeXNATSession(self.server)
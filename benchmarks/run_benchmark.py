@@ -0,0 +1,232 @@
+"""
+Offline end-to-end benchmark of the orchestrator. Each session runs fmriprep.main() in its own process against
+a fake cluster (shim sbatch, squeue, sacct, myquota and singularity, remote commands run locally) and a fake
+XNAT server serving synthetic FreeSurfer subjects. The step timings and transfer statistics recorded by
+utilities.metrics are aggregated per concurrency level.
+
+Usage:
+    python benchmarks/run_benchmark.py --concurrency 1 10 100 --fs-mb 20 --output-mb 50
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from fake_xnat import FakeXNAT
+from session_worker import stopped_exit_code
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+
+from utilities.job import SINGULARITY_IMAGE  # noqa: E402
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+project_id = 'BENCH'
+
+
+def write_nifti_header(path: str, shape: tuple) -> None:
+    """Writes a gzipped NIfTI-1 header without image data, enough for the job sizing to read the dimensions."""
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, len(shape), *shape, *([1] * (7 - len(shape))))
+    struct.pack_into('<hh', header, 70, 16, 32)
+    struct.pack_into('<8f', header, 76, 1.0, *([2.0] * 7))
+    struct.pack_into('<f', header, 108, 352.0)
+    header[344:348] = b'n+1\0'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wb') as f:
+        f.write(bytes(header))
+
+
+def create_bids_input(input_dir: str, subject: str, bold_runs: int) -> None:
+    """Creates a single-session BIDS directory with one T1w image and a number of BOLD runs."""
+    with open(os.path.join(input_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'benchmark', 'BIDSVersion': '1.8.0'}, f)
+    write_nifti_header(os.path.join(input_dir, subject, 'anat', f"{subject}_T1w.nii.gz"), (256, 256, 176))
+    for run in range(1, bold_runs + 1):
+        write_nifti_header(os.path.join(input_dir, subject, 'func', f"{subject}_task-rest_run-{run}_bold.nii.gz"), (72, 72, 48, 300))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def run_level(root: str, concurrency: int, args: argparse.Namespace) -> Dict:
+    """
+    Runs a number of sessions at once and aggregates their metrics.
+
+    Returns:
+    - Dict: The wall time, the number of failed sessions, and per-step and per-transfer statistics.
+    """
+    level_dir = os.path.join(root, f"concurrency-{concurrency}")
+    cluster_dir = os.path.join(level_dir, 'cluster')
+    os.makedirs(os.path.join(cluster_dir, 'scratch', 'mri'), exist_ok=True)
+    image_path = os.path.join(cluster_dir, SINGULARITY_IMAGE.lstrip('/'))
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    with open(image_path, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+    license_path = os.path.join(level_dir, 'license.txt')
+    with open(license_path, 'w') as f:
+        f.write('benchmark license\n')
+
+    sessions = {f"bench{index:03d}_ses_01": f"sub-bench{index:03d}" for index in range(concurrency)}
+    xnat = FakeXNAT(project_id, sessions, file_count=args.fs_files, total_mb=args.fs_mb, latency=args.xnat_latency)
+    xnat_url = xnat.start()
+
+    commands = []
+    for label, subject in sessions.items():
+        session_dir = os.path.join(level_dir, 'sessions', label)
+        for name in ('input', 'app', 'fmriprep', 'freesurfer', 'temp_files'):
+            os.makedirs(os.path.join(session_dir, name), exist_ok=True)
+        create_bids_input(os.path.join(session_dir, 'input'), subject, args.bold_runs)
+
+        env = dict(os.environ)
+        env.update({
+            'BENCH_CLUSTER_ROOT': cluster_dir,
+            'BENCH_QUEUE_SECONDS': str(args.queue_seconds),
+            'BENCH_COMPUTE_SECONDS': str(args.compute_seconds),
+            'BENCH_OUTPUT_MB': str(args.output_mb),
+            'BENCH_SCRATCH_QUOTA_GB': str(args.scratch_quota_gb),
+            'FMRIPREP_INPUT_DIR': os.path.join(session_dir, 'input'),
+            'FMRIPREP_STAGING_DIR': os.path.join(session_dir, 'app'),
+            'FMRIPREP_OUTPUT_DIR': os.path.join(session_dir, 'fmriprep'),
+            'FREESURFER_OUTPUT_DIR': os.path.join(session_dir, 'freesurfer'),
+            'FMRIPREP_LOG_DIR': os.path.join(session_dir, 'temp_files'),
+            'FS_LICENSE_PATH': license_path,
+            'FMRIPREP_STATE_DIR': os.path.join(session_dir, 'temp_files', 'state'),
+            'FMRIPREP_METRICS_FILE': os.path.join(session_dir, 'metrics.jsonl'),
+            'FREESURFER_CACHE_DIR': os.path.join(level_dir, 'cache'),
+            'XNAT_SESSION_INDEX': os.path.join(level_dir, 'session_index.json'),
+            'XNAT_USER': 'benchmark',
+            'XNAT_PASS': 'benchmark',
+        })
+        command = [sys.executable, os.path.join(benchmark_dir, 'session_worker.py'), '--workflow-id', f"bench-{concurrency}-{label}",
+                   '--session-label', label, '--project-id', project_id, '--xnat-url', xnat_url]
+        if args.stream_freesurfer:
+            command.append('--stream-freesurfer')
+        if args.node_local:
+            command.append('--node-local')
+        commands.append((label, session_dir, command, env))
+
+    def run_sessions(extra: List[str], expected_code: int) -> List[str]:
+        processes = []
+        for label, session_dir, command, env in commands:
+            with open(os.path.join(session_dir, 'worker.log'), 'a') as log:
+                processes.append((label, subprocess.Popen(command + extra, cwd=session_dir, env=env, stdout=log, stderr=subprocess.STDOUT)))
+        failed = []
+        for label, process in processes:
+            try:
+                if process.wait(timeout=max(1, args.timeout - (time.time() - start))) != expected_code:
+                    failed.append(label)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                failed.append(label)
+        return failed
+
+    start = time.time()
+    failed = []
+    if args.restart_after:
+        # Stop every session after the step, then restart it like a new container: same state, empty staging directory
+        failed = run_sessions(['--stop-after', args.restart_after], stopped_exit_code)
+        for label, session_dir, command, env in commands:
+            shutil.rmtree(os.path.join(session_dir, 'app'))
+            os.makedirs(os.path.join(session_dir, 'app'))
+    failed += [label for label in run_sessions([], 0) if label not in failed]
+    wall_seconds = time.time() - start
+    xnat.stop()
+
+    steps: Dict[str, List[float]] = {}
+    transfers: Dict[str, Dict] = {}
+    queue_waits: List[float] = []
+    for label in sessions:
+        metrics_path = os.path.join(level_dir, 'sessions', label, 'metrics.jsonl')
+        if not os.path.exists(metrics_path):
+            continue
+        with open(metrics_path) as f:
+            for line in f:
+                event = json.loads(line)
+                if event['event'] == 'step':
+                    steps.setdefault(event['step'], []).append(event['seconds'])
+                elif event['event'] == 'transfer':
+                    totals = transfers.setdefault(event['kind'], {'count': 0, 'bytes': 0, 'seconds': 0.0, 'throughputs': []})
+                    totals['count'] += 1
+                    totals['bytes'] += event['bytes']
+                    totals['seconds'] += event['seconds']
+                    totals['throughputs'].append(event['bytes_per_second'])
+                elif event['event'] == 'job' and event.get('queue_wait_seconds') is not None:
+                    queue_waits.append(event['queue_wait_seconds'])
+
+    return {
+        'concurrency': concurrency,
+        'wall_seconds': wall_seconds,
+        'failed': failed,
+        'sessions_per_hour': (concurrency - len(failed)) * 3600 / wall_seconds if wall_seconds > 0 else 0.0,
+        'xnat_requests': xnat.requests,
+        'xnat_bytes': xnat.bytes_served,
+        'queue_wait_p50': percentile(queue_waits, 0.5),
+        'steps': {step: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'max': max(values), 'count': len(values)}
+                  for step, values in steps.items()},
+        'transfers': {kind: {'count': totals['count'], 'mb': totals['bytes'] / (1024 * 1024),
+                             'median_mb_per_s': percentile(totals['throughputs'], 0.5) / (1024 * 1024)}
+                      for kind, totals in transfers.items()},
+    }
+
+
+def print_report(result: Dict) -> None:
+    print(f"\n=== {result['concurrency']} concurrent session(s): {result['wall_seconds']:.1f}s wall time, "
+          f"{len(result['failed'])} failed, {result['sessions_per_hour']:.1f} sessions/hour ===")
+    print(f"XNAT: {result['xnat_requests']} requests, {result['xnat_bytes'] / (1024 * 1024):.1f} MB served; "
+          f"median queue wait {result['queue_wait_p50']:.1f}s")
+    print(f"{'step':<24}{'p50 (s)':>10}{'p95 (s)':>10}{'max (s)':>10}{'runs':>8}")
+    for step, stats in result['steps'].items():
+        print(f"{step:<24}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['max']:>10.2f}{stats['count']:>8}")
+    print(f"{'transfer':<24}{'count':>10}{'MB':>10}{'MB/s p50':>10}")
+    for kind, stats in result['transfers'].items():
+        print(f"{kind:<24}{stats['count']:>10}{stats['mb']:>10.1f}{stats['median_mb_per_s']:>10.1f}")
+    if result['failed']:
+        print(f"Failed sessions (see sessions/<label>/worker.log): {', '.join(result['failed'])}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the orchestrator offline against a fake cluster and XNAT server.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100], help="Numbers of concurrent sessions to run. Default is 1 10 100.")
+    parser.add_argument('--fs-files', type=int, default=40, help="Files in each synthetic FreeSurfer resource. Default is 40.")
+    parser.add_argument('--fs-mb', type=float, default=20, help="Size of each synthetic FreeSurfer resource in MB. Default is 20.")
+    parser.add_argument('--bold-runs', type=int, default=2, help="BOLD runs per session. Default is 2.")
+    parser.add_argument('--output-mb', type=float, default=50, help="Size of the derivatives written by the fake fMRIPrep in MB. Default is 50.")
+    parser.add_argument('--queue-seconds', type=float, default=1, help="Simulated SLURM queue wait. Default is 1.")
+    parser.add_argument('--compute-seconds', type=float, default=5, help="Simulated fMRIPrep run time. Default is 5.")
+    parser.add_argument('--scratch-quota-gb', type=float, default=5120, help="The /scratch quota reported by myquota, 10%% of it used. Default is 5120.")
+    parser.add_argument('--xnat-latency', type=float, default=0.0, help="Seconds added to each XNAT request. Default is 0.")
+    parser.add_argument('--stream-freesurfer', action='store_true', help="Stream FreeSurfer resources to the cluster instead of staging them.")
+    parser.add_argument('--node-local', action='store_true', help="Run the jobs with node-local staging under $TMPDIR.")
+    parser.add_argument('--restart-after', type=str, help="Stop each session once this step is done, e.g. prepare_input_data, and rerun it with an empty staging directory.")
+    parser.add_argument('--timeout', type=float, default=1800, help="Seconds after which the sessions of a level are killed. Default is 1800.")
+    parser.add_argument('--root', type=str, help="Directory for the fake cluster and sessions. Default is a temporary directory.")
+    parser.add_argument('--keep', action='store_true', help="Keep the benchmark directory for inspection.")
+    parser.add_argument('--json', type=str, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='fmriprep-benchmark-')
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            result = run_level(root, concurrency, args)
+            print_report(result)
+            results.append(result)
+    finally:
+        if args.keep or args.root:
+            print(f"\nBenchmark files kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,47 @@
+"""
+Runs fmriprep.main() for one synthetic session against the fake cluster and the fake XNAT server.
+Started by run_benchmark.py, which sets the local directories and fake cluster through the environment.
+"""
+import argparse
+import os
+import sys
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(benchmark_dir), 'code'))
+
+import fakes  # noqa: E402
+import fmriprep  # noqa: E402
+import utilities.freesurfer  # noqa: E402
+
+# Exit code of a worker stopped with --stop-after
+stopped_exit_code = 75
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the orchestrator for one benchmark session.')
+    parser.add_argument('--workflow-id', required=True)
+    parser.add_argument('--session-label', required=True)
+    parser.add_argument('--project-id', required=True)
+    parser.add_argument('--xnat-url', required=True)
+    parser.add_argument('--anat-only', action='store_true')
+    parser.add_argument('--stream-freesurfer', action='store_true')
+    parser.add_argument('--node-local', action='store_true')
+    parser.add_argument('--stop-after', type=str, help="Kill the process once this step is recorded as done, like a container that is stopped.")
+    args = parser.parse_args()
+
+    if args.stop_after:
+        mark_done = fmriprep.WorkflowState.mark_done
+
+        def mark_done_and_stop(self, step):
+            mark_done(self, step)
+            if step == args.stop_after:
+                print(f"Stopping after {step}", flush=True)
+                os._exit(stopped_exit_code)
+        fmriprep.WorkflowState.mark_done = mark_done_and_stop
+
+    fmriprep.SSHConnection = fakes.LocalSSHConnection
+    utilities.freesurfer.xnat = fakes.FakeXNATModule(args.xnat_url)
+
+    try:
+        fmriprep.main(args.workflow_id, args.anat_only, '', args.session_label, args.project_id, stream_freesurfer=args.stream_freesurfer, node_local=args.node_local)
+    except SystemExit as e:
+        sys.exit(e.code)
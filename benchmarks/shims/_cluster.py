@@ -0,0 +1,40 @@
+"""
+Shared helpers of the fake cluster. Remote paths (/scratch, /home and the SLURM binaries) are mapped
+into the directory given by BENCH_CLUSTER_ROOT, so every command runs on the local machine.
+"""
+import os
+import re
+
+shim_dir = os.path.dirname(os.path.abspath(__file__))
+
+# /scratch/... and /home/... at the start of a path, not inside a longer local path
+remote_path_pattern = re.compile(r"(?<![\w.\-/])/(scratch|home)/")
+
+
+def cluster_root() -> str:
+    return os.environ['BENCH_CLUSTER_ROOT']
+
+
+def to_local(text: str) -> str:
+    """Rewrites the remote paths of a command or script into the fake cluster."""
+    text = text.replace('/opt/slurm/default/bin/', f"{shim_dir}/")
+    return remote_path_pattern.sub(lambda match: f"{cluster_root()}/{match.group(1)}/", text)
+
+
+def to_remote(text: str) -> str:
+    """Rewrites local paths of the fake cluster back into the remote paths the orchestrator knows."""
+    return text.replace(cluster_root(), '')
+
+
+def home_dir(username: str) -> str:
+    """The home directory of a cluster user, where remote commands start."""
+    path = os.path.join(cluster_root(), 'home', username)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def shell_env() -> dict:
+    """The environment of remote commands, with the shims ahead of the real tools."""
+    env = dict(os.environ)
+    env['PATH'] = f"{shim_dir}{os.pathsep}{env.get('PATH', '')}"
+    return env
@@ -0,0 +1,237 @@
+"""
+A minimal SLURM for the benchmarks. Jobs are JSON records under BENCH_CLUSTER_ROOT/slurm, sbatch starts a
+detached runner that waits BENCH_QUEUE_SECONDS and then runs the script with bash, and squeue and sacct
+report the records in the formats the orchestrator parses.
+"""
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import _cluster
+
+finished_states = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY'}
+
+
+def _slurm_dir() -> str:
+    path = os.path.join(_cluster.cluster_root(), 'slurm')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _job_path(job_id: str) -> str:
+    return os.path.join(_slurm_dir(), f"{job_id}.json")
+
+
+def _next_job_id() -> str:
+    with open(os.path.join(_slurm_dir(), 'next_id'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = int(f.read().strip() or 1000)
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_id + 1))
+    return str(job_id)
+
+
+def _save(job: Dict) -> None:
+    path = _job_path(job['id'])
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(job, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _load_jobs() -> List[Dict]:
+    jobs = []
+    for name in os.listdir(_slurm_dir()):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(_slurm_dir(), name)) as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return sorted(jobs, key=lambda job: int(job['id'].split('_')[0]))
+
+
+def _timestamp(value) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(value)) if value else 'Unknown'
+
+
+def _duration(seconds) -> str:
+    seconds = int(seconds or 0)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _directives(script: str) -> Dict[str, str]:
+    """Parses the #SBATCH lines of a script."""
+    directives = {}
+    for line in script.splitlines():
+        match = re.match(r"^#SBATCH\s+(-\w|--[\w-]+)[=\s]?\s*(\S*)", line)
+        if match:
+            directives[match.group(1)] = match.group(2)
+    aliases = {'-J': '--job-name', '-c': '--cpus-per-task', '-t': '--time', '-o': '--output', '-e': '--error', '-a': '--array'}
+    return {aliases.get(key, key): value for key, value in directives.items()}
+
+
+def _array_tasks(spec: str) -> List[int]:
+    tasks = []
+    for part in spec.split('%')[0].split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            tasks.extend(range(int(first), int(last) + 1))
+        elif part:
+            tasks.append(int(part))
+    return tasks
+
+
+def sbatch(argv: List[str]) -> int:
+    script_path = _cluster.to_local(argv[-1])
+    with open(script_path) as f:
+        directives = _directives(f.read())
+
+    job_id = _next_job_id()
+    tasks = _array_tasks(directives['--array']) if '--array' in directives else [None]
+    for task in tasks:
+        _save({
+            'id': job_id if task is None else f"{job_id}_{task}",
+            'array_id': job_id,
+            'task': task,
+            'name': directives.get('--job-name', os.path.basename(script_path)),
+            'script': _cluster.to_remote(script_path),
+            'cwd': os.getcwd(),
+            'state': 'PENDING',
+            'exit_code': '0:0',
+            'submit': time.time(),
+            'start': None,
+            'end': None,
+            'timelimit': directives.get('--time', '16:00:00'),
+            'req_mem': directives.get('--mem', '0'),
+        })
+
+    # The runner outlives the ssh command that submitted the job, like a real batch job
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'run', job_id, script_path],
+                     start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     env=_cluster.shell_env())
+    print(f"Submitted batch job {job_id}")
+    return 0
+
+
+def run(job_id: str, script_path: str) -> None:
+    """Runs every task of a submitted job after the simulated queue wait."""
+    time.sleep(float(os.getenv('BENCH_QUEUE_SECONDS', 1)))
+
+    with open(script_path) as f:
+        script = f.read()
+    directives = _directives(script)
+    local_script = os.path.join(_slurm_dir(), f"{job_id}.sh")
+    with open(local_script, 'w') as f:
+        f.write(_cluster.to_local(script))
+
+    processes = []
+    for job in [job for job in _load_jobs() if job['array_id'] == job_id]:
+        job.update(state='RUNNING', start=time.time())
+        _save(job)
+
+        def log_path(option: str, default: str) -> str:
+            pattern = directives.get(option, default)
+            name = (pattern.replace('%A', job_id).replace('%a', str(job['task']))
+                    .replace('%j', job['id'].split('_')[0]))
+            return os.path.join(job['cwd'], name)
+
+        env = _cluster.shell_env()
+        env.update(SLURM_JOB_ID=job['id'].split('_')[0], SLURM_CPUS_PER_TASK=directives.get('--cpus-per-task', '1'))
+        if job['task'] is not None:
+            env.update(SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(job['task']))
+        with open(log_path('--output', 'slurm-%j.out'), 'w') as out, open(log_path('--error', 'slurm-%j.out'), 'a') as err:
+            processes.append((job, subprocess.Popen(['bash', local_script], cwd=job['cwd'], env=env, stdout=out, stderr=err)))
+
+    for job, process in processes:
+        exit_code = process.wait()
+        job.update(state='COMPLETED' if exit_code == 0 else 'FAILED', exit_code=f"{exit_code}:0", end=time.time())
+        _save(job)
+
+
+def squeue(argv: List[str]) -> int:
+    job_ids = username = None
+    header = True
+    output_format = '%i %P %j %u %T %M %D %R'
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-j', '--jobs'):
+            job_ids = args.pop(0).split(',')
+        elif arg in ('-u', '--user'):
+            username = args.pop(0)
+        elif arg in ('-o', '--format'):
+            output_format = args.pop(0)
+        elif arg in ('-h', '--noheader'):
+            header = False
+
+    jobs = [job for job in _load_jobs() if job['state'] not in finished_states]
+    if job_ids is not None:
+        jobs = [job for job in jobs if job['id'] in job_ids or job['array_id'] in job_ids]
+
+    fields = {'%i': 'id', '%o': 'script', '%j': 'name', '%T': 'state'}
+    if header:
+        print('JOBID PARTITION NAME USER ST TIME NODES NODELIST(REASON)')
+    for job in jobs:
+        line = output_format
+        for code, key in fields.items():
+            line = line.replace(code, str(job[key]))
+        line = re.sub(r"%\w", '-', line.replace('%P', 'compute').replace('%u', username or 'mri'))
+        print(line)
+    return 0
+
+
+def sacct(argv: List[str]) -> int:
+    job_ids = name = None
+    fields = ['JobID', 'JobName', 'State', 'ExitCode']
+    parsable = False
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-j', '--jobs'):
+            job_ids = args.pop(0).split(',')
+        elif arg in ('-o', '--format'):
+            fields = args.pop(0).split(',')
+        elif arg.startswith('--name='):
+            name = arg.split('=', 1)[1]
+        elif arg in ('-P', '--parsable2'):
+            parsable = True
+        elif arg in ('-u', '-S', '--user', '--starttime'):
+            args.pop(0)
+
+    jobs = _load_jobs()
+    if job_ids is not None:
+        jobs = [job for job in jobs if job['id'] in job_ids or job['array_id'] in job_ids]
+    if name is not None:
+        jobs = [job for job in jobs if job['name'] == name]
+
+    for job in jobs:
+        end = job['end'] or time.time()
+        values = {
+            'JobID': job['id'],
+            'JobName': job['name'],
+            'State': job['state'],
+            'ExitCode': job['exit_code'],
+            'Submit': _timestamp(job['submit']),
+            'Start': _timestamp(job['start']),
+            'End': _timestamp(job['end']),
+            'Elapsed': _duration(end - job['start'] if job['start'] else 0),
+            'Timelimit': job['timelimit'],
+            'MaxRSS': '',
+            'ReqMem': job['req_mem'],
+            'TotalCPU': _duration(0),
+        }
+        row = [values.get(field, '') for field in fields]
+        print('|'.join(row) if parsable else ' '.join(row))
+    return 0
+
+
+if __name__ == '__main__':
+    # Started by sbatch as: _slurm.py run <job id> <script>
+    run(sys.argv[2], sys.argv[3])
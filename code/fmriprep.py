@@ -1,123 +1,354 @@
 import argparse
+import shutil
 import sys
 import os 
 
-from utilities import connect_with_key,\
-    check_storage,\
+from utilities import SSHConnection,\
+    estimate_scratch_footprint,\
+    wait_for_scratch_space,\
+    release_scratch_space,\
     create_work_directory,\
+    prune_work_directories,\
+    bids_subject_label,\
+    persistent_work_directory,\
     sync_data_with_key,\
+    parallel_sync,\
+    archive_sync,\
+    read_remote_manifest,\
+    retrieve_outputs,\
     create_bash_script,\
+    estimate_job_resources,\
+    fetch_usage_history,\
+    prepare_shared_cache,\
     submit_job,\
-    delete,\
+    find_submitted_job,\
+    delete_paths,\
     check_job_status,\
-    try_with_infinite_retry,\
+    wait_for_jobs,\
+    RetryPolicy,\
+    CircuitBreaker,\
+    run_with_retry,\
     print_log,\
-    find_fmriprep_freesurfer_resources_by_subject
+    RemoteLogFollower,\
+    find_fmriprep_freesurfer_resources_by_subject,\
+    find_fmriprep_anatomical_derivatives,\
+    get_fmriprep_freesurfer_resource_size,\
+    stream_fmriprep_freesurfer_resources_to_remote,\
+    cache_stats,\
+    WorkflowState,\
+    configure_metrics,\
+    record_event,\
+    record_job_timing,\
+    timed_step,\
+    write_profile_report,\
+    get_job_timing
+
+from utilities.paths import input_dir, staging_dir, fmriprep_output_dir, freesurfer_output_dir, log_dir, license_path
 
 import time
 
-def main(workflow_id, run_anat_only, flags, session_label, project_id):
+def main(workflow_id, run_anat_only, flags, session_label, project_id, stream_freesurfer=False, retrieve_spaces=None, retrieve_exclude=None, reuse_work_dir=False, work_dir_max_age=14, node_local=False, anat_fast_track=False, resource_monitor=False):
     hostname = "jubail.abudhabi.nyu.edu"
     port = 22
     username = "mri"
+    xnat_url = "http://10.230.12.52"
 
-    client = None
+    connection = None
+    log_follower = None
+    work_dir = None
     job_id = ''
     completed = False
     found_fs = False
+    # Session whose anatomical derivatives are reused, if any
+    anat_session = None
+
+    # Progress and results of the steps, kept on disk so a restarted run resumes where it stopped
+    state = WorkflowState(workflow_id)
+    # Step timings, transfer volumes, retries and queue wait are written to FMRIPREP_METRICS_FILE
+    # and, when FMRIPREP_PROMETHEUS_TEXTFILE is set, to a textfile for the node exporter
+    configure_metrics(workflow=workflow_id, session=session_label, project=project_id)
+
+    def resume():
+        global anat_session, completed, found_fs, job_id, log_follower, work_dir
+        found_fs = state.get('found_fs', False)
+        anat_session = state.get('anat_session')
+        work_dir = state.get('work_dir')
+        job_id = state.get('job_id', '')
+        completed = state.get('completed', False)
+        if state.is_done('run_job'):
+            print(f"Reattaching to job {job_id}")
+            log_follower = RemoteLogFollower([f'/home/{username}/slurm-{workflow_id}.out', f'/home/{username}/slurm-{workflow_id}.err'])
 
     def prepare_input_data():
-        global found_fs
-        found_fs = find_fmriprep_freesurfer_resources_by_subject(
-            xnat_url="http://10.230.12.52",
-            username=os.getenv('XNAT_USER'),
-            password=os.getenv('XNAT_PASS'),
-            project=project_id,
-            session=session_label
-        )
+        global anat_session, found_fs
+        anat_session = None
+        found_fs = False
+        streamed_fs_bytes = None
+        if anat_fast_track and not run_anat_only:
+            # Reuse the anatomical workflow of another session of the subject instead of recomputing it
+            anat_session = find_fmriprep_anatomical_derivatives(
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=project_id,
+                session=session_label,
+                subject=bids_subject_label(input_dir),
+                target_dir=f'{staging_dir}/anat_derivatives'
+            )
+        if anat_session:
+            # The surfaces must come from the same anatomy as the reused T1w, masks and transforms
+            if stream_freesurfer:
+                streamed_fs_bytes = get_fmriprep_freesurfer_resource_size(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                          project=project_id, session=anat_session)
+                found_fs = streamed_fs_bytes is not None
+            else:
+                found_fs = find_fmriprep_freesurfer_resources_by_subject(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                         project=project_id, session=anat_session)
+            if not found_fs:
+                print(f"Session {anat_session} has no FreeSurfer subject, running the anatomical workflow instead of reusing its derivatives")
+                shutil.rmtree(f'{staging_dir}/anat_derivatives', ignore_errors=True)
+                anat_session = None
+        # Staged again on a restart, so whatever it selects is sent again too
+        state.set(anat_session=anat_session, anat_derivatives_sent=False)
+        if stream_freesurfer:
+            if not anat_session:
+                streamed_fs_bytes = get_fmriprep_freesurfer_resource_size(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                          project=project_id, session=session_label)
+            # Nothing is staged locally, so /scratch is reserved for the streamed subject from the size XNAT reports
+            state.set(streamed_freesurfer_bytes=streamed_fs_bytes or 0)
+            print("Streaming mode: freesurfer resources will be sent directly to the cluster")
+            return
+        if not anat_session:
+            found_fs = find_fmriprep_freesurfer_resources_by_subject(
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=project_id,
+                session=session_label
+            )
+        state.set(found_fs=found_fs)
+        record_event('cache', **cache_stats)
+        print(f"FreeSurfer input cache: {cache_stats['hits']} hit(s), {cache_stats['misses']} miss(es), "
+              f"{cache_stats['bytes'] / (1024 * 1024):.1f} MB served from cache")
 
     def connect_server():
-        global client
-        client = connect_with_key(hostname=hostname,port=port,username=username,)
+        global connection
+        # One paramiko client and one multiplexed control connection shared by every command and transfer
+        connection = SSHConnection(hostname=hostname, port=port, username=username).connect()
 
     def check_scratch_space():
-        global client
-        check_storage(client=client)
+        global connection, found_fs, anat_session
+        # Reserve what this session will use on /scratch, waiting while other workflows hold the space
+        footprint = estimate_scratch_footprint(input_dir=input_dir, anat_only=run_anat_only, freesurfer_dir=f'{staging_dir}/freesurfer' if found_fs else None,
+                                               derivatives_dir=f'{staging_dir}/anat_derivatives' if anat_session else None,
+                                               streamed_freesurfer_bytes=state.get('streamed_freesurfer_bytes', 0))
+        wait_for_scratch_space(client=connection.client, username=username, workflow_id=workflow_id, footprint=footprint)
+        state.set(scratch_reservation=footprint)
 
     def create_workspace():
-        global client
-        create_work_directory(client=client, username=username, operation_id=workflow_id)
+        global connection, work_dir
+        create_work_directory(client=connection.client, username=username, operation_id=workflow_id)
+        work_dir = None
+        if reuse_work_dir:
+            # Keep nipype's node cache across reruns of the same session and fMRIPrep version
+            prune_work_directories(client=connection.client, username=username, max_age_days=work_dir_max_age)
+            subject = bids_subject_label(input_dir) or session_label
+            work_dir = persistent_work_directory(username=username, project=project_id, subject=subject, session=session_label)
+            print(f"Using persistent work directory {work_dir}")
+        state.set(work_dir=work_dir, remote_dir=f'/scratch/{username}/{workflow_id}')
 
     def send_data():
-        global found_fs
-
-        sync_data_with_key(action='send', hostname=hostname, username=username, source='/input', destination= f'/scratch/{username}/{workflow_id}')
-        if found_fs:
-            sync_data_with_key(action='send', hostname=hostname, username=username, source='/app/freesurfer', destination= f'/scratch/{username}/{workflow_id}/input/')
+        global connection, found_fs, anat_session
+        # Each transfer is recorded once done, so a retry of this step only repeats the one that failed
+        if not state.get('input_sent', False):
+            parallel_sync(action='send', hostname=hostname, username=username, source=input_dir, destination=f'/scratch/{username}/{workflow_id}/input', client=connection.client, ssh_command=connection.ssh_command)
+            state.set(input_sent=True)
+        if anat_session and not state.get('anat_derivatives_sent', False):
+            archive_sync(action='send', hostname=hostname, username=username, source=f'{staging_dir}/anat_derivatives', destination=f'/scratch/{username}/{workflow_id}/anat_derivatives', client=connection.client, ssh_command=connection.ssh_command)
+            state.set(anat_derivatives_sent=True)
+        if state.get('freesurfer_sent', False):
+            return
+        if stream_freesurfer:
+            # With reused derivatives, the FreeSurfer subject of the session they were computed from
+            found_fs = stream_fmriprep_freesurfer_resources_to_remote(
+                client=connection.client,
+                remote_dir=f'/scratch/{username}/{workflow_id}/input',
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=project_id,
+                session=anat_session or session_label
+            )
+        elif found_fs:
+            # Thousands of small files, streamed as one archive
+            archive_sync(action='send', hostname=hostname, username=username, source=f'{staging_dir}/freesurfer', destination=f'/scratch/{username}/{workflow_id}/input/freesurfer', client=connection.client, ssh_command=connection.ssh_command)
+        state.set(found_fs=found_fs, freesurfer_sent=True)
                 
     def send_fs():
-        sync_data_with_key(action='send', hostname=hostname, username=username, source='/opt/fs', destination= f'/scratch/{username}/{workflow_id}/license.txt')
+        global connection
+        sync_data_with_key(action='send', hostname=hostname, username=username, source=license_path, destination= f'/scratch/{username}/{workflow_id}/license.txt', ssh_command=connection.ssh_command)
 
     def create_job_script():
-        create_bash_script(location=f'/scratch/{username}', workflow_id=workflow_id, anat_only=run_anat_only, flags=flags)
+        global connection, found_fs, work_dir, anat_session
+        # Size cores, memory and walltime from the staged input, calibrated against past runs
+        history = fetch_usage_history(client=connection.client, username=username)
+        resources = estimate_job_resources(input_dir=input_dir, anat_only=run_anat_only, has_freesurfer=found_fs, history=history)
+        create_bash_script(location=f'/scratch/{username}', workflow_id=workflow_id, anat_only=run_anat_only, flags=flags, resources=resources, work_dir=work_dir, node_local=node_local, anat_derivatives=bool(anat_session),
+                           resource_monitor=resource_monitor)
 
     def send_script():
-        sync_data_with_key(action='send',username=username, hostname=hostname, source=f'./{workflow_id}.slurm', destination=f'/home/{username}')
+        global connection
+        sync_data_with_key(action='send',username=username, hostname=hostname, source=f'./{workflow_id}.slurm', destination=f'/home/{username}', ssh_command=connection.ssh_command)
+
+    def check_shared_cache():
+        global connection
+        # Fetch missing templates once here rather than in every job on the compute nodes
+        prepare_shared_cache(client=connection.client, flags=flags)
 
     def run_job():
-        global client, job_id
-        job_id = submit_job(client=client, script_location=f'/home/{username}/{workflow_id}.slurm')
+        global connection, job_id, log_follower
+        # A run interrupted right after sbatch finds its job still queued instead of submitting a duplicate
+        job_id = find_submitted_job(client=connection.client, username=username, script_location=f'/home/{username}/{workflow_id}.slurm')
+        if job_id:
+            print(f"Job {job_id} was already submitted from this script")
+        else:
+            job_id = submit_job(client=connection.client, script_location=f'/home/{username}/{workflow_id}.slurm')
+        state.set(job_id=job_id)
+        log_follower = RemoteLogFollower([f'/home/{username}/slurm-{workflow_id}.out', f'/home/{username}/slurm-{workflow_id}.err'])
 
     def wait_job_finish():
-        global client, job_id
-        while(check_job_status(client=client, job_id=job_id, method='squeue') and job_id is not None):
-            time.sleep(120)
+        global connection, job_id, log_follower
+        if job_id is None:
+            return
+        # Print the job logs as they grow while waiting, reading only the new bytes on each poll
+        wait_for_jobs(
+            client=connection.client,
+            job_ids=[job_id],
+            marker_paths=[f'/scratch/{username}/{workflow_id}/.finished'],
+            on_poll=lambda states: log_follower.poll(connection.client)
+        )
+        log_follower.poll(connection.client)
+        log_follower.flush()
 
     def get_output_data():
-        global client,completed,job_id  
-        sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/slurm-{workflow_id}.out', destination=f'/temp_files',output=False)
-        sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/slurm-{workflow_id}.err', destination=f'/temp_files',output=False)
-        completed = check_job_status(client=client, job_id=job_id)
+        global anat_session, connection, completed, found_fs, job_id, log_follower
+        sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/slurm-{workflow_id}.out', destination=log_dir,output=False, ssh_command=connection.ssh_command)
+        sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/slurm-{workflow_id}.err', destination=log_dir,output=False, ssh_command=connection.ssh_command)
+        completed = check_job_status(client=connection.client, job_id=job_id)
+        state.set(completed=completed)
+        record_job_timing(get_job_timing(client=connection.client, job_id=job_id))
+        if resource_monitor:
+            # Where the cluster hours went: sacct usage of the job and the slowest nipype nodes
+            write_profile_report(client=connection.client, job_id=job_id, profile_path=f'/scratch/{username}/{workflow_id}/node_profile.json',
+                                 output_path=f'{log_dir}/profile-{workflow_id}.json')
         print(f"_________________________________________________________\n")
-        print_log(f'/temp_files/slurm-{workflow_id}.out')
+        # The log was already printed while following it, only print what was not streamed
+        if log_follower.offsets[f'/home/{username}/slurm-{workflow_id}.out'] == 0:
+            print_log(f'{log_dir}/slurm-{workflow_id}.out')
         
         if completed:
-            sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/scratch/{username}/{workflow_id}/fmriprep/*', destination=f'/fmriprep', output=False)
-            # Empty fmriprep directory before copying new data
-            sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/scratch/{username}/{workflow_id}/freesurfer/*', destination=f'/freesurfer', output=False)
+            manifest = read_remote_manifest(client=connection.client, manifest_path=f'/scratch/{username}/{workflow_id}/manifest.tsv')
+            if manifest is None:
+                print("No output manifest found, retrieving all outputs")
+                parallel_sync(action='get', hostname=hostname, username=username, source=f'/scratch/{username}/{workflow_id}/fmriprep', destination=fmriprep_output_dir, client=connection.client, ssh_command=connection.ssh_command)
+                # Empty fmriprep directory before copying new data
+                archive_sync(action='get', hostname=hostname, username=username, source=f'/scratch/{username}/{workflow_id}/freesurfer', destination=freesurfer_output_dir, client=connection.client, ssh_command=connection.ssh_command)
+            else:
+                reference_dir = f'{staging_dir}/freesurfer' if found_fs and not stream_freesurfer else None
+                if reference_dir and not os.path.isdir(reference_dir):
+                    # A restarted container lost the staged subject; the persistent cache restores it without a download
+                    try:
+                        find_fmriprep_freesurfer_resources_by_subject(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                      project=project_id, session=anat_session or session_label)
+                    except Exception as e:
+                        print(f"Could not stage the FreeSurfer inputs again, retrieving every FreeSurfer output: {str(e)}")
+                    if not os.path.isdir(reference_dir):
+                        reference_dir = None
+                # Pull only requested outputs that are new or changed, unchanged freesurfer inputs are copied locally
+                fmriprep_stats = retrieve_outputs(client=connection.client, manifest=manifest, remote_dir=f'/scratch/{username}/{workflow_id}', prefix='fmriprep', destination=fmriprep_output_dir,
+                                 hostname=hostname, username=username, spaces=retrieve_spaces, exclude=retrieve_exclude, ssh_command=connection.ssh_command)
+                freesurfer_stats = retrieve_outputs(client=connection.client, manifest=manifest, remote_dir=f'/scratch/{username}/{workflow_id}', prefix='freesurfer', destination=freesurfer_output_dir,
+                                 hostname=hostname, username=username, reference_dir=reference_dir,
+                                 spaces=retrieve_spaces, exclude=retrieve_exclude, ssh_command=connection.ssh_command, archive=True)
+                state.set(manifest_entries=len(manifest), retrieved={'fmriprep': fmriprep_stats, 'freesurfer': freesurfer_stats})
         else:
             print(f"_________________________________________________________\n")
-            print_log(f'/temp_files/slurm-{workflow_id}.err')
+            print_log(f'{log_dir}/slurm-{workflow_id}.err')
             print(f"_________________________________________________________\n")
     
     def clean_up():
-        global client, completed
-        delete(client=client, username=username, path=f'/scratch/{username}/{workflow_id}')
-        delete(client=client, username=username, path=f'/home/{username}/{workflow_id}.slurm')
-        delete(client=client, username=username, path=f'/home/{username}/slurm-{workflow_id}.out')
-        delete(client=client, username=username, path=f'/home/{username}/slurm-{workflow_id}.err')
-        client.close(),
+        global connection, completed
+        # One round-trip, the scratch tree is removed in the background so clean up does not wait on the filesystem
+        delete_paths(client=connection.client, paths=[
+            f'/scratch/{username}/{workflow_id}',
+            f'/home/{username}/{workflow_id}.slurm',
+            f'/home/{username}/slurm-{workflow_id}.out',
+            f'/home/{username}/slurm-{workflow_id}.err'
+        ], background=True)
+        release_scratch_space(client=connection.client, username=username, workflow_id=workflow_id)
+        connection.close()
         if not completed:
+            state.remove()
             sys.exit(1)
 
+    def abandon():
+        global connection
+        # Nothing to release or close if the run failed before connecting
+        if globals().get('connection') is None:
+            return
+        try:
+            # Other workflows can use the space while this one is not running, a rerun reserves it again
+            release_scratch_space(client=connection.client, username=username, workflow_id=workflow_id)
+        except Exception as e:
+            print(f"Could not release the /scratch reservation: {str(e)}")
+        connection.close()
+
+    # Steps talking to the same service share its breaker, so an outage pauses them instead of every one retrying
+    xnat = CircuitBreaker('xnat')
+    cluster = CircuitBreaker('cluster')
+    xnat_policy = RetryPolicy(breaker=xnat)
+    cluster_policy = RetryPolicy(breaker=cluster)
+
     steps = [
-            ("Prepare input data, its may take a few minutes", prepare_input_data),
-            ("Connect to cluster", connect_server),
-            ("Check scratch space", check_scratch_space),
-            ("Create operation directory", create_workspace),
-            ("Move /input directory into operation directory ", send_data),
-            ("Move fs license into operation directory ", send_fs),
-            ("Create job script", create_job_script),
-            ("Move submit script into cluster", send_script),
-            ("Submit job", run_job),
-            ("Waiting job finish",wait_job_finish),
-            ("Get output data from cluster", get_output_data),
-            ("Clean up operation files", clean_up)
+            ("Prepare input data, its may take a few minutes", prepare_input_data, xnat_policy),
+            ("Connect to cluster", connect_server, cluster_policy),
+            ("Check scratch space", check_scratch_space, cluster_policy),
+            ("Create operation directory", create_workspace, cluster_policy),
+            ("Move /input directory into operation directory ", send_data, RetryPolicy(base_delay=60, breaker=cluster)),
+            ("Move fs license into operation directory ", send_fs, cluster_policy),
+            ("Create job script", create_job_script, cluster_policy),
+            ("Move submit script into cluster", send_script, cluster_policy),
+            ("Check TemplateFlow and image cache", check_shared_cache, cluster_policy),
+            # A rejected script fails at once, a busy controller is retried a few times
+            ("Submit job", run_job, RetryPolicy(max_attempts=3, breaker=cluster)),
+            # The job keeps running whatever happens to the connection, so waiting for it never gives up
+            ("Waiting job finish", wait_job_finish, RetryPolicy(max_attempts=None, max_delay=300, breaker=cluster)),
+            ("Get output data from cluster", get_output_data, RetryPolicy(base_delay=60, breaker=cluster)),
+            ("Clean up operation files", clean_up, cluster_policy)
         ]
     
-    for step_name, step_func in steps:
+    resume()
+    for step_name, step_func, policy in steps:
+        # The SSH connection cannot be persisted, it is opened again on every run, and a run that failed before
+        # submitting its job released its /scratch reservation, which is taken again. The staging directory is local
+        # to the container, so inputs are staged again until they are sent; the persistent cache makes that cheap.
+        rerun = (step_func is connect_server
+                 or (step_func is check_scratch_space and not state.is_done('run_job'))
+                 or (step_func is prepare_input_data and not state.get('freesurfer_sent', False)))
+        if state.is_done(step_func.__name__) and not rerun:
+            print(f"Skipping completed step: {step_name}")
+            continue
         print(f"Executing step: {step_name}")
-        try_with_infinite_retry(step_func)    
+        try:
+            with timed_step(step_func.__name__):
+                run_with_retry(step_func, policy)
+        except Exception as e:
+            # The state file, the remote directory and a submitted job are kept, so a rerun resumes from this step
+            print(f"Step '{step_name}' failed: {str(e)}")
+            abandon()
+            sys.exit(1)
+        state.mark_done(step_func.__name__)
+    state.remove()
 
 
 def str_to_bool(value: str) -> bool:
@@ -136,6 +367,14 @@ if __name__ == "__main__":
     parser.add_argument('--anat-only', type=str_to_bool, help="Run FMRIPrep only for anatomical data. Use 'true' or 'false'.")
     parser.add_argument('--session-label', type=str, help="Session label to process, e.g., 'Subject_0017_ses_01'.")
     parser.add_argument('--project-id', type=str, help="Project label to process, e.g., 'NYU_HBN'.")
+    parser.add_argument('--reuse-work-dir', type=str_to_bool, default=False, help="Keep the fMRIPrep work directory between runs of the same session so reruns resume from cached nodes. Use 'true' or 'false'.")
+    parser.add_argument('--work-dir-max-age', type=int, default=14, help="Days after which an unused persistent work directory is removed. Default is 14.")
+    parser.add_argument('--retrieve-spaces', type=str, help="Comma separated output spaces to retrieve, e.g., 'T1w,fsnative'. Other spaces are left on the cluster. Default retrieves all spaces.")
+    parser.add_argument('--retrieve-exclude', type=str, help="Comma separated glob patterns of outputs not to retrieve, e.g., '*.html,*/figures/*'.")
+    parser.add_argument('--stream-freesurfer', type=str_to_bool, default=False, help="Stream freesurfer resources from XNAT directly to the cluster instead of staging them locally. Use 'true' or 'false'.")
+    parser.add_argument('--node-local', type=str_to_bool, default=False, help="Run FMRIPrep on the compute node's local storage ($TMPDIR) and copy only the outputs back to /scratch. Use 'true' or 'false'.")
+    parser.add_argument('--anat-fast-track', type=str_to_bool, default=False, help="Reuse the fMRIPrep anatomical derivatives of another session of the same subject instead of rerunning the anatomical workflow. Use 'true' or 'false'.")
+    parser.add_argument('--resource-monitor', type=str_to_bool, default=False, help="Run FMRIPrep with its resource monitor and write a profile of the job, with the runtime, peak memory and CPU use of each nipype node, to the log directory. Use 'true' or 'false'.")
 
     args = parser.parse_args()
 
@@ -152,5 +391,13 @@ if __name__ == "__main__":
             args.anat_only,
             args.flags,
             args.session_label,
-            args.project_id
+            args.project_id,
+            args.stream_freesurfer,
+            args.retrieve_spaces.split(',') if args.retrieve_spaces else None,
+            args.retrieve_exclude.split(',') if args.retrieve_exclude else None,
+            args.reuse_work_dir,
+            args.work_dir_max_age,
+            args.node_local,
+            args.anat_fast_track,
+            args.resource_monitor
         )
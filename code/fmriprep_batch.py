@@ -0,0 +1,269 @@
+import argparse
+import sys
+import os
+import time
+
+from utilities import SSHConnection,\
+    estimate_scratch_footprint,\
+    wait_for_scratch_space,\
+    release_scratch_space,\
+    create_work_directory,\
+    sync_data_with_key,\
+    parallel_sync,\
+    archive_sync,\
+    read_remote_manifest,\
+    retrieve_outputs,\
+    create_batch_bash_script,\
+    create_packed_bash_script,\
+    pack_sessions,\
+    RemoteShell,\
+    estimate_job_resources,\
+    fetch_usage_history,\
+    JobResources,\
+    prepare_shared_cache,\
+    submit_job,\
+    delete_paths,\
+    check_array_job_status,\
+    wait_for_jobs,\
+    RetryPolicy,\
+    CircuitBreaker,\
+    run_with_retry,\
+    print_log,\
+    find_fmriprep_freesurfer_resources_by_subject
+
+from utilities.paths import input_dir, staging_dir, fmriprep_output_dir, freesurfer_output_dir, log_dir, license_path
+
+from fmriprep import str_to_bool
+
+
+def main(batch_id, run_anat_only, flags, session_labels, project_id, input_root=input_dir, node_local=False, pack=False):
+    hostname = "jubail.abudhabi.nyu.edu"
+    port = 22
+    username = "mri"
+    xnat_url = "http://10.230.12.52"
+
+    connection = None
+    job_id = ''
+    found_fs = {}
+    task_states = {}
+    # Array task of each session, several sessions share a task when they are packed
+    session_tasks = {}
+    session_states = {}
+
+    def prepare_input_data():
+        global found_fs
+        found_fs = {}
+        for session_label in session_labels:
+            found_fs[session_label] = find_fmriprep_freesurfer_resources_by_subject(
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=project_id,
+                session=session_label,
+                target_dir=f'{staging_dir}/freesurfer/{session_label}/freesurfer'
+            )
+
+    def connect_server():
+        global connection
+        # One paramiko client and one multiplexed control connection shared by every command and transfer
+        connection = SSHConnection(hostname=hostname, port=port, username=username).connect()
+
+    def check_scratch_space():
+        global connection, found_fs
+        # Reserve the space of every session at once, the array tasks may all run together
+        footprint = sum(
+            estimate_scratch_footprint(input_dir=f'{input_root}/{session_label}', anat_only=run_anat_only,
+                                       freesurfer_dir=f'{staging_dir}/freesurfer/{session_label}/freesurfer' if found_fs[session_label] else None)
+            for session_label in session_labels
+        )
+        wait_for_scratch_space(client=connection.client, username=username, workflow_id=batch_id, footprint=footprint)
+
+    def create_workspace():
+        global connection
+        for session_label in session_labels:
+            create_work_directory(client=connection.client, username=username, operation_id=f'{batch_id}/{session_label}')
+
+    def send_data():
+        global connection, found_fs
+        for session_label in session_labels:
+            parallel_sync(action='send', hostname=hostname, username=username, source=f'{input_root}/{session_label}', destination=f'/scratch/{username}/{batch_id}/{session_label}/input', client=connection.client, ssh_command=connection.ssh_command)
+            if found_fs[session_label]:
+                archive_sync(action='send', hostname=hostname, username=username, source=f'{staging_dir}/freesurfer/{session_label}/freesurfer', destination=f'/scratch/{username}/{batch_id}/{session_label}/input/freesurfer', client=connection.client, ssh_command=connection.ssh_command)
+
+    def send_fs():
+        global connection
+        sync_data_with_key(action='send', hostname=hostname, username=username, source=license_path, destination=f'/scratch/{username}/{batch_id}/license.txt', ssh_command=connection.ssh_command)
+
+    def create_job_script():
+        global connection, found_fs, session_tasks
+        history = fetch_usage_history(client=connection.client, username=username)
+        estimates = [
+            estimate_job_resources(input_dir=f'{input_root}/{session_label}', anat_only=run_anat_only, has_freesurfer=found_fs[session_label], history=history)
+            for session_label in session_labels
+        ]
+        if pack:
+            # Small sessions share an allocation, running side by side with their own thread and memory budget
+            session_resources = dict(zip(session_labels, estimates))
+            session_groups = pack_sessions(session_resources)
+            session_tasks = {session_label: task_id for task_id, group in enumerate(session_groups, start=1) for session_label in group}
+            create_packed_bash_script(location=f'/scratch/{username}', batch_id=batch_id, session_groups=session_groups, session_resources=session_resources,
+                                      anat_only=run_anat_only, flags=flags, node_local=node_local)
+            return
+
+        # Every array task gets the same allocation, sized for the most demanding session
+        session_tasks = {session_label: task_id for task_id, session_label in enumerate(session_labels, start=1)}
+        resources = JobResources(
+            cpus=max(r.cpus for r in estimates),
+            walltime_hours=max(r.walltime_hours for r in estimates),
+            mem_gb=max(r.mem_gb for r in estimates),
+            omp_nthreads=max(r.omp_nthreads for r in estimates)
+        )
+        create_batch_bash_script(location=f'/scratch/{username}', batch_id=batch_id, session_labels=session_labels, anat_only=run_anat_only, flags=flags, resources=resources, node_local=node_local)
+
+    def send_script():
+        global connection
+        sync_data_with_key(action='send', username=username, hostname=hostname, source=f'./{batch_id}.slurm', destination=f'/home/{username}', ssh_command=connection.ssh_command)
+
+    def check_shared_cache():
+        global connection
+        # Fetch missing templates once here rather than in every job on the compute nodes
+        prepare_shared_cache(client=connection.client, flags=flags)
+
+    def run_job():
+        global connection, job_id
+        job_id = submit_job(client=connection.client, script_location=f'/home/{username}/{batch_id}.slurm')
+
+    def wait_job_finish():
+        global connection, job_id, task_states, session_states
+        # One sacct query reports every task of the array
+        wait_for_jobs(
+            client=connection.client,
+            job_ids=[job_id],
+            marker_paths=[f'/scratch/{username}/{batch_id}/{session_label}/.finished' for session_label in session_labels]
+        )
+        task_states = check_array_job_status(client=connection.client, job_id=job_id)
+        session_states = {session_label: task_states.get(session_tasks[session_label]) for session_label in session_labels}
+        if pack:
+            # A packed task fails if any of its sessions does, the exit status of each session tells them apart
+            results = RemoteShell(connection.client).run([f'cat /scratch/{username}/{batch_id}/{session_label}/exit_code' for session_label in session_labels])
+            for session_label, result in zip(session_labels, results):
+                if result.ok and result.stdout.strip():
+                    session_states[session_label] = 'COMPLETED' if result.stdout.strip() == '0' else 'FAILED'
+
+    def get_output_data():
+        global connection, session_tasks, session_states
+        for session_label in session_labels:
+            log_name = f'slurm-{batch_id}_{session_tasks[session_label]}'
+            sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/{log_name}.out', destination=log_dir, output=False, ssh_command=connection.ssh_command)
+            sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/{log_name}.err', destination=log_dir, output=False, ssh_command=connection.ssh_command)
+
+            state = session_states.get(session_label)
+            print(f"_________________________________________________________\n")
+            print(f"Session {session_label}: {state}")
+            print_log(f'{log_dir}/{log_name}.out')
+            if pack:
+                # Packed sessions log to their own directory, the task log only records their start
+                sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/scratch/{username}/{batch_id}/{session_label}/fmriprep.log', destination=f'{log_dir}/{session_label}.log', output=False, ssh_command=connection.ssh_command)
+                print_log(f'{log_dir}/{session_label}.log')
+
+            if state == 'COMPLETED':
+                session_dir = f'/scratch/{username}/{batch_id}/{session_label}'
+                manifest = read_remote_manifest(client=connection.client, manifest_path=f'{session_dir}/manifest.tsv')
+                output_dirs = {'fmriprep': fmriprep_output_dir, 'freesurfer': freesurfer_output_dir}
+                for output in ('fmriprep', 'freesurfer'):
+                    if manifest is None:
+                        sync = archive_sync if output == 'freesurfer' else parallel_sync
+                        sync(action='get', hostname=hostname, username=username, source=f'{session_dir}/{output}', destination=f'{output_dirs[output]}/{session_label}', client=connection.client, ssh_command=connection.ssh_command)
+                    else:
+                        retrieve_outputs(client=connection.client, manifest=manifest, remote_dir=session_dir, prefix=output, destination=f'{output_dirs[output]}/{session_label}',
+                                         hostname=hostname, username=username, reference_dir=f'{staging_dir}/freesurfer/{session_label}/freesurfer' if output == 'freesurfer' else None,
+                                         ssh_command=connection.ssh_command, archive=output == 'freesurfer')
+            else:
+                print(f"_________________________________________________________\n")
+                print_log(f'{log_dir}/{log_name}.err')
+                print(f"_________________________________________________________\n")
+
+    def clean_up():
+        global connection, session_tasks, session_states
+        paths = [f'/scratch/{username}/{batch_id}', f'/home/{username}/{batch_id}.slurm']
+        for task_id in sorted(set(session_tasks.values())):
+            paths.append(f'/home/{username}/slurm-{batch_id}_{task_id}.out')
+            paths.append(f'/home/{username}/slurm-{batch_id}_{task_id}.err')
+        delete_paths(client=connection.client, paths=paths, background=True)
+        release_scratch_space(client=connection.client, username=username, workflow_id=batch_id)
+        connection.close()
+        if any(state != 'COMPLETED' for state in session_states.values()):
+            sys.exit(1)
+
+    def abandon():
+        global connection
+        # Nothing to release or close if the batch failed before connecting
+        if globals().get('connection') is None:
+            return
+        try:
+            # Other workflows can use the space while this one is not running
+            release_scratch_space(client=connection.client, username=username, workflow_id=batch_id)
+        except Exception as e:
+            print(f"Could not release the /scratch reservation: {str(e)}")
+        connection.close()
+
+    # Steps talking to the same service share its breaker, so an outage pauses them instead of every one retrying
+    xnat = CircuitBreaker('xnat')
+    cluster = CircuitBreaker('cluster')
+    cluster_policy = RetryPolicy(breaker=cluster)
+
+    steps = [
+            ("Prepare input data, its may take a few minutes", prepare_input_data, RetryPolicy(breaker=xnat)),
+            ("Connect to cluster", connect_server, cluster_policy),
+            ("Check scratch space", check_scratch_space, cluster_policy),
+            ("Create operation directories", create_workspace, cluster_policy),
+            ("Move session inputs into operation directories", send_data, RetryPolicy(base_delay=60, breaker=cluster)),
+            ("Move fs license into batch directory", send_fs, cluster_policy),
+            ("Create job array script", create_job_script, cluster_policy),
+            ("Move submit script into cluster", send_script, cluster_policy),
+            ("Check TemplateFlow and image cache", check_shared_cache, cluster_policy),
+            ("Submit job array", run_job, RetryPolicy(max_attempts=3, breaker=cluster)),
+            ("Waiting job array finish", wait_job_finish, RetryPolicy(max_attempts=None, max_delay=300, breaker=cluster)),
+            ("Get output data from cluster", get_output_data, RetryPolicy(base_delay=60, breaker=cluster)),
+            ("Clean up operation files", clean_up, cluster_policy)
+        ]
+
+    for step_name, step_func, policy in steps:
+        print(f"Executing step: {step_name}")
+        try:
+            run_with_retry(step_func, policy)
+        except Exception as e:
+            print(f"Step '{step_name}' failed: {str(e)}")
+            abandon()
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run FMRIPrep on many sessions as one job array in Jubail cluster.')
+
+    parser.add_argument('--flags', type=str, help="Additional FMRIPrep flags applied to every session.")
+    parser.add_argument('--anat-only', type=str_to_bool, help="Run FMRIPrep only for anatomical data. Use 'true' or 'false'.")
+    parser.add_argument('--session-labels', type=str, nargs='+', help="Session labels to process, e.g., 'Subject_0017_ses_01 Subject_0018_ses_01'.")
+    parser.add_argument('--project-id', type=str, help="Project label to process, e.g., 'NYU_HBN'.")
+    parser.add_argument('--input-root', type=str, default=input_dir, help="Directory holding one BIDS input directory per session label. Default is FMRIPREP_INPUT_DIR or /input.")
+    parser.add_argument('--node-local', type=str_to_bool, default=False, help="Run FMRIPrep on the compute node's local storage ($TMPDIR) and copy only the outputs back to /scratch. Use 'true' or 'false'.")
+    parser.add_argument('--pack', type=str_to_bool, default=False, help="Run several small sessions side by side in one allocation instead of one array task per session. Use 'true' or 'false'.")
+
+    args = parser.parse_args()
+
+    batch_id = os.getenv('XNAT_WORKFLOW_ID', f"batch-{int(time.time())}")
+    if not args.session_labels:
+        print("Error: At least one session label is required.")
+    else:
+        # Accept both space and comma separated labels
+        session_labels = [label for value in args.session_labels for label in value.split(',') if label]
+
+        main(
+            batch_id,
+            args.anat_only,
+            args.flags,
+            session_labels,
+            args.project_id,
+            args.input_root,
+            args.node_local,
+            args.pack
+        )
@@ -0,0 +1,679 @@
+"""
+Long-running orchestrator service: one process drives many XNAT workflows at once instead of one container per
+session. Workflow requests arrive over HTTP or as JSON files dropped in a spool directory. Each workflow runs the
+same steps as fmriprep.main() as an asyncio task, sharing a small pool of SSH connections, with a concurrency
+limit per stage and a single scheduler poll for every submitted job.
+
+Usage:
+    FMRIPREP_SERVICE_TOKEN=... python -u service.py --http-port 8080 --pool-size 4
+
+    curl -X POST localhost:8080/workflows -H "Authorization: Bearer $FMRIPREP_SERVICE_TOKEN" -d '{"session_label": "Subject_0017_ses_01", "project_id": "NYU_HBN",
+        "input_dir": "/data/Subject_0017_ses_01", "fmriprep_output_dir": "/derivatives/fmriprep/Subject_0017_ses_01",
+        "freesurfer_output_dir": "/derivatives/freesurfer/Subject_0017_ses_01"}'
+    curl localhost:8080/workflows -H "Authorization: Bearer $FMRIPREP_SERVICE_TOKEN"
+"""
+import argparse
+import asyncio
+import glob
+import hmac
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from utilities import SSHConnection,\
+    estimate_scratch_footprint,\
+    reserve_scratch_space,\
+    release_scratch_space,\
+    create_work_directory,\
+    sync_data_with_key,\
+    parallel_sync,\
+    archive_sync,\
+    read_remote_manifest,\
+    retrieve_outputs,\
+    create_bash_script,\
+    estimate_job_resources,\
+    fetch_usage_history,\
+    prepare_shared_cache,\
+    submit_job,\
+    find_submitted_job,\
+    delete_paths,\
+    check_job_status,\
+    get_job_states,\
+    get_job_timing,\
+    FINISHED_STATES,\
+    find_fmriprep_freesurfer_resources_by_subject,\
+    find_fmriprep_anatomical_derivatives,\
+    get_fmriprep_freesurfer_resource_size,\
+    bids_subject_label,\
+    stream_fmriprep_freesurfer_resources_to_remote,\
+    WorkflowState,\
+    configure_metrics,\
+    metric_context,\
+    record_event,\
+    record_retry,\
+    RetryPolicy,\
+    CircuitBreaker,\
+    write_profile_report
+from utilities.retry import breaker_poll_interval
+from utilities.paths import license_path
+from utilities.state import persistent_dir
+
+hostname = "jubail.abudhabi.nyu.edu"
+port = 22
+username = "mri"
+xnat_url = "http://10.230.12.52"
+
+# Requests, state, staged FreeSurfer inputs and logs of the service. It must survive a restart of the service.
+default_service_dir = os.getenv('FMRIPREP_SERVICE_DIR', os.path.join(persistent_dir, 'service'))
+# Concurrent steps allowed per stage; waiting for jobs needs no slot
+default_stage_limits = {'staging': 4, 'submit': 2, 'retrieval': 4, 'cleanup': 4}
+# Seconds between attempts to reserve /scratch space
+admission_interval = 300
+# Bearer token every HTTP request must present. The endpoint does not start without one.
+default_http_token = os.getenv('FMRIPREP_SERVICE_TOKEN')
+
+
+class ConnectionPool:
+    """
+    A few SSH connections shared by every workflow. A step holds one connection while it runs, so a handful of
+    logins serve hundreds of workflows. Each connection keeps its own ControlMaster socket for rsync.
+    """
+
+    def __init__(self, size: int, control_root: str = '/tmp/fmriprep-service'):
+        """
+        Parameters:
+        - size (int): The number of connections.
+        - control_root (str): Directory under which each connection keeps its ControlMaster socket.
+        """
+        self.connections = []
+        for index in range(size):
+            control_dir = os.path.join(control_root, str(index))
+            os.makedirs(control_dir, exist_ok=True)
+            self.connections.append(SSHConnection(hostname=hostname, port=port, username=username, control_dir=control_dir))
+        self._idle: Optional[asyncio.Queue] = None
+
+    async def start(self) -> None:
+        self._idle = asyncio.Queue()
+        for connection in self.connections:
+            await asyncio.to_thread(connection.connect)
+            self._idle.put_nowait(connection)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Waits for an idle connection and returns it to the pool afterwards."""
+        connection = await self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put_nowait(connection)
+
+    def close(self) -> None:
+        for connection in self.connections:
+            connection.close()
+
+
+class JobMonitor:
+    """Waits for the jobs of every workflow with one sacct query per interval instead of one poller per workflow."""
+
+    def __init__(self, pool: ConnectionPool, interval: int = 60):
+        """
+        Parameters:
+        - pool (ConnectionPool): The connections the scheduler is queried through.
+        - interval (int): Seconds between scheduler polls. Default is 60.
+        """
+        self.pool = pool
+        self.interval = interval
+        self._waiting: Dict[str, asyncio.Future] = {}
+
+    def wait(self, job_id: str) -> asyncio.Future:
+        """Returns a future resolved with the final state of the job."""
+        if job_id not in self._waiting:
+            self._waiting[job_id] = asyncio.get_running_loop().create_future()
+        return self._waiting[job_id]
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._waiting:
+                continue
+            try:
+                async with self.pool.acquire() as connection:
+                    states = await asyncio.to_thread(get_job_states, connection.client, list(self._waiting))
+            except Exception as e:
+                print(f"Job monitor could not query the scheduler: {str(e)}")
+                continue
+            # Array jobs are reported per task, a job is finished once all of its tasks are
+            job_states: Dict[str, List[str]] = {}
+            for task_id, info in states.items():
+                job_states.setdefault(task_id.split('_')[0], []).append(info['state'])
+            finished = [job_id for job_id in self._waiting if job_states.get(job_id) and all(state in FINISHED_STATES for state in job_states[job_id])]
+            for job_id in finished:
+                failed = [state for state in job_states[job_id] if state != 'COMPLETED']
+                self._waiting.pop(job_id).set_result(failed[0] if failed else 'COMPLETED')
+            print(f"Job monitor: {len(self._waiting)} job(s) running or queued, {len(finished)} finished")
+
+
+class Workflow:
+    """
+    One session processed by the service: the steps of fmriprep.main() on instance state, so many workflows share
+    the process. Progress is kept in a WorkflowState, so a restarted service resumes every unfinished workflow.
+    """
+
+    # Stage of each step, bounding how many workflows run it at once
+    steps = [
+        ('staging', 'prepare_input_data'),
+        ('admission', 'check_scratch_space'),
+        ('staging', 'create_workspace'),
+        ('staging', 'send_data'),
+        ('staging', 'send_fs'),
+        ('staging', 'create_job_script'),
+        ('staging', 'send_script'),
+        ('submit', 'check_shared_cache'),
+        ('submit', 'run_job'),
+        ('monitor', 'wait_job_finish'),
+        ('retrieval', 'get_output_data'),
+        ('cleanup', 'clean_up'),
+    ]
+
+    def __init__(self, request: Dict, service_dir: str):
+        """
+        Parameters:
+        - request (Dict): The workflow request, see parse_request.
+        - service_dir (str): The service directory.
+        """
+        self.request = request
+        self.workflow_id = request['workflow_id']
+        self.session_label = request['session_label']
+        self.project_id = request['project_id']
+        self.anat_only = request.get('anat_only', False)
+        self.flags = request.get('flags') or ''
+        self.stream_freesurfer = request.get('stream_freesurfer', False)
+        self.node_local = request.get('node_local', False)
+        self.anat_fast_track = request.get('anat_fast_track', False)
+        self.resource_monitor = request.get('resource_monitor', False)
+        self.retrieve_spaces = request.get('retrieve_spaces')
+        self.retrieve_exclude = request.get('retrieve_exclude')
+        self.input_dir = request['input_dir']
+        self.fmriprep_output_dir = request['fmriprep_output_dir']
+        self.freesurfer_output_dir = request['freesurfer_output_dir']
+
+        self.workflow_dir = os.path.join(service_dir, 'workflows', self.workflow_id)
+        self.staging_dir = os.path.join(self.workflow_dir, 'app')
+        self.log_dir = os.path.join(self.workflow_dir, 'logs')
+        self.script_path = os.path.join(self.workflow_dir, f'{self.workflow_id}.slurm')
+        self.remote_dir = f'/scratch/{username}/{self.workflow_id}'
+        self.state = WorkflowState(self.workflow_id, state_dir=os.path.join(service_dir, 'state'))
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self.status = 'queued'
+        self.step = None
+        self.error = None
+        self.submitted = time.time()
+
+    def summary(self) -> Dict:
+        return {
+            'workflow_id': self.workflow_id,
+            'session_label': self.session_label,
+            'project_id': self.project_id,
+            'status': self.status,
+            'step': self.step,
+            'job_id': self.state.get('job_id'),
+            'error': self.error,
+            'submitted': self.submitted,
+        }
+
+    # Steps, run in worker threads. They mirror the steps of fmriprep.main().
+
+    def prepare_input_data(self, connection: Optional[SSHConnection]) -> None:
+        anat_session = None
+        found_fs = False
+        streamed_fs_bytes = None
+        if self.anat_fast_track and not self.anat_only:
+            anat_session = find_fmriprep_anatomical_derivatives(
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=self.project_id,
+                session=self.session_label,
+                subject=bids_subject_label(self.input_dir),
+                target_dir=f'{self.staging_dir}/anat_derivatives'
+            )
+        if anat_session:
+            # The surfaces must come from the same anatomy as the reused T1w, masks and transforms
+            if self.stream_freesurfer:
+                streamed_fs_bytes = get_fmriprep_freesurfer_resource_size(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                          project=self.project_id, session=anat_session)
+                found_fs = streamed_fs_bytes is not None
+            else:
+                found_fs = find_fmriprep_freesurfer_resources_by_subject(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                         project=self.project_id, session=anat_session, target_dir=f'{self.staging_dir}/freesurfer')
+            if not found_fs:
+                print(f"[{self.workflow_id}] Session {anat_session} has no FreeSurfer subject, not reusing its derivatives")
+                shutil.rmtree(f'{self.staging_dir}/anat_derivatives', ignore_errors=True)
+                anat_session = None
+        self.state.set(anat_session=anat_session)
+        if self.stream_freesurfer:
+            if not anat_session:
+                streamed_fs_bytes = get_fmriprep_freesurfer_resource_size(xnat_url=xnat_url, username=os.getenv('XNAT_USER'), password=os.getenv('XNAT_PASS'),
+                                                                          project=self.project_id, session=self.session_label)
+            # Nothing is staged locally, so /scratch is reserved for the streamed subject from the size XNAT reports
+            self.state.set(streamed_freesurfer_bytes=streamed_fs_bytes or 0)
+            return
+        if not anat_session:
+            found_fs = find_fmriprep_freesurfer_resources_by_subject(
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=self.project_id,
+                session=self.session_label,
+                target_dir=f'{self.staging_dir}/freesurfer'
+            )
+        self.state.set(found_fs=found_fs)
+
+    def reserve_scratch_space(self, connection: SSHConnection) -> bool:
+        footprint = estimate_scratch_footprint(input_dir=self.input_dir, anat_only=self.anat_only,
+                                               freesurfer_dir=f'{self.staging_dir}/freesurfer' if self.state.get('found_fs') else None,
+                                               derivatives_dir=f'{self.staging_dir}/anat_derivatives' if self.state.get('anat_session') else None,
+                                               streamed_freesurfer_bytes=self.state.get('streamed_freesurfer_bytes', 0))
+        if not reserve_scratch_space(connection.client, username, self.workflow_id, footprint):
+            return False
+        self.state.set(scratch_reservation=footprint)
+        return True
+
+    def create_workspace(self, connection: SSHConnection) -> None:
+        create_work_directory(client=connection.client, username=username, operation_id=self.workflow_id)
+        self.state.set(remote_dir=self.remote_dir)
+
+    def send_data(self, connection: SSHConnection) -> None:
+        # Each transfer is recorded once done, so a retry of this step only repeats the one that failed
+        if not self.state.get('input_sent', False):
+            parallel_sync(action='send', hostname=hostname, username=username, source=self.input_dir, destination=f'{self.remote_dir}/input',
+                          client=connection.client, ssh_command=connection.ssh_command)
+            self.state.set(input_sent=True)
+        if self.state.get('anat_session') and not self.state.get('anat_derivatives_sent', False):
+            archive_sync(action='send', hostname=hostname, username=username, source=f'{self.staging_dir}/anat_derivatives', destination=f'{self.remote_dir}/anat_derivatives',
+                         client=connection.client, ssh_command=connection.ssh_command)
+            self.state.set(anat_derivatives_sent=True)
+        if self.state.get('freesurfer_sent', False):
+            return
+        found_fs = self.state.get('found_fs', False)
+        if self.stream_freesurfer:
+            # With reused derivatives, the FreeSurfer subject of the session they were computed from
+            found_fs = stream_fmriprep_freesurfer_resources_to_remote(
+                client=connection.client,
+                remote_dir=f'{self.remote_dir}/input',
+                xnat_url=xnat_url,
+                username=os.getenv('XNAT_USER'),
+                password=os.getenv('XNAT_PASS'),
+                project=self.project_id,
+                session=self.state.get('anat_session') or self.session_label
+            )
+        elif found_fs:
+            archive_sync(action='send', hostname=hostname, username=username, source=f'{self.staging_dir}/freesurfer', destination=f'{self.remote_dir}/input/freesurfer',
+                          client=connection.client, ssh_command=connection.ssh_command)
+        self.state.set(found_fs=found_fs, freesurfer_sent=True)
+
+    def send_fs(self, connection: SSHConnection) -> None:
+        sync_data_with_key(action='send', hostname=hostname, username=username, source=license_path, destination=f'{self.remote_dir}/license.txt', ssh_command=connection.ssh_command)
+
+    def create_job_script(self, connection: SSHConnection) -> None:
+        history = fetch_usage_history(client=connection.client, username=username)
+        resources = estimate_job_resources(input_dir=self.input_dir, anat_only=self.anat_only, has_freesurfer=self.state.get('found_fs', False), history=history)
+        # create_bash_script writes to the working directory, which every workflow shares
+        create_bash_script(location=f'/scratch/{username}', workflow_id=self.workflow_id, anat_only=self.anat_only, flags=self.flags, resources=resources, node_local=self.node_local,
+                           anat_derivatives=bool(self.state.get('anat_session')), resource_monitor=self.resource_monitor)
+        shutil.move(f'{self.workflow_id}.slurm', self.script_path)
+
+    def send_script(self, connection: SSHConnection) -> None:
+        sync_data_with_key(action='send', username=username, hostname=hostname, source=self.script_path, destination=f'/home/{username}', ssh_command=connection.ssh_command)
+
+    def check_shared_cache(self, connection: SSHConnection) -> None:
+        prepare_shared_cache(client=connection.client, flags=self.flags)
+
+    def run_job(self, connection: SSHConnection) -> None:
+        script_location = f'/home/{username}/{self.workflow_id}.slurm'
+        job_id = find_submitted_job(client=connection.client, username=username, script_location=script_location)
+        if not job_id:
+            job_id = submit_job(client=connection.client, script_location=script_location)
+        self.state.set(job_id=job_id)
+
+    def get_output_data(self, connection: SSHConnection) -> None:
+        job_id = self.state.get('job_id')
+        for extension in ('out', 'err'):
+            sync_data_with_key(action='get', hostname=hostname, username=username, source=f'/home/{username}/slurm-{self.workflow_id}.{extension}',
+                               destination=self.log_dir, output=False, ssh_command=connection.ssh_command)
+        completed = check_job_status(client=connection.client, job_id=job_id)
+        self.state.set(completed=completed)
+        record_event('job', workflow=self.workflow_id, **get_job_timing(client=connection.client, job_id=job_id))
+        if self.resource_monitor:
+            write_profile_report(client=connection.client, job_id=job_id, profile_path=f'{self.remote_dir}/node_profile.json',
+                                 output_path=os.path.join(self.log_dir, f'profile-{self.workflow_id}.json'))
+        if not completed:
+            return
+
+        manifest = read_remote_manifest(client=connection.client, manifest_path=f'{self.remote_dir}/manifest.tsv')
+        if manifest is None:
+            parallel_sync(action='get', hostname=hostname, username=username, source=f'{self.remote_dir}/fmriprep', destination=self.fmriprep_output_dir,
+                          client=connection.client, ssh_command=connection.ssh_command)
+            archive_sync(action='get', hostname=hostname, username=username, source=f'{self.remote_dir}/freesurfer', destination=self.freesurfer_output_dir,
+                          client=connection.client, ssh_command=connection.ssh_command)
+            return
+        found_fs = self.state.get('found_fs', False)
+        retrieve_outputs(client=connection.client, manifest=manifest, remote_dir=self.remote_dir, prefix='fmriprep', destination=self.fmriprep_output_dir,
+                         hostname=hostname, username=username, spaces=self.retrieve_spaces, exclude=self.retrieve_exclude, ssh_command=connection.ssh_command)
+        retrieve_outputs(client=connection.client, manifest=manifest, remote_dir=self.remote_dir, prefix='freesurfer', destination=self.freesurfer_output_dir,
+                         hostname=hostname, username=username, reference_dir=f'{self.staging_dir}/freesurfer' if found_fs and not self.stream_freesurfer else None,
+                         spaces=self.retrieve_spaces, exclude=self.retrieve_exclude, ssh_command=connection.ssh_command, archive=True)
+
+    def clean_up(self, connection: SSHConnection) -> None:
+        delete_paths(client=connection.client, paths=[
+            self.remote_dir,
+            f'/home/{username}/{self.workflow_id}.slurm',
+            f'/home/{username}/slurm-{self.workflow_id}.out',
+            f'/home/{username}/slurm-{self.workflow_id}.err'
+        ], background=True)
+        release_scratch_space(client=connection.client, username=username, workflow_id=self.workflow_id)
+        # The staged FreeSurfer subject is only needed until the outputs are retrieved
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+class OrchestratorService:
+    """Accepts workflow requests and drives them through their steps with per-stage concurrency limits."""
+
+    def __init__(self, service_dir: str = default_service_dir, pool_size: int = 4, stage_limits: Optional[Dict[str, int]] = None, poll_interval: int = 60):
+        """
+        Parameters:
+        - service_dir (str): Directory for requests, state, staged inputs and logs. Default is FMRIPREP_SERVICE_DIR.
+        - pool_size (int): The number of shared SSH connections. Default is 4.
+        - stage_limits (Optional[Dict[str, int]]): Concurrent steps per stage. Default is default_stage_limits.
+        - poll_interval (int): Seconds between scheduler polls of the job monitor. Default is 60.
+        """
+        self.service_dir = service_dir
+        self.stage_limits = {**default_stage_limits, **(stage_limits or {})}
+        self.pool = ConnectionPool(pool_size)
+        self.monitor = JobMonitor(self.pool, interval=poll_interval)
+        self.workflows: Dict[str, Workflow] = {}
+        self.http_token: Optional[str] = None
+        self._stages: Dict[str, asyncio.Semaphore] = {}
+        # Shared by every workflow, so an outage pauses all of them instead of each one retrying on its own
+        self.breakers = {'cluster': CircuitBreaker('cluster'), 'xnat': CircuitBreaker('xnat')}
+        self.policies = {
+            'xnat': RetryPolicy(breaker=self.breakers['xnat']),
+            'staging': RetryPolicy(breaker=self.breakers['cluster']),
+            # A rejected script fails at once, a busy controller is retried a few times
+            'submit': RetryPolicy(max_attempts=3, breaker=self.breakers['cluster']),
+            'retrieval': RetryPolicy(base_delay=60, breaker=self.breakers['cluster']),
+            'cleanup': RetryPolicy(breaker=self.breakers['cluster']),
+        }
+        for name in ('requests', 'incoming', 'finished'):
+            os.makedirs(os.path.join(service_dir, name), exist_ok=True)
+
+    def submit(self, request: Dict) -> Workflow:
+        """
+        Records a request on disk and starts its workflow. A request for a workflow that is already running is ignored.
+
+        Parameters:
+        - request (Dict): The workflow request, see parse_request.
+
+        Returns:
+        - Workflow: The workflow of the request.
+        """
+        request = parse_request(request)
+        workflow_id = request['workflow_id']
+        if workflow_id in self.workflows:
+            return self.workflows[workflow_id]
+
+        request_path = os.path.join(self.service_dir, 'requests', f'{workflow_id}.json')
+        with open(f'{request_path}.tmp', 'w') as f:
+            json.dump(request, f, indent=2)
+        os.replace(f'{request_path}.tmp', request_path)
+
+        workflow = Workflow(request, self.service_dir)
+        self.workflows[workflow_id] = workflow
+        asyncio.get_running_loop().create_task(self._drive(workflow))
+        print(f"[{workflow_id}] Accepted session {workflow.session_label} of project {workflow.project_id}")
+        return workflow
+
+    async def _run_step(self, workflow: Workflow, stage: str, step: str) -> None:
+        """
+        Runs one step in a worker thread, holding a stage slot and a pooled connection, and retries it under the
+        policy of its stage. Like run_with_retry, but sleeping without holding a thread, a slot or a connection.
+        """
+        # Talks to XNAT only
+        policy = self.policies['xnat'] if step == 'prepare_input_data' else self.policies[stage]
+        attempt = 0
+        while True:
+            wait = policy.breaker.wait_time() if policy.breaker is not None else 0
+            while wait > 0:
+                await asyncio.sleep(min(wait, breaker_poll_interval))
+                wait = policy.breaker.wait_time()
+            try:
+                async with self._stages[stage]:
+                    if step == 'prepare_input_data':
+                        result = await asyncio.to_thread(workflow.prepare_input_data, None)
+                    else:
+                        async with self.pool.acquire() as connection:
+                            result = await asyncio.to_thread(getattr(workflow, step), connection)
+            except Exception as e:
+                if policy.is_fatal(e):
+                    print(f"[{workflow.workflow_id}] {step} failed with an error that retrying cannot fix: {str(e)}")
+                    raise
+                if policy.is_outage(e):
+                    policy.breaker.record_failure()
+                    if policy.breaker.wait_time() > 0:
+                        record_retry(step, e)
+                        continue
+                attempt += 1
+                if policy.max_attempts is not None and attempt >= policy.max_attempts:
+                    print(f"[{workflow.workflow_id}] {step} failed {attempt} times, giving up: {str(e)}")
+                    raise
+                record_retry(step, e)
+                delay = policy.delay(attempt)
+                print(f"[{workflow.workflow_id}] {step} failed (attempt {attempt}), retrying in {delay:.0f}s: {str(e)}")
+                await asyncio.sleep(delay)
+            else:
+                if policy.breaker is not None:
+                    policy.breaker.record_success()
+                return result
+
+    async def _wait_for_space(self, workflow: Workflow) -> None:
+        """Queues the workflow until its /scratch footprint is reserved, without holding a connection while it waits."""
+        while True:
+            async with self.pool.acquire() as connection:
+                if await asyncio.to_thread(workflow.reserve_scratch_space, connection):
+                    return
+            await asyncio.sleep(admission_interval)
+
+    async def _drive(self, workflow: Workflow) -> None:
+        """Runs the remaining steps of a workflow, skipping the ones a previous run of the service completed."""
+        # Every event of the workflow, including transfers and retries inside the utilities, carries its ID
+        with metric_context(workflow=workflow.workflow_id):
+            await self._drive_steps(workflow)
+
+    async def _drive_steps(self, workflow: Workflow) -> None:
+        workflow.status = 'running'
+        try:
+            for stage, step in Workflow.steps:
+                if workflow.state.is_done(step):
+                    continue
+                workflow.step = step
+                start = time.time()
+                if stage == 'admission':
+                    await self._wait_for_space(workflow)
+                elif stage == 'monitor':
+                    state = await self.monitor.wait(workflow.state.get('job_id'))
+                    print(f"[{workflow.workflow_id}] Job {workflow.state.get('job_id')} finished: {state}")
+                else:
+                    await self._run_step(workflow, stage, step)
+                record_event('step', workflow=workflow.workflow_id, step=step, seconds=round(time.time() - start, 3))
+                workflow.state.mark_done(step)
+            workflow.status = 'completed' if workflow.state.get('completed') else 'failed'
+        except Exception as e:
+            workflow.status = 'failed'
+            workflow.error = f"{type(e).__name__}: {e}"
+            try:
+                # A failed workflow is not resumed: free its /scratch directory, reservation, job files and staged inputs
+                await self._run_step(workflow, 'cleanup', 'clean_up')
+            except Exception as e:
+                # Kept on disk so the next start of the service resumes the workflow and cleans up after it
+                workflow.step = None
+                print(f"[{workflow.workflow_id}] Workflow failed and could not be cleaned up, kept for the next start of the service: {str(e)}")
+                return
+
+        workflow.step = None
+        print(f"[{workflow.workflow_id}] Workflow {workflow.status}")
+        record_event('workflow', workflow=workflow.workflow_id, status=workflow.status, seconds=round(time.time() - workflow.submitted, 3))
+        with open(os.path.join(self.service_dir, 'finished', f'{workflow.workflow_id}.json'), 'w') as f:
+            json.dump({**workflow.request, **workflow.summary()}, f, indent=2)
+        os.remove(os.path.join(self.service_dir, 'requests', f'{workflow.workflow_id}.json'))
+        workflow.state.remove()
+
+    async def watch_spool(self, interval: int = 5) -> None:
+        """Picks up request files dropped into the incoming directory."""
+        incoming = os.path.join(self.service_dir, 'incoming')
+        while True:
+            for path in sorted(glob.glob(os.path.join(incoming, '*.json'))):
+                try:
+                    with open(path) as f:
+                        self.submit(json.load(f))
+                except (ValueError, KeyError) as e:
+                    print(f"Rejected request {path}: {str(e)}")
+                os.remove(path)
+            await asyncio.sleep(interval)
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves POST /workflows to submit a request, GET /workflows and GET /workflows/<id> to follow them. Every
+        request must carry the service token as 'Authorization: Bearer <token>'.
+        """
+        status, body = 404, {'error': 'not found'}
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                # Checked before the body is read, so an unauthenticated client cannot make the service read anything
+                authorized = hmac.compare_digest(headers.get('authorization', '').encode('latin-1'), f"Bearer {self.http_token}".encode('latin-1'))
+                data = await reader.readexactly(int(headers.get('content-length', 0))) if authorized else b''
+
+                parts = [part for part in path.split('?')[0].split('/') if part]
+                if not authorized:
+                    status, body = 401, {'error': 'missing or invalid token'}
+                elif parts[:1] == ['workflows'] and method == 'POST' and len(parts) == 1:
+                    request = json.loads(data or b'{}')
+                    if not isinstance(request, dict):
+                        raise ValueError("The request must be a JSON object")
+                    status, body = 202, self.submit(request).summary()
+                elif parts[:1] == ['workflows'] and method == 'GET' and len(parts) == 1:
+                    status, body = 200, [workflow.summary() for workflow in self.workflows.values()]
+                elif parts[:1] == ['workflows'] and method == 'GET' and len(parts) == 2 and parts[1] in self.workflows:
+                    status, body = 200, self.workflows[parts[1]].summary()
+            except asyncio.IncompleteReadError:
+                status, body = 400, {'error': 'incomplete request'}
+            except (ValueError, KeyError) as e:
+                status, body = 400, {'error': str(e)}
+
+            payload = json.dumps(body).encode('utf-8')
+            reasons = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found'}
+            extra = 'WWW-Authenticate: Bearer\r\n' if status == 401 else ''
+            writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\n{extra}"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+            await writer.drain()
+        finally:
+            # Closed whatever happened, a client that disconnected mid-request must not leak the connection
+            writer.close()
+
+    async def run(self, http_host: str = '127.0.0.1', http_port: Optional[int] = None, http_token: Optional[str] = default_http_token) -> None:
+        """
+        Runs the service until it is stopped, resuming the workflows of requests a previous run did not finish.
+
+        Parameters:
+        - http_host (str): The address the HTTP endpoint listens on. Default is the loopback interface only.
+        - http_port (Optional[int]): The port of the HTTP endpoint. None only reads the spool directory.
+        - http_token (Optional[str]): The bearer token HTTP requests must present. Default is FMRIPREP_SERVICE_TOKEN.
+
+        Raises:
+        - ValueError: If the HTTP endpoint is enabled without a token.
+        """
+        if http_port is not None and not http_token:
+            raise ValueError("The HTTP endpoint needs a token: set FMRIPREP_SERVICE_TOKEN or pass --http-token")
+        self.http_token = http_token
+        # Every step runs in a worker thread; size the pool for all stages plus the connections waiting on space
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=sum(self.stage_limits.values()) + len(self.pool.connections) + 4))
+        self._stages = {stage: asyncio.Semaphore(limit) for stage, limit in self.stage_limits.items()}
+        await self.pool.start()
+
+        for path in sorted(glob.glob(os.path.join(self.service_dir, 'requests', '*.json'))):
+            with open(path) as f:
+                self.submit(json.load(f))
+
+        tasks = [self.monitor.run(), self.watch_spool()]
+        if http_port is not None:
+            server = await asyncio.start_server(self.handle_http, http_host, http_port)
+            print(f"Listening for workflow requests on http://{http_host}:{http_port}/workflows")
+            tasks.append(server.serve_forever())
+        print(f"Watching {os.path.join(self.service_dir, 'incoming')} for workflow requests")
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.pool.close()
+
+
+def parse_request(request: Dict) -> Dict:
+    """
+    Validates a workflow request and fills in its defaults.
+
+    Parameters:
+    - request (Dict): The request. 'session_label', 'project_id', 'input_dir', 'fmriprep_output_dir' and
+      'freesurfer_output_dir' are required; 'workflow_id', 'anat_only', 'flags', 'stream_freesurfer', 'node_local',
+      'retrieve_spaces', 'retrieve_exclude', 'anat_fast_track' and 'resource_monitor' are optional and match the options of fmriprep.py.
+
+    Returns:
+    - Dict: The request with a workflow ID.
+
+    Raises:
+    - ValueError: If the request is not a JSON object.
+    - KeyError: If a required field is missing.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    for field in ('session_label', 'project_id', 'input_dir', 'fmriprep_output_dir', 'freesurfer_output_dir'):
+        if not request.get(field):
+            raise KeyError(f"'{field}' is required")
+    return {'workflow_id': request.get('workflow_id') or f"service-{uuid.uuid4().hex[:12]}", **{k: v for k, v in request.items() if k != 'workflow_id'}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run FMRIPrep workflows for many XNAT sessions from one long-running service.')
+
+    parser.add_argument('--http-port', type=int, help="Port of the HTTP endpoint accepting workflow requests. Default only reads the spool directory.")
+    parser.add_argument('--http-host', type=str, default='127.0.0.1', help="Address of the HTTP endpoint. Default is the loopback interface only.")
+    parser.add_argument('--http-token', type=str, default=default_http_token, help="Bearer token required on every HTTP request. Default is FMRIPREP_SERVICE_TOKEN.")
+    parser.add_argument('--service-dir', type=str, default=default_service_dir, help="Directory for requests, state and logs. Requests can be dropped as JSON files into its incoming directory.")
+    parser.add_argument('--pool-size', type=int, default=4, help="Number of SSH connections shared by all workflows. Default is 4.")
+    parser.add_argument('--poll-interval', type=int, default=60, help="Seconds between scheduler polls for all running jobs. Default is 60.")
+    for stage, limit in default_stage_limits.items():
+        parser.add_argument(f'--max-{stage}', type=int, default=limit, help=f"Workflows running the {stage} stage at once. Default is {limit}.")
+
+    args = parser.parse_args()
+    if args.http_port is not None and not args.http_token:
+        parser.error("--http-port needs a token: set FMRIPREP_SERVICE_TOKEN or pass --http-token")
+
+    configure_metrics(path=os.path.join(args.service_dir, 'metrics.jsonl'), textfile=None, service='fmriprep')
+    service = OrchestratorService(
+        service_dir=args.service_dir,
+        pool_size=args.pool_size,
+        stage_limits={stage: getattr(args, f'max_{stage}') for stage in default_stage_limits},
+        poll_interval=args.poll_interval
+    )
+    asyncio.run(service.run(http_host=args.http_host, http_port=args.http_port, http_token=args.http_token))
@@ -1,4 +1,18 @@
-from .cluster import check_storage, create_work_directory, delete, sync_data, sync_data_with_key, print_log
-from .job import submit_job, check_job_status, try_with_infinite_retry, create_bash_script
-from .ssh import connect, connect_with_key
-from .freesurfer import find_fmriprep_freesurfer_resources_by_subject
+from .cluster import check_storage, create_work_directory, prune_work_directories, bids_subject_label, delete, delete_paths, sync_data, sync_data_with_key, print_log
+from .job import FINISHED_STATES, submit_job, find_submitted_job, check_job_status, check_array_job_status, get_job_states, job_succeeded, get_job_timing, wait_for_jobs, try_with_infinite_retry, create_bash_script, create_batch_bash_script, create_packed_bash_script, persistent_work_directory, FMRIPREP_VERSION
+from .ssh import connect, connect_with_key, SSHConnection
+from .freesurfer import find_fmriprep_freesurfer_resources_by_subject, find_fmriprep_anatomical_derivatives, get_fmriprep_freesurfer_resource_size, stream_fmriprep_freesurfer_resources_to_remote
+from .download import download_resource_files
+from .session_index import find_experiment, lookup_experiment_id
+from .cache import cache_stats
+from .transfer import parallel_sync, archive_sync, archive_transfer
+from .manifest import read_remote_manifest, retrieve_outputs
+from .log import RemoteLogFollower
+from .sizing import JobResources, estimate_job_resources, estimate_scratch_footprint, fetch_usage_history, pack_sessions, packed_resources
+from .state import WorkflowState
+from .admission import reserve_scratch_space, wait_for_scratch_space, release_scratch_space
+from .remote import RemoteShell, RemoteResult, delete_command, deferred_stderr_command
+from .preflight import prepare_shared_cache, prepare_templates, required_templates, verify_image
+from .metrics import configure_metrics, metric_context, record_event, record_job_timing, record_retry, timed_step, write_prometheus_textfile
+from .retry import FatalError, RetryPolicy, CircuitBreaker, run_with_retry
+from .profile import get_job_usage, read_node_profile, write_profile_report
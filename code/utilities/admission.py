@@ -0,0 +1,185 @@
+import os
+import re
+import shlex
+import time
+from typing import Dict, List, Optional
+
+from paramiko.client import SSHClient
+
+from .retry import FatalError
+
+# Seconds a myquota reading is shared by the workflows before it is refreshed
+default_quota_ttl = int(os.getenv('SCRATCH_QUOTA_TTL', 300))
+# Fraction of the quota kept free as a safety margin
+default_quota_margin = float(os.getenv('SCRATCH_QUOTA_MARGIN', 0.05))
+# Reservations of workflows that crashed without releasing them expire after this many days
+reservation_max_age_days = 7
+
+size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
+
+def _admission_dir(username: str) -> str:
+    return f"/scratch/{username}/.admission"
+
+
+def _parse_size(value: str) -> int:
+    """Converts a myquota size such as '5.0TB' or '811.09GB' into bytes."""
+    match = re.match(r"^([\d.]+)\s*([KMGTP]?)i?B?$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Unexpected size '{value}'")
+    return int(float(match.group(1)) * size_units[match.group(2).upper()])
+
+
+def parse_quota(lines: List[str]) -> Optional[Dict]:
+    """
+    Reads the /scratch allocation and usage from the output of myquota.
+
+    Parameters:
+    - lines (List[str]): The lines printed by myquota.
+
+    Returns:
+    - Optional[Dict]: The 'quota_bytes' and 'used_bytes' (None when only a percentage is printed) and the
+      'used_percent', or None if there is no /scratch line.
+    """
+    for line in lines:
+        if not line.strip().startswith('/scratch'):
+            continue
+        percent = re.search(r"\(\s*([\d.]+)%\)", line)
+        sizes = re.findall(r"([\d.]+\s*[KMGTP]i?B)", line, re.IGNORECASE)
+        quota = {'quota_bytes': None, 'used_bytes': None, 'used_percent': float(percent.group(1)) if percent else None}
+        if len(sizes) >= 2:
+            # Allocation comes before current usage
+            quota['quota_bytes'] = _parse_size(sizes[0])
+            quota['used_bytes'] = _parse_size(sizes[1])
+        if quota['used_percent'] is None and quota['used_bytes'] is None:
+            continue
+        return quota
+    return None
+
+
+def reserve_scratch_space(client: SSHClient, username: str, workflow_id: str, footprint: int,
+                          margin: float = default_quota_margin, quota_ttl: int = default_quota_ttl) -> bool:
+    """
+    Reserves /scratch space for a workflow if the quota has room for it next to the space reserved by other workflows.
+    The quota reading and the reservations live on the cluster, so every orchestrator sees the same state,
+    and the decision is made while holding a lock on the cluster so two workflows cannot take the same space.
+    Only the part of a reservation its workflow has not written yet is counted, the rest is already in the quota usage.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - username (str): The cluster user whose quota is shared.
+    - workflow_id (str): The workflow the space is reserved for.
+    - footprint (int): The number of bytes to reserve.
+    - margin (float): The fraction of the quota kept free. Default is SCRATCH_QUOTA_MARGIN or 0.05.
+    - quota_ttl (int): Seconds a cached myquota reading stays valid. Default is SCRATCH_QUOTA_TTL or 300.
+
+    Returns:
+    - bool: True if the space is reserved, False if the workflow has to wait.
+
+    Raises:
+    - FatalError: If the footprint is larger than the whole quota allows.
+    - Exception: If the quota cannot be read.
+    """
+    directory = shlex.quote(_admission_dir(username))
+    reservation = shlex.quote(f"{_admission_dir(username)}/reservations/{workflow_id}")
+    scratch_dir = shlex.quote(f"/scratch/{username}")
+    # The remote shell holds the lock until it reads our decision from stdin. The space each reserving workflow
+    # already uses is measured with the quota reading, so both are taken at the same time.
+    command = (
+        f"mkdir -p {directory}/reservations && exec 9>{directory}/lock && flock 9 || exit 1; "
+        f"find {directory}/reservations -type f -mtime +{reservation_max_age_days} -delete; "
+        f"if [ $(( $(date +%s) - $(stat -c %Y {directory}/quota 2>/dev/null || echo 0) )) -ge {int(quota_ttl)} ]; then "
+        f"myquota > {directory}/quota.tmp && {{ "
+        f"for f in {directory}/reservations/*; do [ -f \"$f\" ] && printf '%s\\t%s\\n' \"${{f##*/}}\" "
+        f"\"$(du -sb {scratch_dir}/\"${{f##*/}}\" 2>/dev/null | cut -f1)\"; done > {directory}/usage; "
+        f"mv {directory}/quota.tmp {directory}/quota; }}; fi; "
+        f"cat {directory}/quota; echo __RESERVATIONS__; "
+        f"for f in {directory}/reservations/*; do [ -f \"$f\" ] && printf '%s\\t%s\\t%s\\n' \"${{f##*/}}\" \"$(cat \"$f\")\" "
+        f"\"$(awk -F '\\t' -v name=\"${{f##*/}}\" '$1 == name {{print $2}}' {directory}/usage 2>/dev/null)\"; done; "
+        f"echo __END__; read -r reply; "
+        f"if [ \"$reply\" = reserve ]; then echo {int(footprint)} > {reservation}.tmp && mv {reservation}.tmp {reservation}; fi"
+    )
+    stdin, stdout, stderr = client.exec_command(command)
+
+    quota_lines, reservations, section = [], {}, 'quota'
+    for line in iter(stdout.readline, ''):
+        line = line.rstrip('\n')
+        if line == '__END__':
+            break
+        if line == '__RESERVATIONS__':
+            section = 'reservations'
+        elif section == 'quota':
+            quota_lines.append(line)
+        elif '\t' in line:
+            name, value, used = (line.split('\t') + ['', ''])[:3]
+            if name != workflow_id and value.strip().isdigit():
+                # Space the workflow already wrote is part of the quota usage
+                reservations[name] = max(0, int(value) - (int(used) if used.strip().isdigit() else 0))
+
+    quota = parse_quota(quota_lines)
+    reserved = sum(reservations.values())
+    if quota is None:
+        decision = 'wait'
+    elif quota['quota_bytes'] is None:
+        # Only a percentage is known, fall back to admitting while the quota is not full
+        decision = 'reserve' if quota['used_percent'] < 100 else 'wait'
+    else:
+        available = quota['quota_bytes'] * (1 - margin) - quota['used_bytes'] - reserved
+        decision = 'reserve' if footprint <= available else 'wait'
+
+    try:
+        stdin.write(f"{decision}\n")
+        stdin.flush()
+        stdin.channel.shutdown_write()
+    except OSError:
+        # The remote shell already exited, e.g. because the lock could not be taken
+        pass
+    stdout.channel.recv_exit_status()
+
+    if quota is None:
+        raise Exception(f"Could not read the /scratch quota: {stderr.read().decode('utf-8').strip()}")
+
+    if quota['quota_bytes'] is not None:
+        print(f"/scratch quota {quota['quota_bytes'] / 1024 ** 4:.2f} TB, used {quota['used_bytes'] / 1024 ** 4:.2f} TB, "
+              f"reserved and not yet used by {len(reservations)} other workflow(s) {reserved / 1024 ** 4:.2f} TB, "
+              f"requested {footprint / 1024 ** 3:.1f} GB: {'reserved' if decision == 'reserve' else 'waiting'}")
+        if footprint > quota['quota_bytes'] * (1 - margin):
+            raise FatalError(f"The workflow needs {footprint / 1024 ** 3:.1f} GB, more than the whole /scratch quota allows.")
+    else:
+        print(f"/scratch is {quota['used_percent']:.0f}% used: {'proceeding' if decision == 'reserve' else 'waiting'}")
+
+    return decision == 'reserve'
+
+
+def wait_for_scratch_space(client: SSHClient, username: str, workflow_id: str, footprint: int, poll_interval: int = 300) -> None:
+    """
+    Queues the workflow until its /scratch footprint can be reserved.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - username (str): The cluster user whose quota is shared.
+    - workflow_id (str): The workflow the space is reserved for.
+    - footprint (int): The number of bytes to reserve.
+    - poll_interval (int): Seconds between admission attempts. Default is 300.
+    """
+    start = time.time()
+    while not reserve_scratch_space(client, username, workflow_id, footprint):
+        time.sleep(poll_interval)
+    if time.time() - start > 1:
+        print(f"Admitted after waiting {time.time() - start:.0f}s for /scratch space")
+
+
+def release_scratch_space(client: SSHClient, username: str, workflow_id: str) -> None:
+    """
+    Releases the reservation of a workflow and drops the cached quota reading so waiting workflows see the freed space.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - username (str): The cluster user whose quota is shared.
+    - workflow_id (str): The workflow whose reservation is released.
+    """
+    directory = shlex.quote(_admission_dir(username))
+    reservation = shlex.quote(f"{_admission_dir(username)}/reservations/{workflow_id}")
+    stdin, stdout, stderr = client.exec_command(f"rm -f {reservation} {directory}/quota")
+    stdout.channel.recv_exit_status()
+    print(f"Released /scratch reservation of {workflow_id}")
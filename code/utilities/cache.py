@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+from .state import persistent_dir
+
+# Default location and size cap of the local FreeSurfer input cache
+default_cache_dir = os.getenv('FREESURFER_CACHE_DIR', os.path.join(persistent_dir, 'cache', 'freesurfer'))
+default_cache_max_bytes = int(os.getenv('FREESURFER_CACHE_MAX_BYTES', 50 * 1024 ** 3))
+
+# Hit and miss counters of the current process, reported by the orchestrator
+cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+
+@contextmanager
+def _locked(cache_dir: str):
+    """
+    Holds an exclusive lock on the cache directory while entries are added, restored or evicted.
+
+    Parameters:
+    - cache_dir (str): The root directory of the cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def cache_key(files: List[Dict]) -> str:
+    """
+    Computes the content address of a resource from its file list and checksums.
+
+    Parameters:
+    - files (List[Dict]): The resource files as returned by list_resource_files.
+
+    Returns:
+    - str: A hexadecimal SHA-256 key that changes whenever a path, size or digest changes.
+    """
+    digest = hashlib.sha256()
+    for entry in sorted(files, key=lambda e: e['path']):
+        digest.update(f"{entry['path']}\t{entry['size']}\t{entry['digest']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _entry_info(cache_dir: str, key: str) -> Dict:
+    """
+    Reads the metadata of a complete cache entry.
+
+    Returns:
+    - Dict: The entry metadata, or an empty dict if the entry is missing or incomplete.
+    """
+    try:
+        with open(os.path.join(cache_dir, key, 'entry.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return {}
+
+
+def _link_tree(source_dir: str, target_dir: str) -> int:
+    """
+    Recreates a directory tree by hardlinking its files, copying when hardlinks are not possible.
+
+    Parameters:
+    - source_dir (str): The directory to replicate.
+    - target_dir (str): The destination directory.
+
+    Returns:
+    - int: The number of bytes made available in the destination.
+    """
+    total_bytes = 0
+    for root, _, names in os.walk(source_dir):
+        relative_root = os.path.relpath(root, source_dir)
+        os.makedirs(os.path.join(target_dir, relative_root), exist_ok=True)
+        for name in names:
+            source = os.path.join(root, name)
+            target = os.path.join(target_dir, relative_root, name)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+            total_bytes += os.path.getsize(source)
+    return total_bytes
+
+
+def restore_from_cache(key: str, target_dir: str, cache_dir: str = default_cache_dir) -> bool:
+    """
+    Populates a directory from the cache if an entry exists for the given key.
+
+    Parameters:
+    - key (str): The content address of the resource.
+    - target_dir (str): The directory to populate.
+    - cache_dir (str): The root directory of the cache.
+
+    Returns:
+    - bool: True on a cache hit, otherwise False.
+    """
+    with _locked(cache_dir):
+        if not _entry_info(cache_dir, key):
+            cache_stats['misses'] += 1
+            return False
+
+        total_bytes = _link_tree(os.path.join(cache_dir, key, 'tree'), target_dir)
+        # The modification time of the metadata file records the last use for LRU eviction
+        os.utime(os.path.join(cache_dir, key, 'entry.json'))
+
+    cache_stats['hits'] += 1
+    cache_stats['bytes'] += total_bytes
+    print(f"Restored {total_bytes / (1024 * 1024):.1f} MB from cache entry {key[:12]}")
+    return True
+
+
+def add_to_cache(key: str, source_dir: str, cache_dir: str = default_cache_dir, max_bytes: int = default_cache_max_bytes) -> None:
+    """
+    Stores a directory in the cache under the given key and evicts the least recently used entries above the size cap.
+
+    Parameters:
+    - key (str): The content address of the resource.
+    - source_dir (str): The directory to store.
+    - cache_dir (str): The root directory of the cache.
+    - max_bytes (int): The maximum total size of the cache in bytes.
+
+    Returns:
+    - None
+    """
+    staging_dir = os.path.join(cache_dir, f".{key}.{os.getpid()}")
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # Build the entry outside the lock, it only becomes visible once renamed
+    size = _link_tree(source_dir, os.path.join(staging_dir, 'tree'))
+    with open(os.path.join(staging_dir, 'entry.json'), 'w') as f:
+        json.dump({'size': size, 'created': time.time()}, f)
+
+    with _locked(cache_dir):
+        if _entry_info(cache_dir, key):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+            os.rename(staging_dir, os.path.join(cache_dir, key))
+        _evict(cache_dir, max_bytes, keep=key)
+
+
+def _evict(cache_dir: str, max_bytes: int, keep: str) -> None:
+    """
+    Removes least recently used entries until the cache fits in max_bytes. Must be called with the lock held.
+
+    Parameters:
+    - cache_dir (str): The root directory of the cache.
+    - max_bytes (int): The maximum total size of the cache in bytes.
+    - keep (str): A key that must never be evicted, typically the entry that was just used.
+    """
+    entries = []
+    for key in os.listdir(cache_dir):
+        info = _entry_info(cache_dir, key)
+        if info:
+            last_used = os.path.getmtime(os.path.join(cache_dir, key, 'entry.json'))
+            entries.append((last_used, key, info['size']))
+
+    total = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        print(f"Evicted cache entry {key[:12]} ({size / (1024 * 1024):.1f} MB)")
@@ -1,11 +1,14 @@
 from paramiko.client import SSHClient
 import os
-from typing import Optional
+from typing import List, Optional
 import re
 import subprocess
 import re
 import sys
 
+from .remote import RemoteShell, delete_command
+from .retry import FatalError
+
 
 def _get_scratch_space(client: SSHClient) -> Optional[int]:
     """
@@ -20,10 +23,12 @@ def _get_scratch_space(client: SSHClient) -> Optional[int]:
     Raises:
     - This function may raise exceptions related to SSH command execution, though they aren't explicitly caught here.
     """
-    stdin, stdout, stderr = client.exec_command("myquota")
-    output = stdout.readlines()
+    result = RemoteShell(client).run(["myquota"])[0]
+    if not result.ok:
+        print(f"myquota failed with exit status {result.exit_status}: {result.stderr.strip()}")
+        return None
 
-    for line in output:
+    for line in result.stdout.splitlines():
         if "/scratch" in line:
             space_info = line.split()
             
@@ -44,8 +49,8 @@ def _get_scratch_space(client: SSHClient) -> Optional[int]:
 
 def create_work_directory(client: SSHClient, username: str, operation_id: str) -> None:
     """
-    Creates a directory in the /scratch/ filesystem on the remote server. 
-    If the directory already exists, it's removed and recreated.
+    Creates a directory in the /scratch/ filesystem on the remote server in a single round-trip.
+    If the directory already exists, it's moved aside and removed in the background, then recreated.
 
     Parameters:
     - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
@@ -59,16 +64,52 @@ def create_work_directory(client: SSHClient, username: str, operation_id: str) -
     - This function may raise exceptions related to SSH command execution, though they aren't explicitly caught here.
     """
 
-    stdin, stdout, stderr = client.exec_command(f"test -d /scratch/{username}/{operation_id} && echo 'exists'")
-    directory_check = directory_check = stdout.read().decode('utf-8').strip()
-    if directory_check == "exists":
-        client.exec_command(f"rm -rf /scratch/{username}/{operation_id}")
+    removed, created = RemoteShell(client).run([
+        delete_command(f"/scratch/{username}/{operation_id}", background=True),
+        f"mkdir -p /scratch/{username}/{operation_id}/input"
+    ])
+    if removed.stdout.strip():
         print(f"Removed existing directory /scratch/{username}/{operation_id}")
-
-    stdin, stdout, stderr = client.exec_command(f"mkdir -p /scratch/{username}/{operation_id}/input")
+    if not created.ok:
+        raise Exception(f"Could not create /scratch/{username}/{operation_id}/input: {created.stderr.strip()}")
     print(f"Created directory /scratch/{username}/{operation_id}/input")
 
-def delete(client: SSHClient, username: str, path: str) -> None:
+def prune_work_directories(client: SSHClient, username: str, max_age_days: int) -> None:
+    """
+    Removes persistent nipype work directories that have not been used for a while.
+    Each job touches its work directory when it starts, so the modification time records the last use.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - username (str): The username corresponding to the desired directory structure.
+    - max_age_days (int): Work directories unused for more than this many days are removed.
+
+    Returns:
+    - None: The function returns nothing but has side effects on the remote server.
+    """
+    # /scratch/<user>/work/<project>/<subject>/<session>/fmriprep-<version>
+    work_root = f"/scratch/{username}/work"
+    stdin, stdout, stderr = client.exec_command(
+        f"[ -d {work_root} ] && find {work_root} -mindepth 4 -maxdepth 4 -type d -mtime +{int(max_age_days)} -print -exec rm -rf {{}} +"
+    )
+    for path in stdout.read().decode('utf-8').split():
+        print(f"Removed expired work directory {path}")
+
+
+def bids_subject_label(input_dir: str) -> Optional[str]:
+    """
+    Returns the subject of a single-subject BIDS directory.
+
+    Parameters:
+    - input_dir (str): The local BIDS directory.
+
+    Returns:
+    - Optional[str]: The subject directory name, e.g. 'sub-0017', or None if there is none.
+    """
+    subjects = sorted(name for name in os.listdir(input_dir) if name.startswith('sub-') and os.path.isdir(os.path.join(input_dir, name)))
+    return subjects[0] if subjects else None
+
+def delete(client: SSHClient, username: str, path: str, background: bool = False) -> None:
     """
     Deletes a directory or file in the /scratch/ filesystem on the remote server. 
     If the path doesn't exist, the function does nothing.
@@ -77,24 +118,49 @@ def delete(client: SSHClient, username: str, path: str) -> None:
     - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
     - username (str): The username corresponding to the desired directory structure.
     - path (str): The path corresponding to the desired directory or file.
+    - background (bool): Whether a directory is moved aside and removed in the background. Default is False.
 
     Returns:
     - None: The function returns nothing but has side effects on the remote server.
 
     Raises:
-    - This function may raise exceptions related to SSH command execution, though they aren't explicitly caught here.
+    - Exception: If the deletion fails.
     """
-    stdin, stdout, stderr = client.exec_command(f"[ -d {path} ] && echo 'directory' || echo 'file' ")
-    check = stdout.read().decode('utf-8').strip()
-    
-    if check == "directory":
-        client.exec_command(f"rm -rf {path}")
-        print(f"Removed directory {path}")
-    elif check == "file":
-        client.exec_command(f"rm {path}")
-        print(f"Removed file {path}")
-    else:
-        print(f"Path {path} does not exist or is neither a directory nor a file. Nothing to delete.")
+    delete_paths(client=client, paths=[path], background=background)
+
+
+def delete_paths(client: SSHClient, paths: List[str], background: bool = False) -> None:
+    """
+    Deletes several files or directories on the remote server in a single round-trip, waiting for each
+    deletion to finish unless directories are removed in the background.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - paths (List[str]): The remote paths to delete. Missing paths are skipped.
+    - background (bool): Whether directories are moved aside at once and removed by a detached process. Default is False.
+
+    Returns:
+    - None: The function returns nothing but has side effects on the remote server.
+
+    Raises:
+    - Exception: If any deletion fails.
+    """
+    results = RemoteShell(client).run([delete_command(path, background=background) for path in paths])
+
+    for path, result in zip(paths, results):
+        kind = result.stdout.strip()
+        if not result.ok:
+            print(f"Could not delete {path}: {result.stderr.strip()}")
+        elif kind == "directory":
+            print(f"{'Scheduled removal of' if background else 'Removed'} directory {path}")
+        elif kind == "file":
+            print(f"Removed file {path}")
+        else:
+            print(f"Path {path} does not exist. Nothing to delete.")
+
+    failed = [path for path, result in zip(paths, results) if not result.ok]
+    if failed:
+        raise Exception(f"Could not delete {', '.join(failed)}")
 
 
 
@@ -118,13 +184,13 @@ def sync_data(action: str, username: str, password: str, hostname: str, source:
     if action == "send":
         if not os.path.exists(source):
             error_message = f"The provided source '{source}' does not exist."
-            raise Exception(error_message)
+            raise FatalError(error_message)
         remote_path = f"{username}@{hostname}:{destination}"
         rsync_command = ["rsync", "-av", "-e", ssh_command, source, remote_path]
     elif action == "get":
         if not os.path.exists(destination):
             error_message = f"The provided destination '{destination}' does not exist."
-            raise Exception(error_message)
+            raise FatalError(error_message)
         rsync_command = ["rsync", "-avz", "-e", ssh_command, f"{username}@{hostname}:{source}", destination]
     else:
         error_message = "Invalid action specified. Choose either 'send' or 'get'."
@@ -144,7 +210,7 @@ def sync_data(action: str, username: str, password: str, hostname: str, source:
     except subprocess.CalledProcessError as e:
         pass
 
-def     sync_data_with_key(action: str, username: str, hostname: str, source: str, destination: str, output: bool = True) -> Optional[str]:
+def     sync_data_with_key(action: str, username: str, hostname: str, source: str, destination: str, output: bool = True, ssh_command: Optional[str] = None) -> Optional[str]:
     """
     Uses rsync with SSH key authentication to sync data between local and remote hosts.
     Can either send data to or get data from a remote server.
@@ -157,24 +223,26 @@ def     sync_data_with_key(action: str, username: str, hostname: str, source: st
     - source (str): Source path for the data (depends on the action).
     - destination (str): Destination path for the data (depends on the action).
     - output (bool): Whether to print the output of the rsync command. Default is True.
+    - ssh_command (Optional[str]): The remote shell used by rsync, e.g. SSHConnection.ssh_command to reuse a multiplexed connection. Defaults to a plain key-authenticated ssh.
 
     Returns:
     - An optional boolean flag indicating the presence of an error. If an error occurs, it returns True; otherwise, it returns False.
     """
     
-    ssh_command = f"ssh -i /amrshadid/.ssh/id_rsa -o StrictHostKeyChecking=no"
+    if ssh_command is None:
+        ssh_command = f"ssh -i /amrshadid/.ssh/id_rsa -o StrictHostKeyChecking=no"
 
     if action == "send":
         if not os.path.exists(source):
             error_message = f"The provided source '{source}' does not exist."
-            raise Exception(error_message)
+            raise FatalError(error_message)
         remote_path = f"{username}@{hostname}:{destination}"
         print(remote_path)
         rsync_command = ["rsync", "-av", "-e", ssh_command, source, remote_path]
     elif action == "get":
         if not os.path.exists(destination):
             error_message = f"The provided destination '{destination}' does not exist."
-            raise Exception(error_message)
+            raise FatalError(error_message)
         rsync_command = ["rsync", "-avz", "-e", ssh_command, f"{username}@{hostname}:{source}", destination]
     else:
         error_message = "Invalid action specified. Choose either 'send' or 'get'."
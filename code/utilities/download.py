@@ -0,0 +1,157 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from requests.adapters import HTTPAdapter
+
+from .metrics import record_transfer
+
+
+def _relative_path(file_uri: str) -> str:
+    """
+    Returns the path of a resource file relative to the resource, without the 'files/' prefix.
+
+    Parameters:
+    - file_uri (str): The URI of the file as listed by XNAT, e.g. '/data/experiments/X/resources/Y/files/a/b.txt'.
+
+    Returns:
+    - str: The nested path of the file inside the resource, e.g. 'a/b.txt'.
+    """
+    return file_uri.split('/files/', 1)[-1] if '/files/' in file_uri else file_uri.lstrip('/')
+
+
+def _md5sum(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Computes the MD5 checksum of a local file.
+
+    Parameters:
+    - path (str): The path of the file.
+    - chunk_size (int): The number of bytes read at a time. Default is 1 MiB.
+
+    Returns:
+    - str: The hexadecimal MD5 digest of the file.
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_up_to_date(path: str, size: Optional[int], digest: Optional[str], verify_checksum: bool) -> bool:
+    """
+    Checks whether a local file already matches the file listed in XNAT.
+
+    Parameters:
+    - path (str): The local path of the file.
+    - size (Optional[int]): The size in bytes reported by XNAT, if any.
+    - digest (Optional[str]): The MD5 digest reported by XNAT, if any.
+    - verify_checksum (bool): Whether to compare the MD5 digest in addition to the size.
+
+    Returns:
+    - bool: True if the local file exists and matches, otherwise False.
+    """
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if verify_checksum and digest:
+        return _md5sum(path) == digest
+    return size is not None
+
+
+def list_resource_files(connection, resource_uri: str) -> List[Dict]:
+    """
+    Lists the files of an XNAT resource with a single catalog request.
+
+    Parameters:
+    - connection: An open xnat session.
+    - resource_uri (str): The URI of the resource, e.g. '/data/experiments/X/resources/Y'.
+
+    Returns:
+    - List[Dict]: One entry per file with the keys 'uri', 'path', 'size' and 'digest'.
+    """
+    result = connection.get_json(f"{resource_uri}/files")
+    files = []
+    for entry in result['ResultSet']['Result']:
+        size = entry.get('Size')
+        files.append({
+            'uri': entry['URI'],
+            'path': _relative_path(entry['URI']),
+            'size': int(size) if size not in (None, '') else None,
+            'digest': entry.get('digest') or None,
+        })
+    return files
+
+
+def download_resource_files(connection, resource_uri: str, target_dir: str, max_workers: int = 8, verify_checksum: bool = True, files: Optional[List[Dict]] = None) -> Dict:
+    """
+    Downloads all files of an XNAT resource using a bounded pool of concurrent streams.
+    Files that already exist locally with the expected size (and checksum) are skipped,
+    and partially downloaded files never replace a complete one, so an interrupted run can be resumed.
+
+    Parameters:
+    - connection: An open xnat session. Its HTTP session is shared by all workers.
+    - resource_uri (str): The URI of the resource to download.
+    - target_dir (str): The local directory where the resource tree is recreated.
+    - max_workers (int): The maximum number of concurrent downloads. Default is 8.
+    - verify_checksum (bool): Whether to compare MD5 digests of existing files. Default is True.
+    - files (Optional[List[Dict]]): The file list from list_resource_files, if already fetched.
+
+    Returns:
+    - Dict: Transfer statistics with the keys 'files', 'downloaded', 'skipped', 'bytes' and 'seconds'.
+
+    Raises:
+    - Exception: If any of the files fails to download.
+    """
+    if files is None:
+        files = list_resource_files(connection, resource_uri)
+
+    # Allow one pooled HTTP connection per worker instead of the default pool size
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    connection.interface.mount('http://', adapter)
+    connection.interface.mount('https://', adapter)
+
+    def download(entry: Dict) -> int:
+        target_path = os.path.join(target_dir, entry['path'])
+        if _is_up_to_date(target_path, entry['size'], entry['digest'], verify_checksum):
+            return -1
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        partial_path = f"{target_path}.part"
+        with open(partial_path, 'wb') as f:
+            connection.download_stream(entry['uri'], f)
+        os.replace(partial_path, target_path)
+        return os.path.getsize(target_path)
+
+    downloaded = 0
+    skipped = 0
+    total_bytes = 0
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download, entry): entry for entry in files}
+        for future in as_completed(futures):
+            size = future.result()
+            if size < 0:
+                skipped += 1
+            else:
+                downloaded += 1
+                total_bytes += size
+                print(f"Downloaded: {futures[future]['path']}")
+
+    seconds = time.time() - start
+    throughput = total_bytes / seconds / (1024 * 1024) if seconds > 0 else 0.0
+    print(f"Downloaded {downloaded} files ({total_bytes / (1024 * 1024):.1f} MB) in {seconds:.1f}s "
+          f"at {throughput:.1f} MB/s, skipped {skipped} up-to-date files")
+    record_transfer('xnat_download', files=downloaded, bytes=total_bytes, seconds=seconds, skipped=skipped)
+
+    return {
+        'files': len(files),
+        'downloaded': downloaded,
+        'skipped': skipped,
+        'bytes': total_bytes,
+        'seconds': seconds,
+    }
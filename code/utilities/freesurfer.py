@@ -1,79 +1,260 @@
 import xnat
+import json
 import re
 import os
 import shutil
+from typing import Dict, List, Optional
+from paramiko.client import SSHClient
+
+from .cache import add_to_cache, cache_key, restore_from_cache
+from .download import download_resource_files, list_resource_files
+from .paths import staging_dir
+from .session_index import find_experiment
+from .stream import stream_resource_files_to_remote
 
 # Define the regex pattern to extract the directory path
 pattern = r'^(freesurfer/.+)/[^/]+\.[^/]+$'
-# Set the default input directory
-input_dir = '/app'
+# Written when a derivatives resource lacks one, fMRIPrep only reads derivatives from a BIDS derivatives dataset
+anat_dataset_description = {'Name': 'fMRIPrep anatomical derivatives', 'BIDSVersion': '1.4.0', 'DatasetType': 'derivative',
+                            'GeneratedBy': [{'Name': 'fMRIPrep'}]}
+
+def _find_freesurfer_resource(connection, project: str, session: str):
+    """
+    Finds the freesurfer resource of a session.
+
+    Parameters:
+    - connection: An open xnat session.
+    - project (str): The project ID.
+    - session (str): The session label.
+
+    Returns:
+    - The freesurfer resource object if found, otherwise None.
+
+    Raises:
+    - Exception: If XNAT cannot be reached. Only a missing session or resource returns None.
+    """
+    # Resolve the label through the session index instead of listing every experiment in the project
+    session_obj = find_experiment(connection, project, session)
+
+    if not session_obj:
+        print(f"Error: Session {session} not found in project")
+        return None
 
-def find_fmriprep_freesurfer_resources_by_subject(xnat_url: str, username: str = None, password: str = None, project: str = None, session: str = None):
+    print(f"\nExploring Resources for Session: {session}")
+    print("-" * 50)
+    
+    for resource in session_obj.resources.values():
+        if 'freesurfer' in resource.label.lower():
+            return resource
+
+    print(f"No freesurfer resources found for session: {session}")
+    return None
+
+def find_fmriprep_freesurfer_resources_by_subject(xnat_url: str, username: str = None, password: str = None, project: str = None, session: str = None, target_dir: str = None):
+    """
+    Downloads the freesurfer resource of a session, or restores it from the cache.
+
+    Parameters:
+    - xnat_url (str): The URL of the XNAT server.
+    - username (str): The XNAT username.
+    - password (str): The XNAT password.
+    - project (str): The project ID.
+    - session (str): The session label.
+    - target_dir (str): The local directory receiving the FreeSurfer subject. Default is <staging dir>/freesurfer.
+
+    Returns:
+    - bool: True if the resource was staged, False if the session has no freesurfer resource.
+
+    Raises:
+    - Exception: If XNAT cannot be reached or the download fails, so the caller retries instead of running recon-all.
+    """
     if not project:
         print("Error: Project ID is required")
         return False
-        
-    try:
-        with xnat.connect(xnat_url, user=username, password=password) as connection:
-            project_obj = connection.projects[project]
-
-            if not session:
-                print("Error: Session ID is required")
-                return False
-
-            try:
-                experiments = project_obj.experiments.values()
-                session_obj = None
-                
-                for experiment in experiments:
-                    if experiment.label == session:
-                        session_obj = experiment
-                        break
-                
-                if not session_obj:
-                    print(f"Error: Session {session} not found in project")
-                    return False
-
-            except Exception as e:
-                print(f"Error accessing session {session}: {str(e)}")
-                return False
-
-            print(f"\nExploring Resources for Session: {session}")
-            print("-" * 50)
-            
-            session_resources = session_obj.resources.values()
-            
-            for resource in session_resources:
-                if 'freesurfer' in resource.label.lower():
-                    target_dir = os.path.join(input_dir, 'freesurfer')
-                    os.makedirs(target_dir, exist_ok=True)
-                    
-                    # Get all files in the resource
-                    for file in resource.files.values():
-                        # Get the file path relative to the resource
-                        file_path = file.path
-                        
-                        # Remove any potential 'files/' prefix and get just the nested path
-                        clean_path = file_path.split('files/')[-1] if 'files/' in file_path else file_path
-                        
-                        # Create the target path
-                        target_path = os.path.join(target_dir, clean_path)
-                        
-                        # Create directory structure
-                        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                        
-                        # Download file using stream to handle large files
-                        print(f"Downloading: {clean_path}")
-                        with open(target_path, 'wb') as f:
-                            file.download_stream(f)
-                    
-                    print(f"Copied freesurfer resources for session: {session}")
-                    print(f"Contents of /app directory: {os.listdir(input_dir)}")
-                    return True
-
-            print(f"No freesurfer resources found for session: {session}")
+    if not session:
+        print("Error: Session ID is required")
+        return False
+
+    with xnat.connect(xnat_url, user=username, password=password) as connection:
+        resource = _find_freesurfer_resource(connection, project, session)
+        if resource is None:
             return False
 
-    except Exception as e:
-        print(f"Error accessing XNAT: {str(e)}")
+        if target_dir is None:
+            target_dir = os.path.join(staging_dir, 'freesurfer')
+        os.makedirs(target_dir, exist_ok=True)
+
+        # Reuse a cached copy of the same file list and checksums, otherwise download and cache it
+        files = list_resource_files(connection, resource.uri)
+        key = cache_key(files)
+        if not restore_from_cache(key, target_dir):
+            # Download all files of the resource concurrently, skipping files that are already up to date
+            download_resource_files(connection, resource.uri, target_dir, files=files)
+            add_to_cache(key, target_dir)
+
+        print(f"Copied freesurfer resources for session: {session}")
+        print(f"Contents of {target_dir} directory: {os.listdir(target_dir)}")
+        return True
+
+
+def get_fmriprep_freesurfer_resource_size(xnat_url: str, username: str = None, password: str = None, project: str = None, session: str = None) -> Optional[int]:
+    """
+    Reads the size of the freesurfer resource of a session from its file catalog, without downloading it.
+
+    Parameters:
+    - xnat_url (str): The URL of the XNAT server.
+    - username (str): The XNAT username.
+    - password (str): The XNAT password.
+    - project (str): The project ID.
+    - session (str): The session label.
+
+    Returns:
+    - Optional[int]: The total size in bytes of the files the catalog reports a size for, or None if the session
+      has no freesurfer resource.
+    """
+    with xnat.connect(xnat_url, user=username, password=password) as connection:
+        resource = _find_freesurfer_resource(connection, project, session)
+        if resource is None:
+            return None
+        return sum(entry['size'] or 0 for entry in list_resource_files(connection, resource.uri))
+
+
+def stream_fmriprep_freesurfer_resources_to_remote(client: SSHClient, remote_dir: str, xnat_url: str, username: str = None, password: str = None, project: str = None, session: str = None) -> bool:
+    """
+    Streams the freesurfer resource of a session from XNAT straight into a remote directory on the cluster,
+    without staging it on the container disk. The tree is unpacked as remote_dir/freesurfer.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance connected to the cluster.
+    - remote_dir (str): The remote directory that receives the freesurfer directory.
+    - xnat_url (str): The URL of the XNAT server.
+    - username (str): The XNAT username.
+    - password (str): The XNAT password.
+    - project (str): The project ID.
+    - session (str): The session label.
+
+    Returns:
+    - bool: True if a freesurfer resource was found and streamed, False if there is none.
+
+    Raises:
+    - Exception: If the transfer itself fails, so the caller can retry it.
+    """
+    if not project or not session:
+        print("Error: Project ID and Session ID are required")
         return False
+
+    with xnat.connect(xnat_url, user=username, password=password) as connection:
+        resource = _find_freesurfer_resource(connection, project, session)
+        if resource is None:
+            return False
+
+        files = list_resource_files(connection, resource.uri)
+        stream_resource_files_to_remote(connection, files, client, remote_dir, prefix='freesurfer')
+        print(f"Streamed freesurfer resources for session: {session}")
+        return True
+
+
+def _subject_sessions(connection, project: str, session: str) -> List[Dict]:
+    """
+    Lists the other sessions of the subject a session belongs to, most recent first.
+
+    Parameters:
+    - connection: An open xnat session.
+    - project (str): The project ID.
+    - session (str): The session label.
+
+    Returns:
+    - List[Dict]: The 'ID' and 'label' of each session, empty if the session or its subject is not found.
+    """
+    rows = connection.get_json(f"/data/projects/{project}/experiments",
+                               query={'label': session, 'columns': 'ID,label,subject_ID', 'format': 'json'})['ResultSet']['Result']
+    subject_id = next((row.get('subject_ID') for row in rows if row.get('label') == session), None)
+    if not subject_id:
+        return []
+
+    rows = connection.get_json(f"/data/projects/{project}/subjects/{subject_id}/experiments",
+                               query={'columns': 'ID,label,date', 'format': 'json'})['ResultSet']['Result']
+    return sorted((row for row in rows if row.get('label') != session), key=lambda row: row.get('date') or '', reverse=True)
+
+
+def _anatomical_files(files: List[Dict], subject: str) -> List[Dict]:
+    """
+    Selects the subject-level anatomical derivatives of an fMRIPrep resource, rooted at the derivatives dataset.
+
+    Parameters:
+    - files (List[Dict]): The resource files as returned by list_resource_files.
+    - subject (str): The BIDS subject directory name, e.g. 'sub-0017'.
+
+    Returns:
+    - List[Dict]: The files of sub-<label>/anat and the dataset description, with paths relative to the dataset.
+      Empty if the resource has no preprocessed T1w image of the subject.
+    """
+    anat_pattern = re.compile(rf"^(?:.*/)?({re.escape(subject)}/anat/[^/]+)$")
+    selected = []
+    for entry in files:
+        match = anat_pattern.match(entry['path'])
+        if match:
+            selected.append(dict(entry, path=match.group(1)))
+        elif entry['path'].split('/')[-1] == 'dataset_description.json' and 'sub-' not in entry['path']:
+            selected.append(dict(entry, path='dataset_description.json'))
+
+    if not any(entry['path'].endswith('desc-preproc_T1w.nii.gz') for entry in selected):
+        return []
+    return selected
+
+
+def find_fmriprep_anatomical_derivatives(xnat_url: str, username: str = None, password: str = None, project: str = None, session: str = None,
+                                         subject: str = None, target_dir: str = None) -> Optional[str]:
+    """
+    Looks for fMRIPrep anatomical derivatives of the same subject on its other sessions and stages the most recent ones,
+    so fMRIPrep can reuse them with --derivatives instead of recomputing the anatomical workflow.
+
+    Parameters:
+    - xnat_url (str): The URL of the XNAT server.
+    - username (str): The XNAT username.
+    - password (str): The XNAT password.
+    - project (str): The project ID.
+    - session (str): The session label being processed.
+    - subject (str): The BIDS subject directory name of the session, e.g. 'sub-0017'. Derivatives of another subject label are not matched by fMRIPrep.
+    - target_dir (str): The local directory receiving the derivatives dataset. Default is <staging dir>/anat_derivatives.
+
+    Returns:
+    - Optional[str]: The label of the session whose derivatives were staged, or None if there are none.
+
+    Raises:
+    - Exception: If XNAT cannot be reached, so an outage is retried instead of silently disabling the fast-track.
+    """
+    if not project or not session or not subject:
+        print("Error: Project ID, Session ID and subject are required")
+        return None
+    if target_dir is None:
+        target_dir = os.path.join(staging_dir, 'anat_derivatives')
+
+    with xnat.connect(xnat_url, user=username, password=password) as connection:
+        for other_session in _subject_sessions(connection, project, session):
+            experiment_id = other_session['ID']
+            resources = connection.get_json(f"/data/experiments/{experiment_id}/resources", query={'format': 'json'})['ResultSet']['Result']
+            for resource in resources:
+                if 'fmriprep' not in resource['label'].lower():
+                    continue
+                resource_uri = f"/data/experiments/{experiment_id}/resources/{resource['label']}"
+                files = _anatomical_files(list_resource_files(connection, resource_uri), subject)
+                if not files:
+                    continue
+
+                os.makedirs(target_dir, exist_ok=True)
+                # Every session of a longitudinal subject reuses the same derivatives, so they are cached like FreeSurfer inputs
+                key = cache_key(files)
+                if not restore_from_cache(key, target_dir):
+                    download_resource_files(connection, resource_uri, target_dir, files=files)
+                    add_to_cache(key, target_dir)
+                description_path = os.path.join(target_dir, 'dataset_description.json')
+                if not os.path.exists(description_path):
+                    with open(description_path, 'w') as f:
+                        json.dump(anat_dataset_description, f, indent=2)
+
+                print(f"Staged {len(files)} anatomical derivatives of {subject} from session {other_session['label']}")
+                return other_session['label']
+
+        print(f"No fMRIPrep anatomical derivatives found for {subject} on other sessions of {session}")
+        return None
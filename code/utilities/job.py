@@ -1,7 +1,31 @@
 import re
+import shlex
 from paramiko import SSHClient
-from typing import Callable, Any
+from typing import Callable, Any, Dict, List, Optional
 import time
+import os
+
+from .metrics import record_retry
+from .profile import NODE_PROFILE_SCRIPT, default_top_nodes
+from .retry import FatalError
+from .sizing import JobResources, job_name, packed_resources
+
+# fMRIPrep release run by the generated scripts, also part of the persistent work directory key
+FMRIPREP_VERSION = '24.1.1'
+SINGULARITY_IMAGE = f'/scratch/mri/singularityimages/fmriprep_{FMRIPREP_VERSION}.sif'
+# Shared TemplateFlow cache, filled before submission by utilities.preflight so jobs never download templates
+TEMPLATEFLOW_HOME = '/scratch/mri/.cache/templateflow'
+# Output spaces passed to fMRIPrep unless the flags give their own --output-spaces, which are then passed alone
+OUTPUT_SPACES = ['T1w:res-native', 'fsnative:den-41k', 'fsaverage:den-41k']
+
+# Seconds before the time limit at which SLURM signals a node-local job to copy its results back to /scratch
+node_local_copy_back_seconds = 900
+
+# sbatch errors caused by an overloaded or restarting controller rather than by the script
+transient_sbatch_errors = ('Socket timed out', 'Unable to contact slurm controller', 'Resource temporarily unavailable', 'try again')
+
+# SLURM states after which a job (or array task) will not run again
+FINISHED_STATES = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE'}
 
 def submit_job(client: SSHClient, script_location: str) -> str:
     """
@@ -13,6 +37,10 @@ def submit_job(client: SSHClient, script_location: str) -> str:
 
     Returns:
     - str: The job ID obtained from the sbatch command.
+
+    Raises:
+    - FatalError: If the scheduler rejects the script, e.g. for an invalid partition or resource request.
+    - Exception: If the scheduler could not be reached, which is worth retrying.
     """
     
     stdin, stdout, stderr = client.exec_command(f"/opt/slurm/default/bin/sbatch {script_location}")
@@ -30,8 +58,34 @@ def submit_job(client: SSHClient, script_location: str) -> str:
     if error_output:
         print(f"Error occurred: {error_output}")
 
+    if job_id is None:
+        if any(message in error_output for message in transient_sbatch_errors):
+            raise Exception(f"The scheduler is unavailable: {error_output}")
+        # Submitting the same script again would be rejected again
+        raise FatalError(f"sbatch rejected {script_location}: {error_output or output}")
+
     return job_id
 
+def find_submitted_job(client: SSHClient, username: str, script_location: str) -> Optional[str]:
+    """
+    Looks for a queued or running job that was submitted from a given script, so a restarted
+    orchestrator can reattach to it instead of submitting the script a second time.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - username (str): The cluster user owning the job.
+    - script_location (str): The path of the submitted script on the remote server.
+
+    Returns:
+    - Optional[str]: The job ID, or None if no job from this script is in the queue.
+    """
+    stdin, stdout, stderr = client.exec_command(f"/opt/slurm/default/bin/squeue -h -u {username} -o '%i|%o'")
+    for line in stdout.read().decode('utf-8').splitlines():
+        job_id, _, command = line.strip().partition('|')
+        if command == script_location:
+            return job_id
+    return None
+
 def check_job_status(client: SSHClient, job_id: str, method: str ='sacct') -> bool:
     """
     Check the status of a specific job on a remote scheduler.
@@ -43,6 +97,10 @@ def check_job_status(client: SSHClient, job_id: str, method: str ='sacct') -> bo
 
     Returns:
     - bool: based on the method if use squeue return True if job is running else False, otherwise if the method is sacct return False if job not completed else True
+
+    Raises:
+    - Exception: With the sacct method, if the state of the job cannot be determined yet: sacct returned nothing,
+      e.g. while slurmdbd is unreachable, or the accounting record does not show the job as finished. Worth retrying.
     """
     if method == 'squeue':
         stdin, stdout, stderr = client.exec_command(f"/opt/slurm/default/bin/{method} -j {job_id}")
@@ -54,21 +112,219 @@ def check_job_status(client: SSHClient, job_id: str, method: str ='sacct') -> bo
             return False
 
     elif method == 'sacct':
-        command = f"/opt/slurm/default/bin/{method} -j {job_id} -o state | grep 'FAILED'"
-        stdin, stdout, stderr = client.exec_command(command)
-
-        # Read the output from the command
-        output = stdout.read().decode('utf-8').strip()
-
-        # Check if the output contains any lines indicating a FAILED state
-        if output:
-            print('Error occurred during job execution: Job failed!')
+        states = get_job_states(client, [job_id])
+
+        # Only a finished job with a non-zero exit is a failure, an unknown state must not discard its outputs
+        if not states:
+            raise Exception(f"The state of job {job_id} could not be determined, sacct returned no record")
+        unfinished = {k: v['state'] for k, v in states.items() if v['state'] not in FINISHED_STATES}
+        if unfinished:
+            raise Exception(f"The accounting record of job {job_id} does not show it as finished yet: {unfinished}")
+
+        # Every step of the job must have completed with a zero exit code
+        failed = {k: v for k, v in states.items() if not job_succeeded(v)}
+        if failed:
+            for failed_id, info in failed.items():
+                print(f"Error occurred during job execution: Job {failed_id} ended with state {info['state']} (exit code {info['exit_code']})")
             return False
 
-        # If no FAILED states are found, we assume all jobs are completed successfully
         print('Job completed successfully!')
         return True
-      
+
+
+def _expand_job_ids(job_id: str) -> List[str]:
+    """
+    Expands the compact job array notation used by sacct for pending tasks.
+
+    Parameters:
+    - job_id (str): A job ID as printed by sacct, e.g. '123', '123_4' or '123_[1-3,7%2]'.
+
+    Returns:
+    - List[str]: The individual job IDs, e.g. ['123_1', '123_2', '123_3', '123_7'].
+    """
+    match = re.match(r"^(\d+)_\[([^\]]+)\]$", job_id)
+    if not match:
+        return [job_id]
+
+    base, ranges = match.group(1), match.group(2).split('%')[0]
+    job_ids = []
+    for part in ranges.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            job_ids.extend(f"{base}_{task_id}" for task_id in range(int(first), int(last) + 1))
+        else:
+            job_ids.append(f"{base}_{part}")
+    return job_ids
+
+
+def get_job_states(client: SSHClient, job_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Query the state and exit code of many jobs with a single sacct call.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - job_ids (List[str]): The job IDs to query. Array jobs are reported per task.
+
+    Returns:
+    - Dict[str, Dict[str, str]]: For each job (or array task) ID, a dict with the keys 'state' and 'exit_code'.
+    """
+    command = f"/opt/slurm/default/bin/sacct -j {','.join(job_ids)} -X -n -P -o JobID,State,ExitCode"
+    stdin, stdout, stderr = client.exec_command(command)
+    output = stdout.read().decode('utf-8')
+
+    states = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 3:
+            continue
+        # States such as 'CANCELLED by 123' carry extra words
+        state = fields[1].split()[0] if fields[1] else 'UNKNOWN'
+        for expanded_id in _expand_job_ids(fields[0]):
+            states[expanded_id] = {'state': state, 'exit_code': fields[2]}
+
+    return states
+
+
+def job_succeeded(info: Dict[str, str]) -> bool:
+    """
+    Tells whether a job state returned by get_job_states is a successful completion.
+
+    Parameters:
+    - info (Dict[str, str]): A value of the dict returned by get_job_states.
+
+    Returns:
+    - bool: True if the job completed with a zero exit code.
+    """
+    return info['state'] == 'COMPLETED' and info['exit_code'] in ('0:0', '0')
+
+
+def get_job_timing(client: SSHClient, job_id: str) -> Dict[str, Optional[float]]:
+    """
+    Splits the life of a job into queue wait and run time using its sacct timestamps.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - job_id (str): The job ID to query.
+
+    Returns:
+    - Dict[str, Optional[float]]: The 'queue_wait_seconds' between submission and start and the 'run_seconds'
+      between start and end. A value is None while the job has not reached that point.
+    """
+    stdin, stdout, stderr = client.exec_command(f"/opt/slurm/default/bin/sacct -j {job_id} -X -n -P -o Submit,Start,End")
+    timing: Dict[str, Optional[float]] = {'queue_wait_seconds': None, 'run_seconds': None}
+
+    lines = stdout.read().decode('utf-8').strip().splitlines()
+    if not lines:
+        return timing
+
+    def timestamp(value: str) -> Optional[float]:
+        try:
+            return time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+        except ValueError:
+            # 'Unknown' or 'None' until the job starts or ends
+            return None
+
+    submit, start, end = (timestamp(value) for value in (lines[0].split('|') + ['', '', ''])[:3])
+    if submit is not None and start is not None:
+        timing['queue_wait_seconds'] = start - submit
+    if start is not None and end is not None:
+        timing['run_seconds'] = end - start
+    return timing
+
+
+def check_array_job_status(client: SSHClient, job_id: str) -> Dict[int, str]:
+    """
+    Check the state of every task of a job array with a single sacct query.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - job_id (str): The job ID of the array.
+
+    Returns:
+    - Dict[int, str]: The state of each array task (e.g. PENDING, RUNNING, COMPLETED, FAILED), keyed by task ID.
+    """
+    states = {}
+    for task_job_id, info in get_job_states(client, [job_id]).items():
+        match = re.match(r"^\d+_(\d+)$", task_job_id)
+        if match:
+            states[int(match.group(1))] = info['state']
+    return states
+
+
+def _markers_exist(client: SSHClient, marker_paths: List[str]) -> bool:
+    """Checks with a single remote command whether all marker files exist."""
+    command = ' && '.join(f"test -e {shlex.quote(path)}" for path in marker_paths)
+    stdin, stdout, stderr = client.exec_command(f"{command} && echo 'exists'")
+    return stdout.read().decode('utf-8').strip() == 'exists'
+
+
+def wait_for_jobs(client: SSHClient,
+                  job_ids: List[str],
+                  pending_interval: int = 15,
+                  running_interval: int = 30,
+                  max_interval: int = 600,
+                  backoff: float = 2.0,
+                  marker_paths: List[str] = None,
+                  marker_interval: int = 5,
+                  on_poll: Callable[[Dict[str, Dict[str, str]]], Any] = None) -> Dict[str, Dict[str, str]]:
+    """
+    Wait until every job has reached a finished state, adapting the polling rate to the job state.
+    Pending jobs are polled every pending_interval seconds so their start is noticed quickly. Once all jobs
+    are running, the scheduler is polled less and less often, up to max_interval, while the marker files
+    the job script writes on exit are checked every marker_interval seconds with a cheap 'test -e'.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - job_ids (List[str]): The job IDs to wait for, all queried in one sacct call.
+    - pending_interval (int): Seconds between scheduler polls while any job is pending. Default is 15.
+    - running_interval (int): Initial seconds between scheduler polls once jobs are running. Default is 30.
+    - max_interval (int): Maximum seconds between scheduler polls. Default is 600.
+    - backoff (float): Factor applied to the interval after each poll of running jobs. Default is 2.0.
+    - marker_paths (List[str]): Remote files that exist once the jobs have exited, if any.
+    - marker_interval (int): Seconds between marker checks. Default is 5.
+    - on_poll (Callable): Called with the job states after each scheduler poll and with {} after each marker check.
+
+    Returns:
+    - Dict[str, Dict[str, str]]: The final job states as returned by get_job_states.
+    """
+    interval = running_interval
+    previous_summary = None
+
+    while True:
+        states = get_job_states(client, job_ids)
+
+        counts = {}
+        for info in states.values():
+            counts[info['state']] = counts.get(info['state'], 0) + 1
+        summary = ', '.join(f"{state}: {count}" for state, count in sorted(counts.items()))
+        if summary != previous_summary:
+            print(f"Job states: {summary}")
+            previous_summary = summary
+
+        if on_poll is not None:
+            on_poll(states)
+
+        if states and all(info['state'] in FINISHED_STATES for info in states.values()):
+            return states
+
+        if not states or any(info['state'] in ('PENDING', 'REQUEUED', 'CONFIGURING') for info in states.values()):
+            time.sleep(pending_interval)
+            interval = running_interval
+            continue
+
+        # Running: wait for the next scheduler poll, leaving early when the job script has exited
+        deadline = time.time() + interval
+        interval = min(interval * backoff, max_interval)
+        while time.time() < deadline:
+            time.sleep(min(marker_interval, max(deadline - time.time(), 0)))
+            if marker_paths and _markers_exist(client, marker_paths):
+                # The accounting record may lag a few seconds behind the job exit
+                interval = pending_interval
+                break
+            if on_poll is not None:
+                on_poll({})
+
+
 def try_with_infinite_retry(func: Callable[..., Any], delay: int = 20) -> Any:
     """
     Retry executing a function indefinitely in case of exceptions.
@@ -87,26 +343,20 @@ def try_with_infinite_retry(func: Callable[..., Any], delay: int = 20) -> Any:
         try:
             return func()
         except Exception as e:
+            record_retry(getattr(func, '__name__', str(func)), e)
             time.sleep(delay)
 
 
-def create_bash_script(location: str, workflow_id: str, anat_only: bool, flags: str = '') -> None:
+def _filter_flags(flags: str) -> str:
     """
-    Creates a bash script file with predefined content.
+    Removes the flags that are already managed by the generated script from user supplied flags.
 
     Parameters:
-    - location (str): The location where the input and output directories are located.
-    - workflow_id (str): Unique operation ID to be embedded in the script.
-    - anat_only (bool): If True, add the --anat-only flag to the command.
     - flags (str): Additional flags to be included in the command. Can be empty.
 
     Returns:
-    - None
+    - str: The remaining flags joined by spaces.
     """
-
-    # Determine the anat-only flag based on anat_only
-    anat_flag = '--anat-only' if anat_only else ''
-
     # List of existing flags in the command
     existing_flags = {
         '--skip_bids_validation', 
@@ -115,58 +365,253 @@ def create_bash_script(location: str, workflow_id: str, anat_only: bool, flags:
     }
 
     # Filter out existing flags from the input flags string if flags are not empty
-    filtered_flags = ' '.join(
+    return ' '.join(
         flag for flag in flags.split() if flag not in existing_flags
     ) if flags else ''
 
-    content = f"""#!/bin/bash -l
-
-#SBATCH -n 1
-#SBATCH -c 16
-#SBATCH -a 1
-#SBATCH -t 16:00:00
-#SBATCH -o slurm-{workflow_id}.out
-#SBATCH -e slurm-{workflow_id}.err
 
-# Load FMRIPrep module
-module load singularity
-SINGULARITY_IMG=/scratch/mri/singularityimages/fmriprep_24.1.1.sif
-export TEMPLATEFLOW_HOME='/scratch/mri/.cache/templateflow'
-
-export SINGULARITYENV_FS_LICENSE='{location}/{workflow_id}/license.txt'
+def _fmriprep_commands(anat_only: bool, flags: str, resources: JobResources, persistent_work_dir: bool = False, node_local: bool = False,
+                       anat_derivatives: bool = False, resource_monitor: bool = False) -> str:
+    """
+    Returns the part of a job script that prepares the output directories and runs fMRIPrep.
+    On success a WORKDIR/manifest.tsv listing every output with its size and MD5 checksum is written, and
+    the exit status and a WORKDIR/.finished marker are written to WORKDIR when the script exits. The script must define WORKDIR, INPUT_DIR,
+    NIPYPE_WORK_DIR, FREESURFER_OUTPUT_DIR and FMRIPREP_OUTPUT_DIR beforehand.
 
-WORKDIR='{location}/{workflow_id}'
-INPUT_DIR='{location}/{workflow_id}/input'
+    Parameters:
+    - anat_only (bool): If True, add the --anat-only flag to the command.
+    - flags (str): Additional flags to be included in the command. Can be empty.
+    - resources (JobResources): The allocation the fMRIPrep thread and memory settings must fit in.
+    - persistent_work_dir (bool): Whether NIPYPE_WORK_DIR outlives the job and must be locked and touched.
+    - node_local (bool): Whether to run on node-local storage under $TMPDIR and copy the outputs back to
+      /scratch when the job exits, fails or is about to time out. A persistent work directory stays on /scratch.
+    - anat_derivatives (bool): Whether WORKDIR/anat_derivatives holds anatomical derivatives of another session
+      that fMRIPrep reuses instead of running the anatomical workflow.
+    - resource_monitor (bool): Whether to run fMRIPrep with --resource-monitor and, once it exits, write the runtime,
+      peak memory and CPU use of every nipype node to WORKDIR/node_profile.json and the slowest nodes to the job log.
 
-FREESURFER_OUTPUT_DIR='{location}/{workflow_id}/freesurfer'
-FMRIPREP_OUTPUT_DIR='{location}/{workflow_id}/fmriprep'
+    Returns:
+    - str: The bash commands.
+    """
 
-# Check if input/freesurfer exists and copy it, otherwise create empty directory
+    # Determine the anat-only flag based on anat_only
+    anat_flag = '--anat-only' if anat_only else ''
+    # Anatomical fast-track: precomputed derivatives replace skull-stripping, normalization and surfaces
+    derivatives_bind = '-B "${WORKDIR}/anat_derivatives":/anat_derivatives:ro \\\n    ' if anat_derivatives else ''
+    derivatives_flag = '--derivatives /anat_derivatives' if anat_derivatives else ''
+    filtered_flags = _filter_flags(flags)
+    # The user's spaces replace the defaults rather than follow them on the same command line
+    custom_spaces = any(flag.split('=')[0] in ('--output-spaces', '--output-space') for flag in filtered_flags.split())
+    spaces_flag = '' if custom_spaces else f"--output-space {' '.join(OUTPUT_SPACES)}"
+    monitor_flag = '--resource-monitor' if resource_monitor else ''
+
+    profile_commands = ''
+    if resource_monitor:
+        profile_commands = f"""
+# Summarize the nipype nodes this job ran; nodes reused from an earlier run are older than JOB_START
+cat > "${{WORKDIR}}/node_profile.py" <<'PROFILE'
+{NODE_PROFILE_SCRIPT.strip()}
+PROFILE
+singularity exec --cleanenv \\
+    -B "${{NIPYPE_WORK_DIR}}":/work:ro \\
+    -B "${{WORKDIR}}":/profile \\
+    "${{SINGULARITY_IMG}}" \\
+    python /profile/node_profile.py /work ${{JOB_START}} /profile/node_profile.json {default_top_nodes} \\
+    || echo "Could not profile the nipype nodes"
+"""
+
+    resource_flags = f"--nthreads {resources.cpus}"
+    if resources.omp_nthreads is not None:
+        resource_flags += f" --omp-nthreads {resources.omp_nthreads}"
+    if resources.mem_mb is not None:
+        # Leave headroom for the container and the shell below the SLURM limit
+        resource_flags += f" --mem-mb {int(resources.mem_mb * 0.9)}"
+
+    work_dir_commands = ''
+    if persistent_work_dir:
+        work_dir_commands = """
+# Reuse the persistent work directory so nipype only recomputes nodes whose inputs changed.
+# Touching it keeps it from expiring, and the lock stops two jobs from sharing it at once.
+mkdir -p "${NIPYPE_WORK_DIR}" && touch "${NIPYPE_WORK_DIR}"
+exec 9>"${NIPYPE_WORK_DIR}/.lock"
+flock 9
+"""
+
+    if node_local:
+        local_work_dir = '' if persistent_work_dir else 'NIPYPE_WORK_DIR="${LOCAL_DIR}/work"\n'
+        staging_commands = f"""# Record the job exit so the orchestrator notices it without polling the scheduler,
+# after the outputs are copied back from node-local storage
+trap 'EXIT_CODE=$?; copy_back; rm -rf "${{LOCAL_DIR}}"; echo ${{EXIT_CODE}} > "${{WORKDIR}}/exit_code"; touch "${{WORKDIR}}/.finished"' EXIT
+{work_dir_commands}
+# Run on node-local storage so the metadata-heavy inputs, nipype work directory and outputs stay off /scratch
+SHARED_FREESURFER_OUTPUT_DIR="${{FREESURFER_OUTPUT_DIR}}"
+SHARED_FMRIPREP_OUTPUT_DIR="${{FMRIPREP_OUTPUT_DIR}}"
+LOCAL_DIR=$(mktemp -d "${{TMPDIR:-/tmp}}/fmriprep.XXXXXX") || exit 1
+echo "Staging on node-local storage ${{LOCAL_DIR}}"
+
+copy_back() {{
+    mkdir -p "${{SHARED_FREESURFER_OUTPUT_DIR}}" "${{SHARED_FMRIPREP_OUTPUT_DIR}}"
+    [ -d "${{FREESURFER_OUTPUT_DIR}}" ] && rsync -a "${{FREESURFER_OUTPUT_DIR}}/" "${{SHARED_FREESURFER_OUTPUT_DIR}}/"
+    [ -d "${{FMRIPREP_OUTPUT_DIR}}" ] && rsync -a "${{FMRIPREP_OUTPUT_DIR}}/" "${{SHARED_FMRIPREP_OUTPUT_DIR}}/"
+    echo "Copied outputs back to ${{SHARED_FMRIPREP_OUTPUT_DIR}}"
+}}
+
+# SLURM sends USR1 ahead of the time limit, TERM on scancel; stop fMRIPrep so the EXIT trap copies the outputs back
+trap 'echo "Job is stopping, copying outputs back"; [ -n "${{FMRIPREP_PID}}" ] && kill "${{FMRIPREP_PID}}" && wait "${{FMRIPREP_PID}}"; exit 143' USR1 TERM
+
+# Copy the existing FreeSurfer subject straight into the local subjects directory, otherwise create empty directory
+rsync -a --exclude=/freesurfer "${{INPUT_DIR}}/" "${{LOCAL_DIR}}/input/"
 if [ -d "${{INPUT_DIR}}/freesurfer" ]; then
-    cp -r "${{INPUT_DIR}}/freesurfer" "${{FREESURFER_OUTPUT_DIR}}"
+    rsync -a "${{INPUT_DIR}}/freesurfer/" "${{LOCAL_DIR}}/freesurfer/"
+else
+    mkdir -p "${{LOCAL_DIR}}/freesurfer"
+fi
+INPUT_DIR="${{LOCAL_DIR}}/input"
+FREESURFER_OUTPUT_DIR="${{LOCAL_DIR}}/freesurfer"
+FMRIPREP_OUTPUT_DIR="${{LOCAL_DIR}}/fmriprep"
+{local_work_dir}mkdir -p "${{FMRIPREP_OUTPUT_DIR}}" "${{NIPYPE_WORK_DIR}}"
+"""
+    else:
+        staging_commands = f"""# Record the job exit so the orchestrator notices it without polling the scheduler
+trap 'echo $? > "${{WORKDIR}}/exit_code"; touch "${{WORKDIR}}/.finished"' EXIT
+# Stop fMRIPrep on scancel so the exit status records the job as failed
+trap '[ -n "${{FMRIPREP_PID}}" ] && kill "${{FMRIPREP_PID}}"; exit 143' TERM
+{work_dir_commands}
+# Move input/freesurfer into place, a rename on /scratch instead of copying thousands of small files,
+# otherwise create empty directory
+if [ -d "${{INPUT_DIR}}/freesurfer" ] && [ ! -e "${{FREESURFER_OUTPUT_DIR}}" ]; then
+    mv "${{INPUT_DIR}}/freesurfer" "${{FREESURFER_OUTPUT_DIR}}"
 else
     mkdir -p "${{FREESURFER_OUTPUT_DIR}}"
 fi
 
 # Create fmriprep output directory if it doesn't exist
 mkdir -p "${{FMRIPREP_OUTPUT_DIR}}"
+"""
 
+    return f"""{staging_commands}
+JOB_START=$(date +%s)
+# fMRIPrep runs in the background so the signal traps fire while it is running
 singularity run --cleanenv \\
     -B "${{INPUT_DIR}}":/data:ro \\
     -B "${{FMRIPREP_OUTPUT_DIR}}":/fmriprep \\
-    -B "${{WORKDIR}}":/work \\
+    -B "${{NIPYPE_WORK_DIR}}":/work \\
     -B "${{FREESURFER_OUTPUT_DIR}}":/freesurfer \\
-    "${{SINGULARITY_IMG}}" \\
+    -B "${{TEMPLATEFLOW_HOME}}" \\
+    {derivatives_bind}"${{SINGULARITY_IMG}}" \\
     /data /fmriprep participant \\
     --fs-subjects-dir /freesurfer \\
     --work-dir /work \\
     --skip_bids_validation \\
-    --output-space T1w:res-native fsnative:den-41k fsaverage:den-41k \\
-    --nthreads 16 \\
+    {spaces_flag} \\
+    {resource_flags} \\
     --no-submm-recon \\
     {anat_flag} \\
-    {filtered_flags}
+    {derivatives_flag} \\
+    {monitor_flag} \\
+    {filtered_flags} &
+FMRIPREP_PID=$!
+wait ${{FMRIPREP_PID}}
+FMRIPREP_EXIT_CODE=$?
+{profile_commands}
+# Write a manifest of the outputs with sizes and MD5 checksums so only new or changed files are retrieved,
+# symbolic links with their target
+write_manifest() {{
+    (cd "$1" && find . \\( -type f -o -type l \\) -exec sh -c 'for f; do
+        if [ -L "$f" ]; then printf "%s\\t0\\tsymlink:%s\\n" "$0/${{f#./}}" "$(readlink "$f")"
+        else printf "%s\\t%s\\t%s\\n" "$0/${{f#./}}" "$(stat -c %s "$f")" "$(md5sum < "$f" | cut -d" " -f1)"; fi
+    done' "$2" {{}} +)
+}}
+if [ ${{FMRIPREP_EXIT_CODE}} -eq 0 ]; then
+    {{
+        write_manifest "${{FMRIPREP_OUTPUT_DIR}}" fmriprep
+        write_manifest "${{FREESURFER_OUTPUT_DIR}}" freesurfer
+    }} > "${{WORKDIR}}/manifest.tsv.tmp" && mv "${{WORKDIR}}/manifest.tsv.tmp" "${{WORKDIR}}/manifest.tsv"
+fi
+
+exit ${{FMRIPREP_EXIT_CODE}}
+"""
+
+
+def persistent_work_directory(username: str, project: str, subject: str, session: str, version: str = FMRIPREP_VERSION) -> str:
+    """
+    Returns the nipype work directory shared by every run of a session with the same fMRIPrep version.
+
+    Parameters:
+    - username (str): The cluster user owning the /scratch directory.
+    - project (str): The XNAT project ID.
+    - subject (str): The BIDS subject label.
+    - session (str): The session label.
+    - version (str): The fMRIPrep version. Defaults to the version run by the generated scripts.
+
+    Returns:
+    - str: The remote path, e.g. /scratch/mri/work/<project>/<subject>/<session>/fmriprep-24.1.1.
+    """
+    return os.path.join(f'/scratch/{username}/work', project, subject, session, f'fmriprep-{version}')
+
+
+def _sbatch_resources(resources: JobResources, node_local: bool = False) -> str:
+    """Returns the #SBATCH lines of the job name and allocation."""
+    lines = [f"#SBATCH -J {job_name}", "#SBATCH -n 1", f"#SBATCH -c {resources.cpus}"]
+    if resources.mem_gb is not None:
+        lines.append(f"#SBATCH --mem={resources.mem_gb}G")
+    if node_local:
+        # Warn the batch shell before the time limit so it can copy the outputs back
+        lines.append(f"#SBATCH --signal=B:USR1@{node_local_copy_back_seconds}")
+    return '\n'.join(lines)
+
+
+def create_bash_script(location: str, workflow_id: str, anat_only: bool, flags: str = '', resources: Optional[JobResources] = None, work_dir: Optional[str] = None, node_local: bool = False,
+                       anat_derivatives: bool = False, resource_monitor: bool = False) -> None:
+    """
+    Creates a bash script file with predefined content.
+
+    Parameters:
+    - location (str): The location where the input and output directories are located.
+    - workflow_id (str): Unique operation ID to be embedded in the script.
+    - anat_only (bool): If True, add the --anat-only flag to the command.
+    - flags (str): Additional flags to be included in the command. Can be empty.
+    - resources (Optional[JobResources]): The allocation to request. Defaults to 16 cores for 16 hours.
+    - work_dir (Optional[str]): A persistent nipype work directory, see persistent_work_directory. Defaults to the operation directory.
+    - node_local (bool): Whether to run fMRIPrep on node-local storage and copy only the outputs back to /scratch.
+    - anat_derivatives (bool): Whether anatomical derivatives of another session are staged in the operation directory, see find_fmriprep_anatomical_derivatives.
+    - resource_monitor (bool): Whether to profile the nipype nodes of the run, see write_profile_report.
+
+    Returns:
+    - None
     """
+    if resources is None:
+        resources = JobResources()
+
+    nipype_work_dir = f"'{work_dir}'" if work_dir else f"'{location}/{workflow_id}'"
+
+    content = f"""#!/bin/bash -l
+
+{_sbatch_resources(resources, node_local)}
+#SBATCH -a 1
+#SBATCH -t {resources.walltime}
+#SBATCH -o slurm-{workflow_id}.out
+#SBATCH -e slurm-{workflow_id}.err
+
+# Load FMRIPrep module
+module load singularity
+SINGULARITY_IMG={SINGULARITY_IMAGE}
+export TEMPLATEFLOW_HOME='{TEMPLATEFLOW_HOME}'
+# --cleanenv only passes SINGULARITYENV_ variables; the templates are prefetched, so skip TemplateFlow's update check
+export SINGULARITYENV_TEMPLATEFLOW_HOME="${{TEMPLATEFLOW_HOME}}"
+export SINGULARITYENV_TEMPLATEFLOW_AUTOUPDATE=0
+
+export SINGULARITYENV_FS_LICENSE='{location}/{workflow_id}/license.txt'
+
+WORKDIR='{location}/{workflow_id}'
+INPUT_DIR='{location}/{workflow_id}/input'
+NIPYPE_WORK_DIR={nipype_work_dir}
+
+FREESURFER_OUTPUT_DIR='{location}/{workflow_id}/freesurfer'
+FMRIPREP_OUTPUT_DIR='{location}/{workflow_id}/fmriprep'
+
+{_fmriprep_commands(anat_only, flags, resources, persistent_work_dir=work_dir is not None, node_local=node_local, anat_derivatives=anat_derivatives,
+                    resource_monitor=resource_monitor)}"""
 
     file_name = f'{workflow_id}.slurm'
 
@@ -174,3 +619,163 @@ singularity run --cleanenv \\
         file.write(content)
 
     print(f"File '{file_name}' has been created!")
+
+
+def create_batch_bash_script(location: str, batch_id: str, session_labels: List[str], anat_only: bool, flags: str = '', resources: Optional[JobResources] = None, node_local: bool = False) -> None:
+    """
+    Creates a SLURM job array script processing several sessions, one array task per session.
+    Task N processes the N-th session, staged under location/batch_id/<session_label>.
+
+    Parameters:
+    - location (str): The location where the batch directory is located.
+    - batch_id (str): Unique batch ID to be embedded in the script.
+    - session_labels (List[str]): The session labels, in array task order.
+    - anat_only (bool): If True, add the --anat-only flag to the command.
+    - flags (str): Additional flags to be included in the command. Can be empty.
+    - resources (Optional[JobResources]): The allocation to request. Defaults to 16 cores for 16 hours.
+    - node_local (bool): Whether each task runs fMRIPrep on node-local storage and copies only the outputs back to /scratch.
+
+    Returns:
+    - None
+    """
+    if resources is None:
+        resources = JobResources()
+    sessions = ' '.join(shlex.quote(label) for label in session_labels)
+
+    content = f"""#!/bin/bash -l
+
+{_sbatch_resources(resources, node_local)}
+#SBATCH -a 1-{len(session_labels)}
+#SBATCH -t {resources.walltime}
+#SBATCH -o slurm-{batch_id}_%a.out
+#SBATCH -e slurm-{batch_id}_%a.err
+
+# Map the array task ID to the session it processes
+SESSIONS=({sessions})
+SESSION="${{SESSIONS[$((SLURM_ARRAY_TASK_ID - 1))]}}"
+echo "Processing session ${{SESSION}} (task ${{SLURM_ARRAY_TASK_ID}})"
+
+# Load FMRIPrep module
+module load singularity
+SINGULARITY_IMG={SINGULARITY_IMAGE}
+export TEMPLATEFLOW_HOME='{TEMPLATEFLOW_HOME}'
+# --cleanenv only passes SINGULARITYENV_ variables; the templates are prefetched, so skip TemplateFlow's update check
+export SINGULARITYENV_TEMPLATEFLOW_HOME="${{TEMPLATEFLOW_HOME}}"
+export SINGULARITYENV_TEMPLATEFLOW_AUTOUPDATE=0
+
+export SINGULARITYENV_FS_LICENSE='{location}/{batch_id}/license.txt'
+
+WORKDIR="{location}/{batch_id}/${{SESSION}}"
+INPUT_DIR="${{WORKDIR}}/input"
+NIPYPE_WORK_DIR="${{WORKDIR}}"
+
+FREESURFER_OUTPUT_DIR="${{WORKDIR}}/freesurfer"
+FMRIPREP_OUTPUT_DIR="${{WORKDIR}}/fmriprep"
+
+{_fmriprep_commands(anat_only, flags, resources, node_local=node_local)}"""
+
+    file_name = f'{batch_id}.slurm'
+
+    with open(file_name, 'w') as file:
+        file.write(content)
+
+    print(f"File '{file_name}' has been created!")
+
+
+def create_packed_bash_script(location: str, batch_id: str, session_groups: List[List[str]], session_resources: Dict[str, JobResources],
+                              anat_only: bool, flags: str = '', node_local: bool = False) -> None:
+    """
+    Creates a SLURM job array script that packs several sessions into each allocation, one array task per group.
+    The sessions of a task run as concurrent fMRIPrep instances, each with its own thread and memory budget,
+    staged under location/batch_id/<session_label> and logging to fmriprep.log there.
+
+    Parameters:
+    - location (str): The location where the batch directory is located.
+    - batch_id (str): Unique batch ID to be embedded in the script.
+    - session_groups (List[List[str]]): The session labels of each allocation, in array task order, see pack_sessions.
+    - session_resources (Dict[str, JobResources]): The budget of each session within its allocation.
+    - anat_only (bool): If True, add the --anat-only flag to the command.
+    - flags (str): Additional flags to be included in the command. Can be empty.
+    - node_local (bool): Whether each session runs fMRIPrep on node-local storage and copies only the outputs back to /scratch.
+
+    Returns:
+    - None
+    """
+    # Every array task gets the allocation of the largest group
+    resources = max((packed_resources([session_resources[label] for label in group]) for group in session_groups),
+                    key=lambda r: (r.cpus, r.mem_gb or 0))
+    resources.walltime_hours = max(session_resources[label].walltime_hours for group in session_groups for label in group)
+
+    labels = [label for group in session_groups for label in group]
+    functions = '\n'.join(f"""# Session {label}
+run_session_{index}() {{
+WORKDIR={shlex.quote(f'{location}/{batch_id}/{label}')}
+INPUT_DIR="${{WORKDIR}}/input"
+NIPYPE_WORK_DIR="${{WORKDIR}}"
+FREESURFER_OUTPUT_DIR="${{WORKDIR}}/freesurfer"
+FMRIPREP_OUTPUT_DIR="${{WORKDIR}}/fmriprep"
+{_fmriprep_commands(anat_only, flags, session_resources[label], node_local=node_local)}}}
+""" for index, label in enumerate(labels))
+    tasks = '\n'.join(f"    {task}) TASK_SESSIONS=({' '.join(str(labels.index(label)) for label in group)}) ;;"
+                      for task, group in enumerate(session_groups, start=1))
+    sessions = ' '.join(shlex.quote(label) for label in labels)
+    forwarded = ['USR1', 'TERM'] if node_local else ['TERM']
+    traps = '\n'.join(f"trap 'kill -{signal} \"${{PIDS[@]}}\" 2>/dev/null' {signal}" for signal in forwarded)
+
+    content = f"""#!/bin/bash -l
+
+{_sbatch_resources(resources, node_local)}
+#SBATCH -a 1-{len(session_groups)}
+#SBATCH -t {resources.walltime}
+#SBATCH -o slurm-{batch_id}_%a.out
+#SBATCH -e slurm-{batch_id}_%a.err
+
+# Load FMRIPrep module
+module load singularity
+SINGULARITY_IMG={SINGULARITY_IMAGE}
+export TEMPLATEFLOW_HOME='{TEMPLATEFLOW_HOME}'
+# --cleanenv only passes SINGULARITYENV_ variables; the templates are prefetched, so skip TemplateFlow's update check
+export SINGULARITYENV_TEMPLATEFLOW_HOME="${{TEMPLATEFLOW_HOME}}"
+export SINGULARITYENV_TEMPLATEFLOW_AUTOUPDATE=0
+
+export SINGULARITYENV_FS_LICENSE='{location}/{batch_id}/license.txt'
+
+{functions}
+# Map the array task ID to the sessions sharing this allocation
+SESSIONS=({sessions})
+case "${{SLURM_ARRAY_TASK_ID}}" in
+{tasks}
+esac
+
+PIDS=()
+for SESSION_INDEX in "${{TASK_SESSIONS[@]}}"; do
+    SESSION_LOG="{location}/{batch_id}/${{SESSIONS[$SESSION_INDEX]}}/fmriprep.log"
+    echo "Processing session ${{SESSIONS[$SESSION_INDEX]}} (task ${{SLURM_ARRAY_TASK_ID}}), log in ${{SESSION_LOG}}"
+    "run_session_${{SESSION_INDEX}}" > "${{SESSION_LOG}}" 2>&1 &
+    PIDS+=($!)
+done
+
+# Pass the scheduler's signals on so every session stops cleanly and writes its outputs
+{traps}
+
+FAILED=0
+for PID in "${{PIDS[@]}}"; do
+    wait "${{PID}}"
+    STATUS=$?
+    # A trapped signal interrupts wait, so wait again while the session is still running
+    while kill -0 "${{PID}}" 2>/dev/null; do
+        wait "${{PID}}"
+        STATUS=$?
+    done
+    [ ${{STATUS}} -eq 0 ] || FAILED=1
+done
+
+exit ${{FAILED}}
+"""
+
+    file_name = f'{batch_id}.slurm'
+
+    with open(file_name, 'w') as file:
+        file.write(content)
+
+    print(f"File '{file_name}' has been created!")
@@ -1,6 +1,8 @@
 import os
 from .job import check_job_status
 import time
+from typing import Dict, List
+from paramiko.client import SSHClient
 
 def fetch_logs(client, filepath, localpath, password):
     """Fetch logs from remote server using scp."""
@@ -33,4 +35,79 @@ def continuous_fetch_logs(client, job_id, filepath, localpath, password, retry_i
         except Exception as e:
             print(f"Exception while fetching logs: {e}")
             print(f"Retrying in {retry_interval} seconds...")
-            time.sleep(retry_interval)
\ No newline at end of file
+            time.sleep(retry_interval)
+
+class RemoteLogFollower:
+    """
+    Follows remote log files over SFTP, reading only the bytes written since the previous poll
+    and printing complete lines in one batch per file.
+    """
+
+    def __init__(self, paths: List[str]):
+        """
+        Parameters:
+        - paths (List[str]): The remote log files to follow, e.g. the .out and .err files of a SLURM job.
+        """
+        self.offsets: Dict[str, int] = {path: 0 for path in paths}
+        self._partial: Dict[str, str] = {path: '' for path in paths}
+        self._client = None
+        self._sftp = None
+
+    def _sftp_for(self, client: SSHClient):
+        # Reopen the SFTP session when the orchestrator reconnected with a new client
+        if self._sftp is None or self._client is not client:
+            self._sftp = client.open_sftp()
+            self._client = client
+        return self._sftp
+
+    def poll(self, client: SSHClient) -> int:
+        """
+        Prints the lines appended to each log since the previous poll.
+
+        Parameters:
+        - client (SSHClient): An established SSHClient instance connected to the server.
+
+        Returns:
+        - int: The number of bytes read.
+        """
+        sftp = self._sftp_for(client)
+        total = 0
+
+        for path, offset in self.offsets.items():
+            try:
+                size = sftp.stat(path).st_size
+            except FileNotFoundError:
+                # SLURM creates the logs only when the job starts
+                continue
+
+            if size < offset:
+                # The log was truncated or recreated, start over
+                offset = 0
+                self._partial[path] = ''
+            if size == offset:
+                continue
+
+            with sftp.open(path, 'rb') as remote_file:
+                remote_file.seek(offset)
+                data = remote_file.read(size - offset)
+            self.offsets[path] = offset + len(data)
+            total += len(data)
+
+            lines = (self._partial[path] + data.decode('utf-8', errors='replace')).split('\n')
+            self._partial[path] = lines.pop()
+            if lines:
+                prefix = '[stderr] ' if path.endswith('.err') else ''
+                print('\n'.join(f"{prefix}{line}" for line in lines))
+
+        return total
+
+    def flush(self) -> None:
+        """Prints the last unterminated line of each log and closes the SFTP session."""
+        for path, partial in self._partial.items():
+            if partial:
+                print(f"{'[stderr] ' if path.endswith('.err') else ''}{partial}")
+                self._partial[path] = ''
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+            self._client = None
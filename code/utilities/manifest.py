@@ -0,0 +1,148 @@
+import fnmatch
+import os
+import re
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+from paramiko.client import SSHClient
+
+from .download import _md5sum
+from .transfer import archive_sync, parallel_sync
+
+# BIDS space entity of a derivative file name, e.g. 'space-MNI152NLin2009cAsym'
+space_pattern = re.compile(r"_space-([A-Za-z0-9]+)")
+
+
+def read_remote_manifest(client: SSHClient, manifest_path: str) -> Optional[Dict[str, Tuple[int, str]]]:
+    """
+    Reads the output manifest written by the job script.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - manifest_path (str): The remote path of manifest.tsv.
+
+    Returns:
+    - Optional[Dict[str, Tuple[int, str]]]: The size and MD5 checksum of each output, keyed by path relative
+      to the job directory (e.g. 'fmriprep/sub-01/anat/...'), or None if there is no manifest. A symbolic link
+      has size 0 and 'symlink:<target>' in place of the checksum.
+    """
+    stdin, stdout, stderr = client.exec_command(f"cat {manifest_path}")
+    content = stdout.read().decode('utf-8')
+    if stdout.channel.recv_exit_status() != 0:
+        return None
+
+    manifest = {}
+    for line in content.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3:
+            manifest[fields[0]] = (int(fields[1]), fields[2])
+    return manifest
+
+
+def is_requested(path: str, spaces: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> bool:
+    """
+    Tells whether an output file was asked for by the caller.
+
+    Parameters:
+    - path (str): The path of the output relative to the job directory.
+    - spaces (Optional[List[str]]): The output spaces to keep, e.g. ['T1w', 'fsnative']. Files in other spaces,
+      and fsaverage subject directories when no fsaverage space is kept, are skipped. None keeps every space.
+    - exclude (Optional[List[str]]): Glob patterns of files to skip, e.g. ['*.html', '*/figures/*'].
+
+    Returns:
+    - bool: True if the file should be retrieved.
+    """
+    if exclude and any(fnmatch.fnmatch(path, pattern) for pattern in exclude):
+        return False
+
+    if spaces is not None:
+        match = space_pattern.search(os.path.basename(path))
+        if match and match.group(1) not in spaces:
+            return False
+        parts = path.split('/')
+        if len(parts) > 1 and parts[0] == 'freesurfer' and parts[1].startswith('fsaverage'):
+            if not any(space.startswith('fsaverage') for space in spaces):
+                return False
+
+    return True
+
+
+def _matches(path: str, size: int, checksum: str) -> bool:
+    """Tells whether a local file has the given size and MD5 checksum, or a link the given 'symlink:<target>'."""
+    if checksum.startswith('symlink:'):
+        return os.path.islink(path) and os.readlink(path) == checksum[len('symlink:'):]
+    return os.path.isfile(path) and not os.path.islink(path) and os.path.getsize(path) == size and _md5sum(path) == checksum
+
+
+def retrieve_outputs(client: SSHClient,
+                     manifest: Dict[str, Tuple[int, str]],
+                     remote_dir: str,
+                     prefix: str,
+                     destination: str,
+                     hostname: str,
+                     username: str,
+                     reference_dir: Optional[str] = None,
+                     spaces: Optional[List[str]] = None,
+                     exclude: Optional[List[str]] = None,
+                     ssh_command: Optional[str] = None,
+                     archive: bool = False) -> Dict:
+    """
+    Retrieves the outputs listed in the manifest under one prefix, pulling only what is requested and not already available locally.
+    Files identical to the local destination are skipped and files identical to the reference directory
+    (typically the FreeSurfer subject we uploaded ourselves) are copied locally instead of over the network.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - manifest (Dict[str, Tuple[int, str]]): The manifest returned by read_remote_manifest.
+    - remote_dir (str): The remote job directory the manifest paths are relative to.
+    - prefix (str): The output directory to retrieve, e.g. 'fmriprep' or 'freesurfer'.
+    - destination (str): The local directory receiving the outputs.
+    - hostname (str): IP address or hostname of the remote server.
+    - username (str): Username on the remote host.
+    - reference_dir (Optional[str]): A local directory holding unchanged copies of some outputs.
+    - spaces (Optional[List[str]]): The output spaces to keep. None keeps every space.
+    - exclude (Optional[List[str]]): Glob patterns of files to skip.
+    - ssh_command (Optional[str]): The remote shell used by rsync.
+    - archive (bool): Fetch new files as one tar stream, see archive_sync. Default is False.
+
+    Returns:
+    - Dict: Counts of 'fetched', 'copied', 'unchanged' and 'skipped' files and the 'bytes' transferred.
+    """
+    to_fetch: List[Tuple[str, int]] = []
+    copied = unchanged = skipped = 0
+
+    for path, (size, checksum) in sorted(manifest.items()):
+        if not path.startswith(f"{prefix}/"):
+            continue
+        if not is_requested(path, spaces, exclude):
+            skipped += 1
+            continue
+
+        relative_path = path[len(prefix) + 1:]
+        target = os.path.join(destination, relative_path)
+        if _matches(target, size, checksum):
+            unchanged += 1
+            continue
+
+        reference = os.path.join(reference_dir, relative_path) if reference_dir else None
+        if reference and _matches(reference, size, checksum):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.lexists(target):
+                os.remove(target)
+            # Links are recreated as links
+            shutil.copy2(reference, target, follow_symlinks=False)
+            copied += 1
+            continue
+
+        to_fetch.append((relative_path, size))
+
+    stats = {'bytes': 0}
+    if to_fetch:
+        sync = archive_sync if archive else parallel_sync
+        stats = sync(action='get', hostname=hostname, username=username, source=f"{remote_dir}/{prefix}",
+                              destination=destination, client=client, ssh_command=ssh_command, files=to_fetch)
+
+    print(f"Retrieved {prefix}: {len(to_fetch)} fetched, {copied} copied from local inputs, "
+          f"{unchanged} unchanged, {skipped} skipped by request")
+
+    return {'fetched': len(to_fetch), 'copied': copied, 'unchanged': unchanged, 'skipped': skipped, 'bytes': stats['bytes']}
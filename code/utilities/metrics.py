@@ -0,0 +1,189 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# Where events are appended as JSON lines, and the optional Prometheus textfile collector output
+default_metrics_path = os.getenv('FMRIPREP_METRICS_FILE', '/temp_files/metrics.jsonl')
+default_textfile_path = os.getenv('FMRIPREP_PROMETHEUS_TEXTFILE')
+
+# Labels attached to every event, e.g. the workflow and session, set by configure_metrics
+metric_labels: Dict[str, str] = {}
+# Labels of the task recording an event, e.g. the workflow of a service task. asyncio.to_thread passes them on.
+_context_labels: ContextVar[Dict[str, str]] = ContextVar('metric_context_labels', default={})
+# Totals of the current process, exported to the Prometheus textfile
+metric_totals = {'steps': {}, 'retries': {}, 'transfers': {}, 'job': {}}
+_settings = {'path': default_metrics_path, 'textfile': default_textfile_path}
+
+
+def configure_metrics(path: Optional[str] = default_metrics_path, textfile: Optional[str] = default_textfile_path, **labels: str) -> None:
+    """
+    Sets where metrics are written and the labels attached to them.
+
+    Parameters:
+    - path (Optional[str]): The JSON lines file events are appended to. None disables it.
+    - textfile (Optional[str]): The Prometheus textfile rewritten after each step. None disables it.
+    - labels (str): Labels identifying the run, e.g. workflow='...', session='...'.
+    """
+    _settings['path'] = path
+    _settings['textfile'] = textfile
+    metric_labels.clear()
+    metric_labels.update({key: str(value) for key, value in labels.items()})
+
+
+def record_event(event: str, **fields) -> None:
+    """
+    Appends one event to the JSON lines file.
+
+    Parameters:
+    - event (str): The kind of event, e.g. 'step', 'transfer', 'retry' or 'job'.
+    - fields: The measurements of the event.
+    """
+    if not _settings['path']:
+        return
+    entry = {'time': time.time(), 'event': event, **metric_labels, **_context_labels.get(), **fields}
+    try:
+        os.makedirs(os.path.dirname(_settings['path']) or '.', exist_ok=True)
+        with open(_settings['path'], 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        # Telemetry must never stop a workflow
+        print(f"Could not write metrics to {_settings['path']}: {str(e)}")
+
+
+@contextmanager
+def metric_context(**labels: str):
+    """
+    Attaches labels to the events recorded by the current task, and by the threads it starts with asyncio.to_thread,
+    so the events of workflows running concurrently in one process can be told apart.
+
+    Parameters:
+    - labels (str): Labels identifying the task, e.g. workflow='...'.
+    """
+    token = _context_labels.set({**_context_labels.get(), **{key: str(value) for key, value in labels.items()}})
+    try:
+        yield
+    finally:
+        _context_labels.reset(token)
+
+
+@contextmanager
+def timed_step(step: str):
+    """
+    Measures the wall time of an orchestrator step, including its retries.
+
+    Parameters:
+    - step (str): The name of the step.
+    """
+    start = time.time()
+    status = 'ok'
+    try:
+        yield
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        seconds = time.time() - start
+        metric_totals['steps'][step] = seconds
+        record_event('step', step=step, seconds=round(seconds, 3), status=status, retries=metric_totals['retries'].get(step, 0))
+        write_prometheus_textfile()
+
+
+def record_retry(step: str, error: Exception) -> None:
+    """
+    Counts a failed attempt of a step that is about to be retried.
+
+    Parameters:
+    - step (str): The name of the step.
+    - error (Exception): The error of the failed attempt.
+    """
+    metric_totals['retries'][step] = metric_totals['retries'].get(step, 0) + 1
+    record_event('retry', step=step, attempt=metric_totals['retries'][step], error=f"{type(error).__name__}: {error}")
+
+
+def record_transfer(kind: str, files: int, bytes: int, seconds: float, **fields) -> None:
+    """
+    Records the size and throughput of a transfer.
+
+    Parameters:
+    - kind (str): The transfer method and direction, e.g. 'rsync_send', 'rsync_get' or 'xnat_download'.
+    - files (int): The number of files transferred.
+    - bytes (int): The number of bytes moved.
+    - seconds (float): The wall time of the transfer.
+    - fields: Additional details, e.g. the number of shards.
+    """
+    totals = metric_totals['transfers'].setdefault(kind, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+    totals['files'] += files
+    totals['bytes'] += bytes
+    totals['seconds'] += seconds
+    throughput = bytes / seconds if seconds > 0 else 0.0
+    record_event('transfer', kind=kind, files=files, bytes=bytes, seconds=round(seconds, 3), bytes_per_second=round(throughput, 1), **fields)
+
+
+def record_job_timing(timing: Dict) -> None:
+    """
+    Records how long a SLURM job waited in the queue and ran.
+
+    Parameters:
+    - timing (Dict): The timing returned by get_job_timing.
+    """
+    metric_totals['job'].update({key: value for key, value in timing.items() if value is not None})
+    record_event('job', **timing)
+    write_prometheus_textfile()
+
+
+def _labels(**extra: str) -> str:
+    """Formats the run labels plus extra labels in the Prometheus exposition format."""
+    labels = {**metric_labels, **extra}
+    escaped = [f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in labels.items()]
+    return '{' + ','.join(escaped) + '}' if escaped else ''
+
+
+def write_prometheus_textfile(path: Optional[str] = None) -> None:
+    """
+    Writes the totals of the current process for the node exporter textfile collector.
+    The file is replaced atomically so the collector never reads a partial file.
+
+    Parameters:
+    - path (Optional[str]): The .prom file to write. Defaults to the configured textfile, if any.
+    """
+    path = path or _settings['textfile']
+    if not path:
+        return
+
+    lines = [
+        '# HELP fmriprep_step_duration_seconds Wall time of each orchestrator step, including retries.',
+        '# TYPE fmriprep_step_duration_seconds gauge',
+    ]
+    lines += [f"fmriprep_step_duration_seconds{_labels(step=step)} {seconds:.3f}" for step, seconds in metric_totals['steps'].items()]
+    lines += [
+        '# HELP fmriprep_step_retries_total Failed attempts of each orchestrator step.',
+        '# TYPE fmriprep_step_retries_total counter',
+    ]
+    lines += [f"fmriprep_step_retries_total{_labels(step=step)} {count}" for step, count in metric_totals['retries'].items()]
+    lines += [
+        '# HELP fmriprep_transfer_bytes_total Bytes moved by each transfer method.',
+        '# TYPE fmriprep_transfer_bytes_total counter',
+    ]
+    lines += [f"fmriprep_transfer_bytes_total{_labels(kind=kind)} {totals['bytes']}" for kind, totals in metric_totals['transfers'].items()]
+    lines += [
+        '# HELP fmriprep_transfer_seconds_total Wall time spent in each transfer method.',
+        '# TYPE fmriprep_transfer_seconds_total counter',
+    ]
+    lines += [f"fmriprep_transfer_seconds_total{_labels(kind=kind)} {totals['seconds']:.3f}" for kind, totals in metric_totals['transfers'].items()]
+    for key, description in (('queue_wait_seconds', 'Time the SLURM job waited in the queue.'), ('run_seconds', 'Time the SLURM job ran.')):
+        if key in metric_totals['job']:
+            lines += [f"# HELP fmriprep_job_{key} {description}", f"# TYPE fmriprep_job_{key} gauge",
+                      f"fmriprep_job_{key}{_labels()} {metric_totals['job'][key]}"]
+
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Could not write Prometheus textfile {path}: {str(e)}")
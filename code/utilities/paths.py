@@ -0,0 +1,10 @@
+import os
+
+# Local directories of the container, shared by every entry point. They can be overridden to run the orchestrator
+# outside of it, e.g. in the benchmarks, or to keep the staging directory on persistent storage.
+input_dir = os.getenv('FMRIPREP_INPUT_DIR', '/input')
+staging_dir = os.getenv('FMRIPREP_STAGING_DIR', '/app')
+fmriprep_output_dir = os.getenv('FMRIPREP_OUTPUT_DIR', '/fmriprep')
+freesurfer_output_dir = os.getenv('FREESURFER_OUTPUT_DIR', '/freesurfer')
+log_dir = os.getenv('FMRIPREP_LOG_DIR', '/temp_files')
+license_path = os.getenv('FS_LICENSE_PATH', '/opt/fs')
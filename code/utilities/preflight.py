@@ -0,0 +1,199 @@
+import os
+import shlex
+from typing import Dict, List, Optional, Tuple
+
+from paramiko.client import SSHClient
+
+from .job import OUTPUT_SPACES, SINGULARITY_IMAGE, TEMPLATEFLOW_HOME
+from .remote import RemoteShell
+from .retry import FatalError
+
+# Expected SHA-256 of the fMRIPrep image. When unset, the checksum recorded on first use is the reference
+default_image_sha256 = os.getenv('FMRIPREP_IMAGE_SHA256')
+
+# Output spaces that are not TemplateFlow templates
+nonstandard_spaces = {'T1w', 'T2w', 'anat', 'fsnative', 'func', 'run', 'bold', 'boldref', 'sbref'}
+
+# Legacy FreeSurfer space names and the fsaverage density they stand for
+fsaverage_densities = {'fsaverage5': '10k', 'fsaverage6': '41k', 'fsaverage': '164k'}
+
+# Templates fMRIPrep always uses: brain extraction and the MNI registration behind the carpet plot
+base_templates = [('OASIS30ANTs', {'resolution': 1}), ('MNI152NLin2009cAsym', {'resolution': 1}), ('MNI152NLin2009cAsym', {'resolution': 2})]
+
+
+def _flag_values(flags: List[str], names: Tuple[str, ...]) -> Optional[List[str]]:
+    """Returns the values following the last of the given flags, or None if none of them is present."""
+    values = None
+    for index, flag in enumerate(flags):
+        if flag in names:
+            values = []
+            for value in flags[index + 1:]:
+                if value.startswith('-'):
+                    break
+                values.append(value)
+    return values
+
+
+def required_templates(flags: str = '') -> List[Tuple[str, Dict]]:
+    """
+    Works out the TemplateFlow templates a run needs from its output spaces and flags.
+
+    Parameters:
+    - flags (str): The additional fMRIPrep flags of the run. Their --output-spaces replace the default spaces.
+
+    Returns:
+    - List[Tuple[str, Dict]]: The template names with the TemplateFlow query (resolution or density) to fetch.
+    """
+    # --output-spaces=<space> is split like --output-spaces <space>, as fMRIPrep's argparse reads both
+    flags = [part for flag in (flags.split() if flags else []) for part in (flag.split('=', 1) if flag.startswith('--') else [flag])]
+    spaces = _flag_values(flags, ('--output-spaces', '--output-space')) or OUTPUT_SPACES
+
+    templates = list(base_templates)
+    for space in spaces:
+        name, *specs = space.split(':')
+        entities = dict(spec.split('-', 1) for spec in specs if '-' in spec)
+        if name in nonstandard_spaces:
+            continue
+        if name in fsaverage_densities:
+            templates.append(('fsaverage', {'density': entities.get('den', fsaverage_densities[name])}))
+            continue
+        if name == 'fsLR':
+            templates.append((name, {'density': entities.get('den', '32k')}))
+            continue
+        query = {'resolution': 1 if entities.get('res', 'native') == 'native' else int(entities['res'])}
+        if 'cohort' in entities:
+            query['cohort'] = entities['cohort']
+        templates.append((name, query))
+
+    cifti = _flag_values(flags, ('--cifti-output',))
+    if cifti is not None:
+        grayordinates = cifti[0] if cifti else '91k'
+        templates += [
+            ('MNI152NLin6Asym', {'resolution': 2 if grayordinates == '91k' else 1}),
+            ('fsLR', {'density': '32k' if grayordinates == '91k' else '59k'}),
+            ('fsaverage', {'density': '164k'}),
+        ]
+
+    unique = []
+    for template in templates:
+        if template not in unique:
+            unique.append(template)
+    return unique
+
+
+def _marker(template: str, query: Dict) -> str:
+    """The file recording that a template query was fetched completely."""
+    key = '_'.join(f"{name}-{value}" for name, value in sorted(query.items()))
+    return f"{TEMPLATEFLOW_HOME}/.preflight/{template}_{key}"
+
+
+def _fetch_command(templates: List[Tuple[str, Dict]], image: str) -> str:
+    """
+    Builds the command fetching missing templates with the TemplateFlow client of the fMRIPrep image, holding a lock
+    so concurrent workflows fetch each template once. Templates fetched while waiting for the lock are skipped.
+    """
+    directory = shlex.quote(f"{TEMPLATEFLOW_HOME}/.preflight")
+    lines = [f"mkdir -p {directory} && exec 9>{directory}/lock && flock 9 || exit 1"]
+    for template, query in templates:
+        code = (f"import templateflow.api as tf; "
+                f"files = tf.get({template!r}, **{query!r}); "
+                f"assert files, {f'no files for {template}'!r}")
+        lines.append(
+            f"[ -f {shlex.quote(_marker(template, query))} ] || {{ "
+            f"singularity exec --cleanenv -B {shlex.quote(TEMPLATEFLOW_HOME)} {shlex.quote(image)} python -c {shlex.quote(code)} "
+            f"&& touch {shlex.quote(_marker(template, query))} || exit 1; "
+            f"echo {shlex.quote(f'Fetched {template} {query}')}; }}"
+        )
+    return '\n'.join(lines)
+
+
+def prepare_templates(client: SSHClient, flags: str = '', image: str = SINGULARITY_IMAGE) -> None:
+    """
+    Makes sure the shared TemplateFlow cache holds every template the run needs, so jobs never download templates
+    on compute nodes. Present templates cost one round-trip; missing ones are fetched once, on the login node.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - flags (str): The additional fMRIPrep flags of the run.
+    - image (str): The fMRIPrep image whose TemplateFlow client fetches the templates.
+
+    Raises:
+    - Exception: If a template cannot be fetched.
+    """
+    templates = required_templates(flags)
+    present = RemoteShell(client).run([f"test -f {shlex.quote(_marker(template, query))}" for template, query in templates])
+    missing = [template for template, result in zip(templates, present) if not result.ok]
+    if not missing:
+        print(f"TemplateFlow cache has all {len(templates)} required templates")
+        return
+
+    print(f"Fetching {len(missing)} missing template(s) into {TEMPLATEFLOW_HOME}: {', '.join(name for name, _ in missing)}")
+    command = (
+        "command -v singularity > /dev/null || { source /etc/profile > /dev/null 2>&1; module load singularity; }\n"
+        f"export SINGULARITYENV_TEMPLATEFLOW_HOME={shlex.quote(TEMPLATEFLOW_HOME)}\n"
+        f"{_fetch_command(missing, image)}"
+    )
+    result = RemoteShell(client).run([command])[0]
+    if not result.ok:
+        raise Exception(f"Could not fetch the TemplateFlow templates: {result.stderr.strip()}")
+    print(result.stdout.strip() or "Another workflow fetched the templates while this one waited for the lock")
+
+
+def verify_image(client: SSHClient, image: str = SINGULARITY_IMAGE, expected_sha256: Optional[str] = default_image_sha256) -> None:
+    """
+    Verifies the checksum of the fMRIPrep image once per image version rather than per job. The checksum is kept
+    next to the image with the size and modification time it was computed for, and only recomputed when they change.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - image (str): The path of the image on the cluster.
+    - expected_sha256 (Optional[str]): The expected checksum. Default is FMRIPREP_IMAGE_SHA256, or the checksum
+      recorded the first time the image was verified.
+
+    Raises:
+    - Exception: If the image cannot be read.
+    - FatalError: If the checksum does not match the expected one.
+    """
+    quoted = shlex.quote(image)
+    record_path = shlex.quote(f"{image}.sha256")
+    stat, record = RemoteShell(client).run([f"stat -c '%s %Y' {quoted}", f"cat {record_path}"])
+    if not stat.ok:
+        raise Exception(f"Could not read the fMRIPrep image {image}: {stat.stderr.strip()}")
+
+    recorded = record.stdout.split() if record.ok else []
+    recorded_sha256 = recorded[0] if recorded else None
+    reference = expected_sha256 or recorded_sha256
+    if recorded[1:] == stat.stdout.split() and recorded_sha256 == reference:
+        print(f"fMRIPrep image {os.path.basename(image)} already verified")
+        return
+
+    # Hash and record under a lock so concurrent workflows hash a new image once and reuse a record written meanwhile.
+    # The record is only written when the checksum matches the reference, so a corrupt image is never recorded.
+    result = RemoteShell(client).run([
+        f"exec 9>{record_path}.lock && flock 9 || exit 1; "
+        f"current=$(stat -c '%s %Y' {quoted}) || exit 1; "
+        f"if [ \"$(cut -d' ' -f2- {record_path} 2>/dev/null)\" = \"$current\" ]; then cut -d' ' -f1 {record_path}; exit 0; fi; "
+        f"sha256=$(sha256sum {quoted} | cut -d' ' -f1) && [ -n \"$sha256\" ] || exit 1; "
+        f"echo \"$sha256\"; "
+        f"if [ -z {shlex.quote(reference or '')} ] || [ \"$sha256\" = {shlex.quote(reference or '')} ]; then "
+        f"echo \"$sha256 $current\" > {record_path}.tmp && mv {record_path}.tmp {record_path}; fi"
+    ], check=True)[0]
+    sha256 = result.stdout.split()[0]
+
+    if reference is not None and sha256 != reference:
+        raise FatalError(f"Checksum of {image} is {sha256}, expected {reference}. The image is corrupt or was replaced; "
+                         f"restore it, or remove {image}.sha256 if the replacement is intended.")
+
+    print(f"Verified fMRIPrep image {os.path.basename(image)}: sha256 {sha256}")
+
+
+def prepare_shared_cache(client: SSHClient, flags: str = '') -> None:
+    """
+    Pre-flight check run before sbatch: verifies the fMRIPrep image and fills the shared TemplateFlow cache.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - flags (str): The additional fMRIPrep flags of the run.
+    """
+    verify_image(client)
+    prepare_templates(client, flags)
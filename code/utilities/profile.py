@@ -0,0 +1,167 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from paramiko.client import SSHClient
+
+from .metrics import record_event
+from .sizing import _elapsed_seconds, _memory_mb
+
+# Number of nipype nodes listed in the hotspot tables
+default_top_nodes = int(os.getenv('PROFILE_TOP_NODES', 10))
+
+# Run with the fMRIPrep image's python after fMRIPrep exits: reads the result file nipype writes in the directory
+# of every node and summarizes the nodes this job ran. Nodes reused from the cache of an earlier run are older than
+# the job and left out. Peak memory and CPU use are only recorded when fMRIPrep ran with --resource-monitor.
+NODE_PROFILE_SCRIPT = r'''
+import json
+import os
+import sys
+
+from nipype.utils.filemanip import loadpkl
+
+work_dir, since, output, top = sys.argv[1], float(sys.argv[2]), sys.argv[3], int(sys.argv[4])
+
+
+def value(runtime, name):
+    return getattr(runtime, name, None) if runtime is not None else None
+
+
+nodes = []
+for root, dirs, files in os.walk(work_dir):
+    for name in files:
+        path = os.path.join(root, name)
+        if not (name.startswith('result_') and name.endswith('.pklz')) or os.path.getmtime(path) < since:
+            continue
+        try:
+            runtimes = loadpkl(path).runtime
+        except Exception:
+            continue
+        # A MapNode has one runtime per iteration
+        runtimes = [runtime for runtime in (runtimes if isinstance(runtimes, list) else [runtimes]) if runtime is not None]
+        if not runtimes:
+            continue
+        durations = [value(runtime, 'duration') or 0.0 for runtime in runtimes]
+        memory = [value(runtime, 'mem_peak_gb') for runtime in runtimes if value(runtime, 'mem_peak_gb') is not None]
+        cpu = [value(runtime, 'cpu_percent') for runtime in runtimes if value(runtime, 'cpu_percent') is not None]
+        nodes.append({
+            'node': os.path.relpath(root, work_dir).replace(os.sep, '.'),
+            'seconds': round(sum(durations), 1),
+            'peak_memory_gb': round(max(memory), 2) if memory else None,
+            'cpu_percent': round(max(cpu), 1) if cpu else None,
+        })
+
+nodes.sort(key=lambda node: node['seconds'], reverse=True)
+with open(output, 'w') as f:
+    json.dump(nodes, f)
+
+print(f"Top {min(top, len(nodes))} of {len(nodes)} nipype nodes by runtime:")
+print(f"{'seconds':>9} {'peak GB':>8} {'CPU %':>7}  node")
+for node in nodes[:top]:
+    memory = f"{node['peak_memory_gb']:.2f}" if node['peak_memory_gb'] is not None else '-'
+    cpu = f"{node['cpu_percent']:.0f}" if node['cpu_percent'] is not None else '-'
+    print(f"{node['seconds']:>9.0f} {memory:>8} {cpu:>7}  {node['node']}")
+'''
+
+
+def get_job_usage(client: SSHClient, job_id: str) -> Dict[str, Optional[float]]:
+    """
+    Reads the resources a finished job used from its sacct record.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - job_id (str): The job ID to query.
+
+    Returns:
+    - Dict[str, Optional[float]]: 'elapsed_seconds', 'total_cpu_seconds' and 'cpus' of the allocation, the
+      'max_rss_gb' of its largest step and the 'cpu_efficiency', the share of the allocated core time that was
+      used. A value is None when sacct does not report it.
+    """
+    stdin, stdout, stderr = client.exec_command(f"/opt/slurm/default/bin/sacct -j {job_id} -n -P -o JobID,Elapsed,TotalCPU,MaxRSS,AllocCPUS")
+    usage: Dict[str, Optional[float]] = {'elapsed_seconds': None, 'total_cpu_seconds': None, 'cpus': None, 'max_rss_gb': None, 'cpu_efficiency': None}
+
+    for line in stdout.read().decode('utf-8').splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 5:
+            continue
+        try:
+            if '.' not in fields[0] and usage['elapsed_seconds'] is None:
+                # The allocation line, its TotalCPU adds up every step
+                usage['elapsed_seconds'] = float(_elapsed_seconds(fields[1]))
+                usage['total_cpu_seconds'] = float(_elapsed_seconds(fields[2]))
+                usage['cpus'] = float(fields[4]) if fields[4] else None
+        except ValueError:
+            pass
+        # MaxRSS is only reported on the steps
+        rss = _memory_mb(fields[3]) if fields[3] else None
+        if rss:
+            usage['max_rss_gb'] = round(max(usage['max_rss_gb'] or 0.0, rss / 1024), 2)
+
+    if usage['elapsed_seconds'] and usage['cpus'] and usage['total_cpu_seconds'] is not None:
+        usage['cpu_efficiency'] = round(usage['total_cpu_seconds'] / (usage['elapsed_seconds'] * usage['cpus']), 3)
+    return usage
+
+
+def read_node_profile(client: SSHClient, profile_path: str) -> Optional[List[Dict]]:
+    """
+    Reads the per-node summary written by NODE_PROFILE_SCRIPT in the job.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - profile_path (str): The remote path of node_profile.json.
+
+    Returns:
+    - Optional[List[Dict]]: The nodes with their 'node' name, 'seconds', 'peak_memory_gb' and 'cpu_percent',
+      slowest first, or None if the job wrote no profile.
+    """
+    stdin, stdout, stderr = client.exec_command(f"cat {profile_path}")
+    content = stdout.read().decode('utf-8')
+    if stdout.channel.recv_exit_status() != 0:
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
+
+
+def write_profile_report(client: SSHClient, job_id: str, profile_path: str, output_path: str, top: int = default_top_nodes) -> Dict:
+    """
+    Combines the nipype node profile of a job with its sacct usage, writes the report as JSON and prints the job
+    usage. The table of the slowest nodes is printed by the job itself, in the log read by print_log.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - job_id (str): The job that ran fMRIPrep.
+    - profile_path (str): The remote path of the node_profile.json written by the job.
+    - output_path (str): The local path of the JSON report.
+    - top (int): The number of nodes listed under 'top'. Default is PROFILE_TOP_NODES or 10.
+
+    Returns:
+    - Dict: The report, with the 'job' usage, the 'nodes' and the 'top' nodes.
+    """
+    usage = get_job_usage(client=client, job_id=job_id)
+    nodes = read_node_profile(client=client, profile_path=profile_path) or []
+    report = {
+        'job_id': job_id,
+        'job': usage,
+        'node_count': len(nodes),
+        'node_seconds': round(sum(node['seconds'] for node in nodes), 1),
+        'top': nodes[:top],
+        'nodes': nodes,
+    }
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    record_event('profile', job_id=job_id, nodes=len(nodes), **usage)
+
+    def show(value: Optional[float], unit: str = '', scale: float = 1.0) -> str:
+        return f"{value * scale:.1f}{unit}" if value is not None else '-'
+
+    print(f"Job {job_id} used {show(usage['total_cpu_seconds'], ' core-h', 1 / 3600)} of {show(usage['cpus'], ' cores')} "
+          f"over {show(usage['elapsed_seconds'], ' h', 1 / 3600)} (CPU efficiency {show(usage['cpu_efficiency'], '%', 100)}), "
+          f"peak memory {show(usage['max_rss_gb'], ' GB')}")
+    if not nodes:
+        print("No nipype node profile was written by the job")
+    print(f"Profile written to {output_path}")
+    return report
@@ -0,0 +1,131 @@
+import shlex
+import uuid
+from dataclasses import dataclass
+from typing import List
+
+from paramiko.client import SSHClient
+
+
+@dataclass
+class RemoteResult:
+    """Outcome of one operation run by RemoteShell."""
+    command: str
+    exit_status: int
+    stdout: str
+    stderr: str
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_status == 0
+
+
+class RemoteShell:
+    """
+    Runs several shell operations on the cluster in a single round-trip. Each operation runs in its own subshell,
+    whatever the outcome of the previous ones, and reports its own exit status, stdout and stderr.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    """
+
+    def __init__(self, client: SSHClient):
+        self.client = client
+
+    def run(self, commands: List[str], check: bool = False) -> List[RemoteResult]:
+        """
+        Runs the operations and waits for all of them to finish.
+
+        Parameters:
+        - commands (List[str]): The shell commands to run, in order.
+        - check (bool): Whether to raise if any operation fails. Default is False.
+
+        Returns:
+        - List[RemoteResult]: One result per command, in the same order.
+
+        Raises:
+        - Exception: If the batch could not run, or if check is set and an operation failed.
+        """
+        if not commands:
+            return []
+
+        # Outputs are collected in files and printed with their sizes, so any content can be split back reliably
+        token = f"__result_{uuid.uuid4().hex}__"
+        lines = ['__batch=$(mktemp -d) || exit 1']
+        for index, command in enumerate(commands):
+            lines.append(f"(\n{command}\n) > \"$__batch/{index}.out\" 2> \"$__batch/{index}.err\" < /dev/null; echo $? > \"$__batch/{index}.rc\"")
+        lines.append(
+            f"for i in $(seq 0 {len(commands) - 1}); do "
+            f"printf '{token} %s %s %s %s\\n' \"$i\" \"$(cat \"$__batch/$i.rc\")\" \"$(wc -c < \"$__batch/$i.out\")\" \"$(wc -c < \"$__batch/$i.err\")\"; "
+            f"cat \"$__batch/$i.out\" \"$__batch/$i.err\"; done"
+        )
+        lines.append('rm -rf "$__batch"')
+
+        stdin, stdout, stderr = self.client.exec_command('\n'.join(lines))
+        output = stdout.read()
+        exit_status = stdout.channel.recv_exit_status()
+
+        results = []
+        marker = token.encode('utf-8')
+        position = output.find(marker)
+        while position >= 0 and len(results) < len(commands):
+            header_end = output.index(b'\n', position)
+            _, index, status, out_size, err_size = output[position:header_end].decode('utf-8').split()
+            start = header_end + 1
+            out_end = start + int(out_size)
+            err_end = out_end + int(err_size)
+            results.append(RemoteResult(
+                command=commands[int(index)],
+                exit_status=int(status),
+                stdout=output[start:out_end].decode('utf-8', errors='replace'),
+                stderr=output[out_end:err_end].decode('utf-8', errors='replace'),
+            ))
+            position = output.find(marker, err_end)
+
+        if len(results) != len(commands):
+            raise Exception(f"Remote batch failed with exit status {exit_status}: {stderr.read().decode('utf-8').strip()}")
+
+        if check:
+            failed = [result for result in results if not result.ok]
+            if failed:
+                raise Exception('; '.join(f"'{result.command}' failed with exit status {result.exit_status}: {result.stderr.strip()}" for result in failed))
+
+        return results
+
+
+def delete_command(path: str, background: bool = False) -> str:
+    """
+    Builds the shell command deleting a file or directory, printing 'directory' or 'file' if something was removed.
+
+    Parameters:
+    - path (str): The remote path to delete.
+    - background (bool): Whether to move the path aside at once and remove it in a detached process, so large
+      trees do not block the caller and the path can be reused immediately. Default is False.
+
+    Returns:
+    - str: The shell command.
+    """
+    quoted = shlex.quote(path)
+    if background:
+        trash = shlex.quote(f"{path.rstrip('/')}.deleting-{uuid.uuid4().hex[:8]}")
+        remove = f"mv {quoted} {trash} && (setsid nohup rm -rf {trash} < /dev/null > /dev/null 2>&1 &)"
+    else:
+        remove = f"rm -rf {quoted}"
+    return (f"if [ -d {quoted} ] && [ ! -L {quoted} ]; then {remove} && echo directory; "
+            f"elif [ -e {quoted} ] || [ -L {quoted} ]; then rm -f {quoted} && echo file; fi")
+
+
+def deferred_stderr_command(command: str, tail_bytes: int = 4096) -> str:
+    """
+    Wraps a command streaming through an SSH channel so its stderr is kept in a temporary file and only its end is
+    written to the channel once the command exits. Stderr nobody reads while the stream flows would fill the
+    channel window and stop the command, and with it the transfer.
+
+    Parameters:
+    - command (str): The shell command.
+    - tail_bytes (int): How much of the end of stderr is reported. Default is 4096.
+
+    Returns:
+    - str: The shell command, exiting with the status of the wrapped one.
+    """
+    return (f"__stderr=$(mktemp) || exit 1; ( {command} ) 2> \"$__stderr\"; __status=$?; "
+            f"tail -c {int(tail_bytes)} \"$__stderr\" >&2; rm -f \"$__stderr\"; exit $__status")
@@ -0,0 +1,166 @@
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Tuple, Type
+
+from paramiko.ssh_exception import AuthenticationException, NoValidConnectionsError, SSHException
+from requests.exceptions import ConnectionError as HTTPConnectionError, Timeout as HTTPTimeout
+
+from .metrics import record_event, record_retry
+
+
+class FatalError(Exception):
+    """An error retrying cannot fix, e.g. a missing input or a job the scheduler rejects."""
+
+
+# Errors that fail a step at once. SystemExit and KeyboardInterrupt are not Exceptions and are never retried either.
+default_fatal_errors: Tuple[Type[BaseException], ...] = (FatalError, AuthenticationException)
+# Seconds between checks of an open breaker, so waiting calls resume soon after a successful trial
+breaker_poll_interval = 30
+# Errors meaning the remote service is unreachable, which count towards opening its circuit breaker
+outage_errors: Tuple[Type[BaseException], ...] = (ConnectionError, socket.timeout, socket.gaierror, EOFError, SSHException, NoValidConnectionsError,
+                                                   HTTPConnectionError, HTTPTimeout)
+
+
+class CircuitBreaker:
+    """
+    Stops every step depending on one service (the cluster or XNAT) from retrying while it is down.
+    After `threshold` consecutive outage errors the breaker opens and calls wait `reset_timeout` seconds;
+    then a single trial call goes through, closing the breaker on success or opening it again on failure.
+    A breaker is shared by the steps, and in the service by the workflows, that use the same service.
+    """
+
+    def __init__(self, name: str, threshold: int = 3, reset_timeout: float = 300):
+        """
+        Parameters:
+        - name (str): The service, e.g. 'cluster' or 'xnat', used in messages and metrics.
+        - threshold (int): Consecutive outage errors that open the breaker. Default is 3.
+        - reset_timeout (float): Seconds the breaker stays open before a trial call. Default is 300.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        """Returns the seconds to wait before calling the service, 0 when the breaker is closed or the caller makes the trial call."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            remaining = self.opened_at + self.reset_timeout - time.time()
+            if remaining > 0:
+                return remaining
+            # This caller makes the trial call, the others wait for its outcome
+            self.opened_at = time.time()
+            return 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                print(f"{self.name} is reachable again, closing its circuit breaker")
+                record_event('circuit', service=self.name, state='closed')
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"{self.name} looks unreachable after {self.failures} failures, pausing calls for {self.reset_timeout:.0f}s")
+                    record_event('circuit', service=self.name, state='open')
+                # A failed trial call opens the breaker for another period
+                self.opened_at = time.time()
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How a step is retried: a bounded number of attempts with exponentially growing, jittered delays.
+    Fatal errors fail the step at once, and errors reaching an open circuit breaker wait for the service instead
+    of using up attempts.
+    """
+    # Attempts before the step fails, None retries forever
+    max_attempts: Optional[int] = 5
+    # Delay after the first failure, multiplied by backoff after each further failure, up to max_delay
+    base_delay: float = 20
+    backoff: float = 2.0
+    max_delay: float = 600
+    # Fraction of each delay that is randomized, so workflows failing together do not retry together
+    jitter: float = 0.5
+    fatal_errors: Tuple[Type[BaseException], ...] = default_fatal_errors
+    breaker: Optional[CircuitBreaker] = field(default=None, repr=False)
+
+    def delay(self, attempt: int) -> float:
+        """
+        Parameters:
+        - attempt (int): The number of failed attempts so far, starting at 1.
+
+        Returns:
+        - float: The seconds to wait before the next attempt.
+        """
+        delay = min(self.base_delay * self.backoff ** (attempt - 1), self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+    def is_fatal(self, error: BaseException) -> bool:
+        return isinstance(error, self.fatal_errors)
+
+    def is_outage(self, error: BaseException) -> bool:
+        """Tells whether the error counts towards opening the breaker of the policy."""
+        return self.breaker is not None and isinstance(error, outage_errors)
+
+
+def run_with_retry(func: Callable[..., Any], policy: RetryPolicy, name: Optional[str] = None) -> Any:
+    """
+    Runs a step under a retry policy.
+
+    Parameters:
+    - func (Callable[..., Any]): The step, called without arguments.
+    - policy (RetryPolicy): How failures of the step are retried.
+    - name (Optional[str]): The name used in messages and metrics. Defaults to the function name.
+
+    Returns:
+    - Any: The return value of the step.
+
+    Raises:
+    - Exception: The error of the last attempt, if it is fatal or no attempts are left.
+    """
+    name = name or getattr(func, '__name__', str(func))
+    attempt = 0
+    while True:
+        if policy.breaker is not None:
+            wait = policy.breaker.wait_time()
+            if wait > 0:
+                print(f"Waiting up to {wait:.0f}s for {policy.breaker.name} before running {name}")
+            while wait > 0:
+                time.sleep(min(wait, breaker_poll_interval))
+                wait = policy.breaker.wait_time()
+
+        try:
+            result = func()
+        except Exception as e:
+            if policy.is_fatal(e):
+                print(f"{name} failed with an error that retrying cannot fix: {str(e)}")
+                raise
+            if policy.is_outage(e):
+                policy.breaker.record_failure()
+                if policy.breaker.wait_time() > 0:
+                    # The service is down: wait for it instead of using up attempts
+                    record_retry(name, e)
+                    continue
+            attempt += 1
+            if policy.max_attempts is not None and attempt >= policy.max_attempts:
+                print(f"{name} failed {attempt} times, giving up: {str(e)}")
+                raise
+            record_retry(name, e)
+            delay = policy.delay(attempt)
+            print(f"{name} failed (attempt {attempt}), retrying in {delay:.0f}s: {str(e)}")
+            time.sleep(delay)
+        else:
+            if policy.breaker is not None:
+                policy.breaker.record_success()
+            return result
@@ -0,0 +1,130 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from .state import persistent_dir
+
+# Default location of the label -> experiment ID index, shared by every run on this host
+default_index_path = os.getenv('XNAT_SESSION_INDEX', os.path.join(persistent_dir, 'cache', 'xnat_session_index.json'))
+# Default number of seconds an index entry stays valid
+default_index_ttl = int(os.getenv('XNAT_SESSION_INDEX_TTL', 24 * 60 * 60))
+
+
+@contextmanager
+def _locked_index(index_path: str):
+    """
+    Opens the on-disk index under an exclusive lock so concurrent runs do not overwrite each other.
+
+    Parameters:
+    - index_path (str): The path of the JSON index file.
+
+    Yields:
+    - Dict: The index content. Changes made to it are written back atomically when the block exits.
+    """
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(f"{index_path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = {}
+
+            yield index
+
+            temp_path = f"{index_path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(temp_path, index_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def query_experiment_id(connection, project: str, label: str) -> Optional[str]:
+    """
+    Looks up the XNAT ID of an experiment with a single label-filtered query.
+
+    Parameters:
+    - connection: An open xnat session.
+    - project (str): The project ID.
+    - label (str): The label of the experiment (session).
+
+    Returns:
+    - Optional[str]: The experiment ID if found, otherwise None.
+    """
+    result = connection.get_json(
+        f"/data/projects/{project}/experiments",
+        query={'label': label, 'columns': 'ID,label', 'format': 'json'}
+    )
+    for row in result['ResultSet']['Result']:
+        if row.get('label') == label:
+            return row['ID']
+    return None
+
+
+def lookup_experiment_id(connection, project: str, label: str, index_path: str = default_index_path, ttl: int = default_index_ttl, refresh: bool = False) -> Optional[str]:
+    """
+    Resolves an experiment label to its XNAT ID, using the on-disk index before querying XNAT.
+
+    Parameters:
+    - connection: An open xnat session.
+    - project (str): The project ID.
+    - label (str): The label of the experiment (session).
+    - index_path (str): The path of the JSON index file.
+    - ttl (int): The number of seconds an index entry stays valid.
+    - refresh (bool): If True, ignore the cached entry and query XNAT again.
+
+    Returns:
+    - Optional[str]: The experiment ID if found, otherwise None.
+    """
+    key = f"{project}/{label}"
+
+    with _locked_index(index_path) as index:
+        entry: Dict = index.get(key)
+        if not refresh and entry and time.time() - entry['time'] < ttl:
+            return entry['id']
+
+        experiment_id = query_experiment_id(connection, project, label)
+        if experiment_id is None:
+            index.pop(key, None)
+        else:
+            index[key] = {'id': experiment_id, 'time': time.time()}
+
+        # Drop expired entries so the index does not grow forever
+        now = time.time()
+        for stale_key in [k for k, v in index.items() if now - v['time'] >= ttl]:
+            del index[stale_key]
+
+        return experiment_id
+
+
+def find_experiment(connection, project: str, label: str, index_path: str = default_index_path, ttl: int = default_index_ttl):
+    """
+    Returns the XNAT experiment object of a session without listing the experiments of the whole project.
+
+    Parameters:
+    - connection: An open xnat session.
+    - project (str): The project ID.
+    - label (str): The label of the experiment (session).
+    - index_path (str): The path of the JSON index file.
+    - ttl (int): The number of seconds an index entry stays valid.
+
+    Returns:
+    - The experiment object if found, otherwise None.
+    """
+    experiment_id = lookup_experiment_id(connection, project, label, index_path=index_path, ttl=ttl)
+    if experiment_id is None:
+        return None
+
+    try:
+        return connection.create_object(f"/data/experiments/{experiment_id}")
+    except Exception:
+        # The cached ID may point to a deleted or moved experiment, query XNAT again
+        experiment_id = lookup_experiment_id(connection, project, label, index_path=index_path, ttl=ttl, refresh=True)
+        if experiment_id is None:
+            return None
+        return connection.create_object(f"/data/experiments/{experiment_id}")
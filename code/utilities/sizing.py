@@ -0,0 +1,330 @@
+import gzip
+import math
+import os
+import re
+import struct
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from paramiko.client import SSHClient
+
+# Job name given to every generated script, used to find past runs in the accounting database
+job_name = 'fmriprep'
+
+# Largest allocation sessions are packed into, see pack_sessions
+default_pack_cpus = int(os.getenv('PACK_NODE_CPUS', 32))
+default_pack_mem_gb = int(os.getenv('PACK_NODE_MEM_GB', 128))
+
+
+@dataclass
+class JobResources:
+    """SLURM allocation and fMRIPrep thread settings of a job."""
+    cpus: int = 16
+    walltime_hours: int = 16
+    mem_gb: Optional[int] = None
+    omp_nthreads: Optional[int] = None
+
+    @property
+    def walltime(self) -> str:
+        return f"{self.walltime_hours}:00:00"
+
+    @property
+    def mem_mb(self) -> Optional[int]:
+        return self.mem_gb * 1024 if self.mem_gb is not None else None
+
+
+def read_nifti_shape(path: str) -> Tuple[int, ...]:
+    """
+    Reads the image dimensions from a NIfTI-1 or NIfTI-2 header without loading the data.
+
+    Parameters:
+    - path (str): The path of a .nii or .nii.gz file.
+
+    Returns:
+    - Tuple[int, ...]: The size of each dimension, e.g. (97, 115, 97, 300) for a BOLD run.
+
+    Raises:
+    - ValueError: If the file is not a NIfTI image.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        header = f.read(540)
+
+    for endian in ('<', '>'):
+        sizeof_hdr = struct.unpack(f"{endian}i", header[:4])[0]
+        if sizeof_hdr == 348:
+            dim = struct.unpack(f"{endian}8h", header[40:56])
+            break
+        if sizeof_hdr == 540:
+            dim = struct.unpack(f"{endian}8q", header[16:80])
+            break
+    else:
+        raise ValueError(f"{path} is not a NIfTI image")
+
+    return tuple(int(d) for d in dim[1:1 + max(1, min(dim[0], 7))])
+
+
+def summarize_inputs(input_dir: str) -> Dict:
+    """
+    Describes the BIDS input of a session from its NIfTI headers.
+
+    Parameters:
+    - input_dir (str): The local BIDS directory.
+
+    Returns:
+    - Dict: The number of 'bold_runs' and 'anat_images', the total 'bold_voxels' (voxels x volumes over all runs)
+      and the 'largest_run_voxels'.
+    """
+    summary = {'bold_runs': 0, 'anat_images': 0, 'bold_voxels': 0, 'largest_run_voxels': 0}
+
+    for root, _, names in os.walk(input_dir):
+        for name in names:
+            if not name.endswith(('.nii', '.nii.gz')):
+                continue
+            path = os.path.join(root, name)
+            if re.search(r"_bold\.nii(\.gz)?$", name):
+                try:
+                    voxels = math.prod(read_nifti_shape(path))
+                except (OSError, ValueError, struct.error) as e:
+                    print(f"Could not read header of {path}: {str(e)}")
+                    continue
+                summary['bold_runs'] += 1
+                summary['bold_voxels'] += voxels
+                summary['largest_run_voxels'] = max(summary['largest_run_voxels'], voxels)
+            elif re.search(r"_(T1w|T2w)\.nii(\.gz)?$", name):
+                summary['anat_images'] += 1
+
+    return summary
+
+
+def _elapsed_seconds(value: str) -> int:
+    """Converts a sacct duration such as '1-02:03:04', '02:03:04' or '03:04.5' into seconds."""
+    days, _, clock = value.rpartition('-')
+    parts = [float(p) for p in clock.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    return int((int(days) if days else 0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2])
+
+
+def _memory_mb(value: str, cpus: Optional[float] = None) -> Optional[float]:
+    """
+    Converts a sacct memory value such as '12345K', '8G' or '16000Mn' into megabytes. Requests per CPU, such as
+    '4000Mc', are multiplied by the allocated CPUs, and are None when the CPUs are not known.
+    """
+    match = re.match(r"^([\d.]+)([KMGT]?)([nc]?)", value)
+    if not match:
+        return None
+    scale = {'': 1 / (1024 * 1024), 'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}[match.group(2)]
+    if match.group(3) == 'c':
+        if not cpus:
+            return None
+        scale *= cpus
+    return float(match.group(1)) * scale
+
+
+def fetch_usage_history(client: SSHClient, username: str, days: int = 30) -> Dict[str, float]:
+    """
+    Derives calibration factors from past fMRIPrep jobs recorded by sacct.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - username (str): The cluster user running the jobs.
+    - days (int): How far back to look. Default is 30.
+
+    Returns:
+    - Dict[str, float]: 'time' and 'memory' factors to apply to the model estimate (1.0 means no change),
+      and the number of 'jobs' they are based on. Empty if there is no usable history.
+    """
+    command = (f"/opt/slurm/default/bin/sacct -u {username} -S now-{days}days --name={job_name} -n -P "
+               f"-o JobID,State,Elapsed,Timelimit,MaxRSS,ReqMem,AllocCPUS")
+    stdin, stdout, stderr = client.exec_command(command)
+
+    jobs: Dict[str, Dict] = {}
+    for line in stdout.read().decode('utf-8').splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 7:
+            continue
+        job = jobs.setdefault(fields[0].split('.')[0], {'max_rss_mb': 0.0})
+        if '.' not in fields[0]:
+            job.update(state=fields[1].split()[0], elapsed=fields[2], limit=fields[3], req_mem=fields[5], cpus=float(fields[6]) if fields[6].isdigit() else None)
+        rss = _memory_mb(fields[4]) if fields[4] else None
+        if rss:
+            job['max_rss_mb'] = max(job['max_rss_mb'], rss)
+
+    time_ratios: List[float] = []
+    memory_ratios: List[float] = []
+    for job in jobs.values():
+        if job.get('state') == 'TIMEOUT':
+            time_ratios.append(1.5)
+        if job.get('state') == 'OUT_OF_MEMORY':
+            memory_ratios.append(1.5)
+        if job.get('state') != 'COMPLETED':
+            continue
+        try:
+            time_ratios.append(_elapsed_seconds(job['elapsed']) / _elapsed_seconds(job['limit']))
+        except (ValueError, ZeroDivisionError):
+            pass
+        requested = _memory_mb(job['req_mem'], cpus=job.get('cpus')) if job.get('req_mem') else None
+        if requested and job['max_rss_mb']:
+            memory_ratios.append(job['max_rss_mb'] / requested)
+
+    if not time_ratios:
+        return {}
+
+    def calibration(ratios: List[float]) -> float:
+        # Size for the 90th percentile of past usage plus a 25% margin, never shrinking below half
+        ratios = sorted(ratios)
+        percentile = ratios[min(len(ratios) - 1, int(0.9 * len(ratios)))]
+        return min(2.0, max(0.5, percentile * 1.25))
+
+    history = {'time': calibration(time_ratios), 'jobs': float(len(jobs))}
+    if memory_ratios:
+        history['memory'] = calibration(memory_ratios)
+    return history
+
+
+def estimate_job_resources(input_dir: str, anat_only: bool, has_freesurfer: bool, history: Optional[Dict[str, float]] = None, max_cpus: int = 32) -> JobResources:
+    """
+    Sizes the SLURM allocation of a session from its staged input.
+
+    Parameters:
+    - input_dir (str): The local BIDS directory of the session.
+    - anat_only (bool): Whether only the anatomical workflow runs.
+    - has_freesurfer (bool): Whether a finished FreeSurfer subject is staged, so recon-all is skipped.
+    - history (Optional[Dict[str, float]]): Calibration factors from fetch_usage_history.
+    - max_cpus (int): The largest allocation to request. Default is 32.
+
+    Returns:
+    - JobResources: The cores, memory, walltime and fMRIPrep thread settings for the job.
+    """
+    summary = summarize_inputs(input_dir)
+    runs = 0 if anat_only else summary['bold_runs']
+
+    # Anatomical workflow: recon-all dominates unless a finished subject is reused
+    anat_hours = 1.5 if has_freesurfer else 6.0
+    # Functional workflow: about 20 minutes per 100 million voxel-volumes, runs processed side by side
+    func_hours = 0.33 * (summary['bold_voxels'] / 1e8) if runs else 0.0
+
+    cpus = 8 if runs <= 1 else min(max_cpus, 8 + 4 * runs)
+    cpus = min(cpus, max_cpus)
+    omp_nthreads = min(8, cpus)
+
+    # Parallel branches need room for one run in float32 plus nipype's intermediate copies
+    largest_run_gb = summary['largest_run_voxels'] * 4 / 1024 ** 3
+    concurrent_runs = min(runs, max(1, cpus // omp_nthreads))
+    mem_gb = (16 if not has_freesurfer else 8) + concurrent_runs * (2 + 4 * largest_run_gb)
+
+    walltime_hours = (anat_hours + func_hours / max(1, concurrent_runs)) * 1.5
+
+    if history:
+        walltime_hours *= history.get('time', 1.0)
+        mem_gb *= history.get('memory', 1.0)
+
+    resources = JobResources(
+        cpus=cpus,
+        walltime_hours=int(min(48, max(2, math.ceil(walltime_hours)))),
+        mem_gb=int(math.ceil(mem_gb)),
+        omp_nthreads=omp_nthreads,
+    )
+    print(f"Sized job from {summary['bold_runs']} BOLD run(s), {summary['anat_images']} anatomical image(s)"
+          f"{' and an existing FreeSurfer subject' if has_freesurfer else ''}: {resources.cpus} cores, "
+          f"{resources.mem_gb} GB, {resources.walltime} walltime")
+    return resources
+
+
+def pack_sessions(estimates: Dict[str, JobResources], node_cpus: int = default_pack_cpus, node_mem_gb: int = default_pack_mem_gb,
+                  max_sessions: int = 4) -> List[List[str]]:
+    """
+    Groups sessions into shared allocations, first fit by decreasing walltime so sessions of a similar length
+    end up together and the allocation is not held for one long session. A session too large for the node runs alone.
+
+    Parameters:
+    - estimates (Dict[str, JobResources]): The resources of each session, from estimate_job_resources.
+    - node_cpus (int): The cores of one allocation. Default is PACK_NODE_CPUS or 32.
+    - node_mem_gb (int): The memory of one allocation in GB. Default is PACK_NODE_MEM_GB or 128.
+    - max_sessions (int): The most fMRIPrep instances run side by side. Default is 4.
+
+    Returns:
+    - List[List[str]]: The session labels of each allocation.
+    """
+    groups: List[List[str]] = []
+    order = sorted(estimates, key=lambda label: (estimates[label].walltime_hours, estimates[label].cpus), reverse=True)
+    for label in order:
+        resources = estimates[label]
+        for group in groups:
+            cpus = sum(estimates[other].cpus for other in group) + resources.cpus
+            mem_gb = sum(estimates[other].mem_gb or 0 for other in group) + (resources.mem_gb or 0)
+            if len(group) < max_sessions and cpus <= node_cpus and mem_gb <= node_mem_gb:
+                group.append(label)
+                break
+        else:
+            groups.append([label])
+
+    print(f"Packed {len(estimates)} session(s) into {len(groups)} allocation(s): "
+          f"{'; '.join(', '.join(group) for group in groups)}")
+    return groups
+
+
+def packed_resources(estimates: List[JobResources]) -> JobResources:
+    """
+    Returns the allocation running several sessions side by side: the sum of their cores and memory, for the longest walltime.
+
+    Parameters:
+    - estimates (List[JobResources]): The resources of each session of the allocation.
+
+    Returns:
+    - JobResources: The allocation to request.
+    """
+    return JobResources(
+        cpus=sum(r.cpus for r in estimates),
+        walltime_hours=max(r.walltime_hours for r in estimates),
+        mem_gb=sum(r.mem_gb for r in estimates) if all(r.mem_gb is not None for r in estimates) else None,
+    )
+
+
+def _tree_size(path: str) -> int:
+    """Total size in bytes of the files under a local directory."""
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def estimate_scratch_footprint(input_dir: str, anat_only: bool, freesurfer_dir: Optional[str] = None, derivatives_dir: Optional[str] = None,
+                               streamed_freesurfer_bytes: int = 0) -> int:
+    """
+    Estimates the peak /scratch usage of a session: the staged inputs, the nipype work directory and the outputs.
+
+    Parameters:
+    - input_dir (str): The local BIDS directory of the session.
+    - anat_only (bool): Whether only the anatomical workflow runs.
+    - freesurfer_dir (Optional[str]): The local FreeSurfer subject staged with the session, if any.
+    - derivatives_dir (Optional[str]): The local anatomical derivatives staged with the session, if any.
+    - streamed_freesurfer_bytes (int): The size of a FreeSurfer subject streamed from XNAT to the cluster instead of
+      being staged locally. Default is 0.
+
+    Returns:
+    - int: The number of bytes to reserve.
+    """
+    summary = summarize_inputs(input_dir)
+    bold_bytes = 0 if anat_only else summary['bold_voxels'] * 4
+
+    staged_freesurfer = _tree_size(freesurfer_dir) if freesurfer_dir and os.path.isdir(freesurfer_dir) else streamed_freesurfer_bytes
+    # The job copies a staged subject to its output directory, otherwise recon-all writes about 1.5 GB
+    freesurfer_output = staged_freesurfer or int(1.5 * 1024 ** 3)
+
+    input_bytes = _tree_size(input_dir) + staged_freesurfer
+    if derivatives_dir and os.path.isdir(derivatives_dir):
+        input_bytes += _tree_size(derivatives_dir)
+    # nipype keeps several float32 copies of each run (resampled, masked, confounds, carpet plots)
+    work_bytes = 4 * 1024 ** 3 + 8 * bold_bytes
+    # Preprocessed runs in each volumetric space, surfaces, reports and the FreeSurfer subject
+    output_bytes = freesurfer_output + 3 * bold_bytes + 512 * 1024 ** 2
+
+    footprint = input_bytes + work_bytes + output_bytes
+    print(f"Estimated /scratch footprint: {footprint / 1024 ** 3:.1f} GB "
+          f"(inputs {input_bytes / 1024 ** 3:.1f} GB, work {work_bytes / 1024 ** 3:.1f} GB, outputs {output_bytes / 1024 ** 3:.1f} GB)")
+    return footprint
@@ -1,6 +1,9 @@
 import paramiko
 import time
 import os 
+import shlex
+import subprocess
+from typing import List
 
 def connect(hostname: str, port: int, username: str, password: str) -> paramiko.SSHClient:
     """
@@ -61,4 +64,102 @@ def connect_with_key(hostname: str, port: int, username: str, private_key_path:
             time.sleep(10)
             
     print("Connected to the server using SSH key...")
-    return client
\ No newline at end of file
+    return client
+
+
+class SSHConnection:
+    """
+    Manages the connections of a workflow to the cluster: one paramiko client for remote commands and one
+    OpenSSH ControlMaster socket reused by every rsync/ssh subprocess, so each transfer skips the TCP
+    handshake and key exchange. Both are re-established transparently when they drop.
+    """
+
+    def __init__(self, hostname: str, port: int, username: str, private_key_path: str = None, control_dir: str = '/tmp', control_persist: int = 600):
+        """
+        Parameters:
+            hostname (str): The hostname or IP address of the server.
+            port (int): The port number for SSH (usually 22).
+            username (str): The username for authentication.
+            private_key_path (str): Path to the private key file. Defaults to ~/.ssh/id_rsa if not provided.
+            control_dir (str): Directory holding the ControlMaster socket. Default is /tmp.
+            control_persist (int): Seconds the master stays open after its last use. Default is 600.
+        """
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.private_key_path = private_key_path or os.path.expanduser('~/.ssh/id_rsa')
+        self.control_path = os.path.join(control_dir, f"ssh-{username}@{hostname}:{port}")
+        self.control_persist = control_persist
+        self._client = None
+
+    def connect(self) -> 'SSHConnection':
+        """Establishes the paramiko client and the ControlMaster connection."""
+        self._ensure_client()
+        self.ensure_master()
+        return self
+
+    @property
+    def client(self) -> paramiko.SSHClient:
+        """The paramiko client, reconnected if the previous transport is no longer active."""
+        return self._ensure_client()
+
+    def _ensure_client(self) -> paramiko.SSHClient:
+        transport = self._client.get_transport() if self._client is not None else None
+        if transport is None or not transport.is_active():
+            if self._client is not None:
+                print("SSH connection lost, reconnecting...")
+                self._client.close()
+            self._client = connect_with_key(hostname=self.hostname, port=self.port, username=self.username, private_key_path=self.private_key_path)
+        return self._client
+
+    def _ssh_options(self) -> List[str]:
+        return [
+            "-i", self.private_key_path,
+            "-p", str(self.port),
+            "-o", "StrictHostKeyChecking=no",
+            "-o", f"ControlPath={self.control_path}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPersist={self.control_persist}",
+            "-o", "ServerAliveInterval=30",
+        ]
+
+    def _master_command(self, operation: str) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["ssh", *self._ssh_options(), "-O", operation, f"{self.username}@{self.hostname}"],
+            capture_output=True, text=True
+        )
+
+    def ensure_master(self) -> None:
+        """
+        Starts the ControlMaster connection if it is not running, removing a stale socket left by a dropped master.
+
+        Raises:
+            Exception: If the master connection cannot be established.
+        """
+        if self._master_command("check").returncode == 0:
+            return
+
+        if os.path.exists(self.control_path):
+            os.remove(self.control_path)
+
+        # The forked master keeps its standard streams open, so they must not be pipes we wait on
+        result = subprocess.run(
+            ["ssh", *self._ssh_options(), "-M", "-N", "-f", f"{self.username}@{self.hostname}"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        if result.returncode != 0:
+            raise Exception(f"Could not start SSH control connection (exit status {result.returncode})")
+        print("Started multiplexed SSH control connection...")
+
+    @property
+    def ssh_command(self) -> str:
+        """The ssh command line for rsync's -e option, routed through the running ControlMaster."""
+        self.ensure_master()
+        return ' '.join(shlex.quote(part) for part in ["ssh", *self._ssh_options()])
+
+    def close(self) -> None:
+        """Closes the paramiko client and stops the ControlMaster connection."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        self._master_command("exit")
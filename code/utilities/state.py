@@ -0,0 +1,68 @@
+import json
+import os
+from typing import Any, Dict
+
+# Root of everything that must outlive the orchestrator container: workflow state, caches and the service directory.
+# It must be a mount of persistent host storage, /temp_files is discarded with the container.
+persistent_dir = os.getenv('FMRIPREP_PERSISTENT_DIR', '/persistent')
+# Directory holding one state file per workflow
+default_state_dir = os.getenv('FMRIPREP_STATE_DIR', os.path.join(persistent_dir, 'state'))
+
+
+class WorkflowState:
+    """
+    Durable record of the progress of a workflow: which steps completed and the results later steps
+    depend on (job ID, remote paths, transfer statistics). Every change is written atomically, so a
+    restarted orchestrator resumes at the first incomplete step instead of staging and submitting again.
+    """
+
+    def __init__(self, workflow_id: str, state_dir: str = default_state_dir):
+        """
+        Parameters:
+        - workflow_id (str): The workflow whose state is recorded.
+        - state_dir (str): The directory holding the state files.
+        """
+        self.path = os.path.join(state_dir, f"{workflow_id}.json")
+        self.data: Dict[str, Any] = {'completed_steps': [], 'values': {}}
+
+        try:
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+            print(f"Resuming workflow {workflow_id} from {self.path}, completed steps: {', '.join(self.data['completed_steps']) or 'none'}")
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print(f"Ignoring unreadable state file {self.path}")
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def is_done(self, step: str) -> bool:
+        """Tells whether a step completed in this or a previous run."""
+        return step in self.data['completed_steps']
+
+    def mark_done(self, step: str) -> None:
+        """Records that a step completed."""
+        if step not in self.data['completed_steps']:
+            self.data['completed_steps'].append(step)
+            self._save()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Returns a recorded result, or default if it was never recorded."""
+        return self.data['values'].get(key, default)
+
+    def set(self, **values: Any) -> None:
+        """Records results. Values must be JSON serializable."""
+        self.data['values'].update(values)
+        self._save()
+
+    def remove(self) -> None:
+        """Deletes the state file once the workflow is over."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,141 @@
+import io
+import shlex
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from paramiko.client import SSHClient
+
+from .metrics import record_transfer
+from .remote import deferred_stderr_command
+
+# Files up to this size are prefetched into memory by the worker pool, larger files are streamed directly
+prefetch_max_bytes = 8 * 1024 * 1024
+
+
+class _ChannelWriter:
+    """File-like object forwarding writes to a paramiko channel and counting the bytes sent."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.bytes = 0
+
+    def write(self, data: bytes) -> int:
+        self.channel.sendall(data)
+        self.bytes += len(data)
+        return len(data)
+
+
+def _tar_header(name: str, size: int) -> bytes:
+    """
+    Builds the tar header block(s) for a regular file.
+
+    Parameters:
+    - name (str): The path of the file inside the archive.
+    - size (int): The size of the file in bytes.
+
+    Returns:
+    - bytes: The encoded header, using the PAX format so long FreeSurfer paths are preserved.
+    """
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _tar_padding(size: int) -> bytes:
+    """Returns the NUL padding that completes the last 512-byte block of a file."""
+    return tarfile.NUL * ((tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
+
+
+def stream_resource_files_to_remote(connection, files: List[Dict], client: SSHClient, remote_dir: str, prefix: str = 'freesurfer', max_workers: int = 8) -> Dict:
+    """
+    Streams the files of an XNAT resource into a remote directory as a tar archive written through an SSH channel.
+    Nothing is written to the local disk: small files are prefetched into memory by a bounded worker pool
+    and large files are forwarded chunk by chunk from the HTTP response to the channel.
+
+    Parameters:
+    - connection: An open xnat session.
+    - files (List[Dict]): The resource files as returned by list_resource_files.
+    - client (SSHClient): An established SSHClient instance connected to the cluster.
+    - remote_dir (str): The remote directory where the archive is unpacked.
+    - prefix (str): The directory inside remote_dir that receives the resource tree. Default is 'freesurfer'.
+    - max_workers (int): The maximum number of concurrent prefetches. Default is 8.
+
+    Returns:
+    - Dict: Transfer statistics with the keys 'files', 'bytes' and 'seconds'.
+
+    Raises:
+    - Exception: If a download does not match its listed size or the remote tar process fails.
+    """
+    channel = client.get_transport().open_session()
+    # Nothing reads the channel until the archive is sent, so tar messages must not pile up in it
+    channel.exec_command(deferred_stderr_command(f"mkdir -p {shlex.quote(remote_dir)} && tar -xf - -C {shlex.quote(remote_dir)}"))
+    writer = _ChannelWriter(channel)
+    start = time.time()
+
+    def prefetch(entry: Dict):
+        # Files with an unknown size also need buffering, the tar header must be written before the data
+        if entry['size'] is not None and entry['size'] > prefetch_max_bytes:
+            return None
+        buffer = io.BytesIO()
+        connection.download_stream(entry['uri'], buffer)
+        return buffer.getvalue()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            entries = iter(files)
+
+            # Keep at most max_workers downloads in flight ahead of the entry being sent
+            for entry in entries:
+                pending.append((entry, executor.submit(prefetch, entry)))
+                if len(pending) >= max_workers:
+                    break
+
+            while pending:
+                entry, future = pending.popleft()
+                next_entry = next(entries, None)
+                if next_entry is not None:
+                    pending.append((next_entry, executor.submit(prefetch, next_entry)))
+
+                name = f"{prefix}/{entry['path']}" if prefix else entry['path']
+                data = future.result()
+
+                if data is not None:
+                    channel.sendall(_tar_header(name, len(data)))
+                    writer.write(data)
+                    size = len(data)
+                else:
+                    size = entry['size']
+                    channel.sendall(_tar_header(name, size))
+                    sent_before = writer.bytes
+                    connection.download_stream(entry['uri'], writer)
+                    if writer.bytes - sent_before != size:
+                        raise Exception(f"Size mismatch while streaming {entry['path']}: "
+                                        f"expected {size} bytes, got {writer.bytes - sent_before}")
+
+                channel.sendall(_tar_padding(size))
+                print(f"Streamed: {entry['path']}")
+
+        # Two empty blocks mark the end of the archive
+        channel.sendall(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        channel.shutdown_write()
+
+        exit_status = channel.recv_exit_status()
+        if exit_status != 0:
+            error_output = channel.makefile_stderr('rb').read().decode('utf-8').strip()
+            raise Exception(f"Remote tar failed with exit status {exit_status}: {error_output}")
+    finally:
+        channel.close()
+
+    seconds = time.time() - start
+    throughput = writer.bytes / seconds / (1024 * 1024) if seconds > 0 else 0.0
+    print(f"Streamed {len(files)} files ({writer.bytes / (1024 * 1024):.1f} MB) to {remote_dir} "
+          f"in {seconds:.1f}s at {throughput:.1f} MB/s")
+    record_transfer('xnat_stream', files=len(files), bytes=writer.bytes, seconds=seconds)
+
+    return {'files': len(files), 'bytes': writer.bytes, 'seconds': seconds}
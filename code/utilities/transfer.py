@@ -0,0 +1,384 @@
+import heapq
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from paramiko.client import SSHClient
+
+from .metrics import record_transfer
+from .remote import deferred_stderr_command
+from .retry import FatalError
+
+# Number of concurrent rsync workers used by parallel_sync
+default_workers = int(os.getenv('TRANSFER_WORKERS', 4))
+
+# Archive transfers: 'auto' streams a tar compressed with zstd when both sides have it, 'zstd', 'tar' or 'off'
+default_archive_mode = os.getenv('TRANSFER_ARCHIVE', 'auto')
+# Below this many new files the archive saves too little over rsync to be worth it
+archive_min_files = int(os.getenv('ARCHIVE_MIN_FILES', 64))
+archive_chunk_bytes = 1024 * 1024
+
+# Text formats worth compressing on the wire. NIfTI, GIfTI, CIFTI and MGZ files are already compressed
+# or binary and only burn CPU when rsync recompresses them.
+compressible_suffixes = (
+    '.log', '.txt', '.tsv', '.json', '.csv', '.html', '.svg', '.toml', '.rst', '.out', '.err',
+    '.stats', '.label', '.ctab', '.lta', '.dat', '.cmd', '.env', '.annot.ctab', '.xfm', '.touch',
+)
+# FreeSurfer directories that only hold text files, often without an extension
+compressible_directories = ('scripts', 'stats', 'label', 'touch')
+
+
+def is_compressible(path: str) -> bool:
+    """
+    Tells whether a file benefits from rsync compression, based on its name.
+
+    Parameters:
+    - path (str): The path of the file, relative to the transfer root.
+
+    Returns:
+    - bool: True for text formats, False for compressed or binary imaging formats.
+    """
+    name = path.lower()
+    if name.endswith(('.gz', '.gii', '.mgz', '.mgh', '.nii', '.png', '.jpg', '.zip', '.h5', '.x5')):
+        return False
+    if name.endswith(compressible_suffixes):
+        return True
+    parent = os.path.basename(os.path.dirname(name))
+    return parent in compressible_directories and '.' not in os.path.basename(name)
+
+
+def list_local_files(root: str) -> List[Tuple[str, int]]:
+    """
+    Lists the regular files and symbolic links under a local directory. Links are listed, not followed, so the
+    transfers copy them as links, e.g. the surf/lh.pial -> lh.pial.T1 links of a FreeSurfer 7 subject.
+
+    Parameters:
+    - root (str): The directory to list.
+
+    Returns:
+    - List[Tuple[str, int]]: The relative path and size of each file, the size of a link being that of the link itself.
+    """
+    files = []
+    for directory, subdirectories, names in os.walk(root):
+        # os.walk reports links to directories among the directories, without descending into them
+        for name in names + [d for d in subdirectories if os.path.islink(os.path.join(directory, d))]:
+            path = os.path.join(directory, name)
+            if os.path.islink(path) or os.path.isfile(path):
+                files.append((os.path.relpath(path, root), os.lstat(path).st_size))
+    return files
+
+
+def list_remote_files(client: SSHClient, root: str) -> List[Tuple[str, int]]:
+    """
+    Lists the regular files and symbolic links under a remote directory with a single find command.
+
+    Parameters:
+    - client (SSHClient): An established SSHClient instance to execute commands on the remote server.
+    - root (str): The remote directory to list.
+
+    Returns:
+    - List[Tuple[str, int]]: The relative path and size of each file. Empty if the directory does not exist.
+    """
+    stdin, stdout, stderr = client.exec_command(f"find {shlex.quote(root)} \\( -type f -o -type l \\) -printf '%s\\t%P\\n' 2>/dev/null")
+    files = []
+    for line in stdout.read().decode('utf-8').splitlines():
+        size, _, path = line.partition('\t')
+        if path:
+            files.append((path, int(size)))
+    return files
+
+
+def make_shards(files: List[Tuple[str, int]], shard_count: int) -> List[List[str]]:
+    """
+    Splits files into shards of roughly equal total size, assigning the largest files first to the lightest shard.
+
+    Parameters:
+    - files (List[Tuple[str, int]]): The relative path and size of each file.
+    - shard_count (int): The maximum number of shards.
+
+    Returns:
+    - List[List[str]]: The non-empty shards, each a list of relative paths.
+    """
+    shard_count = max(1, min(shard_count, len(files)))
+    heap = [(0, index) for index in range(shard_count)]
+    shards = [[] for _ in range(shard_count)]
+
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        load, index = heapq.heappop(heap)
+        shards[index].append(path)
+        heapq.heappush(heap, (load + size, index))
+
+    return [shard for shard in shards if shard]
+
+
+def _run_shard(rsync_prefix: List[str], paths: List[str], source: str, destination: str) -> int:
+    """
+    Runs one rsync worker over a list of files.
+
+    Returns:
+    - int: The number of bytes transferred, as reported by rsync --stats.
+
+    Raises:
+    - Exception: If rsync fails.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.files', delete=False) as files_from:
+        files_from.write('\n'.join(paths) + '\n')
+
+    try:
+        command = rsync_prefix + ["--stats", f"--files-from={files_from.name}", source, destination]
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"rsync failed with exit status {result.returncode}: {result.stderr.strip()}")
+    finally:
+        os.remove(files_from.name)
+
+    match = re.search(r"Total transferred file size: ([\d,.]+)", result.stdout)
+    return int(re.sub(r"[,.]", '', match.group(1))) if match else 0
+
+
+def parallel_sync(action: str, username: str, hostname: str, source: str, destination: str, client: SSHClient, workers: int = default_workers, ssh_command: Optional[str] = None, files: Optional[List[Tuple[str, int]]] = None) -> Dict:
+    """
+    Copies the content of a directory to or from the remote server with several rsync workers at once.
+    The tree is split into shards of balanced size, and only shards of compressible file types use rsync -z.
+
+    Parameters:
+    - action (str): Action to perform, either "send" or "get".
+    - username (str): Username on the remote host.
+    - hostname (str): IP address or hostname of the remote server.
+    - source (str): Source directory whose content is copied (local for "send", remote for "get").
+    - destination (str): Destination directory receiving the content (remote for "send", local for "get").
+    - client (SSHClient): An established SSHClient instance, used to list or create remote directories.
+    - workers (int): The number of concurrent rsync processes. Default is TRANSFER_WORKERS or 4.
+    - ssh_command (Optional[str]): The remote shell used by rsync, e.g. SSHConnection.ssh_command.
+    - files (Optional[List[Tuple[str, int]]]): The relative paths and sizes to copy. Defaults to the whole tree.
+
+    Returns:
+    - Dict: Transfer statistics with the keys 'files', 'bytes' and 'seconds'.
+
+    Raises:
+    - FatalError: If the local source is missing.
+    - Exception: If the action is invalid or an rsync worker fails.
+    """
+    if ssh_command is None:
+        ssh_command = "ssh -o StrictHostKeyChecking=no"
+
+    source = source.rstrip('/')
+    destination = destination.rstrip('/')
+
+    if action == "send":
+        if not os.path.isdir(source):
+            raise FatalError(f"The provided source '{source}' does not exist.")
+        if files is None:
+            files = list_local_files(source)
+        client.exec_command(f"mkdir -p {shlex.quote(destination)}")[1].channel.recv_exit_status()
+        rsync_source, rsync_destination = f"{source}/", f"{username}@{hostname}:{destination}/"
+    elif action == "get":
+        if files is None:
+            files = list_remote_files(client, source)
+        os.makedirs(destination, exist_ok=True)
+        rsync_source, rsync_destination = f"{username}@{hostname}:{source}/", f"{destination}/"
+    else:
+        raise Exception("Invalid action specified. Choose either 'send' or 'get'.")
+
+    compressible = [f for f in files if is_compressible(f[0])]
+    incompressible = [f for f in files if not is_compressible(f[0])]
+
+    base_command = ["rsync", "-a", "-e", ssh_command]
+    jobs = [(base_command + ["-z"], shard) for shard in make_shards(compressible, workers)]
+    jobs += [(base_command, shard) for shard in make_shards(incompressible, workers)]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_run_shard, command, shard, rsync_source, rsync_destination) for command, shard in jobs]
+        total_bytes = sum(future.result() for future in futures)
+    seconds = time.time() - start
+
+    throughput = total_bytes / seconds / (1024 * 1024) if seconds > 0 else 0.0
+    print(f"Transferred {len(files)} files ({total_bytes / (1024 * 1024):.1f} MB) from {source} to {destination} "
+          f"with {len(jobs)} shards in {seconds:.1f}s at {throughput:.1f} MB/s")
+    record_transfer(f"rsync_{action}", files=len(files), bytes=total_bytes, seconds=seconds, shards=len(jobs))
+
+    return {'files': len(files), 'bytes': total_bytes, 'seconds': seconds}
+
+
+def _zstd_available(client: SSHClient) -> bool:
+    """Tells whether zstd is installed both locally and on the remote server."""
+    if shutil.which('zstd') is None:
+        return False
+    stdin, stdout, stderr = client.exec_command("command -v zstd")
+    return stdout.channel.recv_exit_status() == 0
+
+
+def _local_pipeline(commands: List[List[str]], stdin=None, stdout=None) -> List[subprocess.Popen]:
+    """Starts local commands connected by pipes. The stdout of the last command is a pipe unless given."""
+    processes = []
+    for index, command in enumerate(commands):
+        last = index == len(commands) - 1
+        processes.append(subprocess.Popen(command, stdin=processes[-1].stdout if processes else stdin,
+                                          stdout=stdout if last and stdout is not None else subprocess.PIPE, stderr=subprocess.PIPE))
+        if len(processes) > 1:
+            # Only the next command reads the pipe, so it sees EOF when the previous one exits
+            processes[-2].stdout.close()
+    return processes
+
+
+def _check_pipeline(processes: List[subprocess.Popen]) -> None:
+    """Waits for local commands and raises if any of them failed."""
+    for process in processes:
+        if process.wait() != 0:
+            raise Exception(f"{process.args[0]} failed with exit status {process.returncode}: {process.stderr.read().decode('utf-8').strip()}")
+
+
+def _check_remote_tar(channel) -> None:
+    """Waits for the remote side of an archive transfer and raises if it failed."""
+    exit_status = channel.recv_exit_status()
+    if exit_status != 0:
+        error_output = channel.makefile_stderr('rb').read().decode('utf-8').strip()
+        raise Exception(f"Remote tar failed with exit status {exit_status}: {error_output}")
+
+
+def archive_transfer(action: str, source: str, destination: str, client: SSHClient, files: List[Tuple[str, int]], compress: bool = False) -> Dict:
+    """
+    Copies files to or from the remote server as a single tar stream through one SSH channel, unpacked on the other
+    side as it arrives. A tree of many small files, like a FreeSurfer subject, costs one stream instead of one
+    round-trip per file.
+
+    Parameters:
+    - action (str): Action to perform, either "send" or "get".
+    - source (str): Source directory holding the files (local for "send", remote for "get").
+    - destination (str): Destination directory receiving the files (remote for "send", local for "get").
+    - client (SSHClient): An established SSHClient instance connected to the remote server.
+    - files (List[Tuple[str, int]]): The relative paths and sizes of the files to copy.
+    - compress (bool): Compress the stream with zstd, which must be installed on both sides. Default is False.
+
+    Returns:
+    - Dict: Transfer statistics with the keys 'files', 'bytes' (as sent over the wire) and 'seconds'.
+
+    Raises:
+    - Exception: If the action is invalid or tar fails on either side.
+    """
+    source = source.rstrip('/')
+    destination = destination.rstrip('/')
+    with tempfile.NamedTemporaryFile('wb', suffix='.files', delete=False) as files_from:
+        files_from.write(b''.join(path.encode('utf-8') + b'\0' for path, _ in files))
+
+    channel = client.get_transport().open_session()
+    start = time.time()
+    transferred = 0
+    try:
+        if action == "send":
+            channel.exec_command(deferred_stderr_command(f"set -o pipefail; mkdir -p {shlex.quote(destination)} && "
+                                                         f"{'zstd -q -d -c | ' if compress else ''}tar -xf - -C {shlex.quote(destination)}"))
+            processes = _local_pipeline([['tar', '-cf', '-', '-C', source, '--null', '-T', files_from.name]] +
+                                        ([['zstd', '-q', '-c', '-T0']] if compress else []))
+            while True:
+                data = processes[-1].stdout.read(archive_chunk_bytes)
+                if not data:
+                    break
+                channel.sendall(data)
+                transferred += len(data)
+            channel.shutdown_write()
+            _check_pipeline(processes)
+            _check_remote_tar(channel)
+        elif action == "get":
+            channel.exec_command(deferred_stderr_command(f"set -o pipefail; tar -cf - -C {shlex.quote(source)} --null -T -{' | zstd -q -c -T0' if compress else ''}"))
+            os.makedirs(destination, exist_ok=True)
+            processes = _local_pipeline(([['zstd', '-q', '-d', '-c']] if compress else []) + [['tar', '-xf', '-', '-C', destination]],
+                                        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+            # The remote tar reads the file list while it writes the archive, so the list is sent from another thread
+            def send_file_list():
+                with open(files_from.name, 'rb') as f:
+                    channel.sendall(f.read())
+                channel.shutdown_write()
+            sender = threading.Thread(target=send_file_list, daemon=True)
+            sender.start()
+            while True:
+                data = channel.recv(archive_chunk_bytes)
+                if not data:
+                    break
+                processes[0].stdin.write(data)
+                transferred += len(data)
+            processes[0].stdin.close()
+            sender.join()
+            _check_remote_tar(channel)
+            _check_pipeline(processes)
+        else:
+            raise Exception("Invalid action specified. Choose either 'send' or 'get'.")
+    finally:
+        channel.close()
+        os.remove(files_from.name)
+
+    seconds = time.time() - start
+    throughput = transferred / seconds / (1024 * 1024) if seconds > 0 else 0.0
+    print(f"Transferred {len(files)} files ({transferred / (1024 * 1024):.1f} MB{' compressed' if compress else ''}) from {source} to {destination} "
+          f"as one archive in {seconds:.1f}s at {throughput:.1f} MB/s")
+    record_transfer(f"archive_{action}", files=len(files), bytes=transferred, seconds=seconds, compressed=compress)
+
+    return {'files': len(files), 'bytes': transferred, 'seconds': seconds}
+
+
+def archive_sync(action: str, username: str, hostname: str, source: str, destination: str, client: SSHClient, ssh_command: Optional[str] = None,
+                 files: Optional[List[Tuple[str, int]]] = None, mode: str = default_archive_mode) -> Dict:
+    """
+    Copies a directory tree like parallel_sync, but streams the files missing from the destination as one tar archive.
+    Files already present at the destination are left to rsync, whose delta transfer suits incremental updates,
+    and so are transfers of fewer than archive_min_files new files.
+
+    Parameters:
+    - action (str): Action to perform, either "send" or "get".
+    - username (str): Username on the remote host.
+    - hostname (str): IP address or hostname of the remote server.
+    - source (str): Source directory whose content is copied (local for "send", remote for "get").
+    - destination (str): Destination directory receiving the content (remote for "send", local for "get").
+    - client (SSHClient): An established SSHClient instance connected to the remote server.
+    - ssh_command (Optional[str]): The remote shell used by rsync, e.g. SSHConnection.ssh_command.
+    - files (Optional[List[Tuple[str, int]]]): The relative paths and sizes to copy. Defaults to the whole tree.
+    - mode (str): 'auto', 'zstd', 'tar' or 'off', see TRANSFER_ARCHIVE. Default is TRANSFER_ARCHIVE or 'auto'.
+
+    Returns:
+    - Dict: Transfer statistics with the keys 'files', 'bytes' and 'seconds'.
+
+    Raises:
+    - FatalError: If the local source is missing.
+    - Exception: If the action is invalid or a transfer fails.
+    """
+    source = source.rstrip('/')
+    destination = destination.rstrip('/')
+
+    if action == "send":
+        if not os.path.isdir(source):
+            raise FatalError(f"The provided source '{source}' does not exist.")
+        if files is None:
+            files = list_local_files(source)
+        existing = {path for path, _ in list_remote_files(client, destination)}
+    elif action == "get":
+        if files is None:
+            files = list_remote_files(client, source)
+        existing = {path for path, _ in list_local_files(destination)}
+    else:
+        raise Exception("Invalid action specified. Choose either 'send' or 'get'.")
+
+    new_files = [f for f in files if f[0] not in existing]
+    updated_files = [f for f in files if f[0] in existing]
+    if mode == 'off' or len(new_files) < archive_min_files:
+        new_files, updated_files = [], files
+
+    stats = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+    if new_files:
+        compress = mode == 'zstd' or (mode == 'auto' and _zstd_available(client))
+        archived = archive_transfer(action=action, source=source, destination=destination, client=client, files=new_files, compress=compress)
+        stats = {key: stats[key] + archived[key] for key in stats}
+    if updated_files:
+        synced = parallel_sync(action=action, username=username, hostname=hostname, source=source, destination=destination,
+                               client=client, ssh_command=ssh_command, files=updated_files)
+        stats = {key: stats[key] + synced[key] for key in stats}
+
+    return stats